@@ -7,28 +7,113 @@
 # 2/15/12: Major overhaul of interface and usage of AFNIpyIO instead of nibabel
 # 2/16/12: Added some error handling and warnings
 # 2/29/12: Added command line callability, if no options are passed then PLACE code defaults to using Tkinter gui
+# 10/19/26: All timepoints of a run are unwarped with a few sparse matrix-matrix products (placeunwarpall) instead of one
+#           placeunwarp() call per TR, see the -t option
+#           Unwarp matrices are cached on disk keyed by the Dmap and ParScan contents (and a cache format version that
+#           goes up when the way they are built changes), see the -c and --nocache options. Entries that don't fit the
+#           ParScan are rebuilt
+#           Scans can be corrected in parallel worker processes that share one unwarp matrix, see the -j option
+#           Each scan can be unwarped slab by slab on several threads, see the -n option
+#           Dropped the extra copies of every scan (copy.copy() and the np.arange() crops, which didn't crop anything) and
+#           added a streaming mode that works through memory mapped .BRIKs, see the -stream option
+#           Loading, unwarping and saving of consecutive scans can overlap, see the -pipeline option
+#           The unwarp is computed in float32 and rounded to the nearest integer by default. -precision float64 -rounding
+#           truncate gives the exact output of earlier versions, -float writes float32 scans
+#           The PLACE code moved to afnipyio/place.py (place.corrector, plus a service mode that keeps unwarp matrices
+#           warm between jobs), this script is the GUI and command line front end. Tk is only started for the GUI
+#           Added a watch mode that corrects every scan as soon as it has landed in a directory, see the -watch option
+#           Scans that are still being acquired can be corrected sub-brick by sub-brick as they grow, see the -follow option
+#           Every corrected scan is recorded (with input, Dmap/ParScan and output checksums) in PLACE_manifest.json in the
+#           save directory, so an interrupted batch can be rerun with -resume
+#           Scans can be submitted to a queue directory on a shared filesystem that PLACE workers on any number of hosts
+#           work through (python -m afnipyio.place QUEUE_DIR), see the -submit option
+#           The unwarp matrix is built with int32 arithmetic one slice at a time and handed to scipy as ready made CSC
+#           arrays (same matrix, a fraction of the memory), the peak memory of building it is logged
+#           afnipyio/placebench.py (make bench) times every mode on synthetic scans and checks them against
+#           a frozen copy of the original makeunwarpmatrix()/placeunwarp()
+#           Every run appends JSON Lines records to PLACE_report.jsonl in the save directory (per dataset and stage
+#           timings, bytes read and written, peak memory, voxels per second, skip and failure reasons)
+#           A gather unwarp kernel (-k gather) was tried and dropped again: a gather plus segmented sum in numpy was several
+#           times slower than scipy's sparse product on every Dmap tried, and only bit identical when summed in scipy's order
+#           Output names only drop the +orig.HEAD suffix: rstrip('+orig.HEAD') also ate trailing letters of the name, so
+#           EPI_A+orig was saved as EPI__pc+orig and different scans could get the same output. -resume refuses a batch in
+#           which two scans would still be saved to the same output
 
 #======================== required modules to be installed =================
 # Requires numpy, and scipy to be installed as Python modules.
 # Num.py - http://numpy.scipy.org/
 # Sci.py - http://www.scipy.org/
-# Also requires AFNIpyIO module to load in .HEAD/.BRIK files
+# Also requires AFNIpyIO module to load in .HEAD/.BRIK files, the PLACE correction itself is afnipyio/place.py
 
 #======================== command line options ========================
-#usage: PLACE-2.6.py [-h] -d DSETS [DSETS ...] -p PARSCAN -m DMAP
-#                     [-s [SAVE_PATH]]
+#usage: PLACE-2.6.py [-h] [-d DSETS [DSETS ...]] [-submit QUEUE_DIR]
+#                    [-w WATCH_DIR] -p PARSCAN [PARSCAN ...] -m DMAP [DMAP ...]
+#                    [-s [SAVE_PATH]] [-c CACHE_DIR] [-nocache] [-j JOBS]
+#                    [-n THREADS] [-t TCHUNK] [-pipeline DEPTH]
+#                    [-precision {float32,float64}]
+#                    [-rounding {nearest,truncate}] [-float] [-stream]
+#                    [-resume] [-follow]
+#
 #Do PLACE correction
 #
 #optional arguments:
 #  -h, --help            show this help message and exit
 #  -d DSETS [DSETS ...], -dset DSETS [DSETS ...], --dset DSETS [DSETS ...]
 #                        path(s) to .HEAD files (separated by spaces)
-#  -p PARSCAN, -pscan PARSCAN, --pscan PARSCAN
-#                        path to the ParScan file
-#  -m DMAP, -dmap DMAP, --dmap DMAP
-#                        path to the Dmap file
+#  -submit QUEUE_DIR, --submit QUEUE_DIR
+#                        instead of correcting the -d scans here, add one job
+#                        per scan to a queue directory that PLACE workers
+#                        (python -m afnipyio.place QUEUE_DIR) on any number of
+#                        hosts work through
+#  -w WATCH_DIR, -watch WATCH_DIR, --watch WATCH_DIR
+#                        instead of -d: watch a directory and correct every
+#                        scan as soon as it is complete, until interrupted
+#  -p PARSCAN [PARSCAN ...], -pscan PARSCAN [PARSCAN ...], --pscan PARSCAN [PARSCAN ...]
+#                        path to the ParScan file (with -watch: one per Dmap)
+#  -m DMAP [DMAP ...], -dmap DMAP [DMAP ...], --dmap DMAP [DMAP ...]
+#                        path to the Dmap file (with -watch: several, scans are
+#                        matched to them by their dimensions)
 #  -s [SAVE_PATH], -save [SAVE_PATH], --save [SAVE_PATH]
-#                        optional save path (default: same as first -dset path)
+#                        optional save path (default: same as first -dset path,
+#                        or the -watch directory)
+#  -c CACHE_DIR, -cache CACHE_DIR, --cache CACHE_DIR
+#                        unwarp matrix cache directory (default: PLACE_cache
+#                        next to the Dmap)
+#  -nocache, --nocache   always rebuild the unwarp matrix, without reading or
+#                        writing the cache
+#  -j JOBS, -jobs JOBS, --jobs JOBS
+#                        number of scans corrected in parallel worker processes
+#                        (default: 1, 0 = one per CPU)
+#  -n THREADS, -threads THREADS, --threads THREADS
+#                        number of threads unwarping slabs of slices of each
+#                        scan (default: 1, 0 = one per CPU)
+#  -t TCHUNK, -tchunk TCHUNK, --tchunk TCHUNK
+#                        number of timepoints unwarped per sparse matrix product
+#                        (default: 32, 0 = whole run at once)
+#  -pipeline DEPTH, --pipeline DEPTH
+#                        load the next scan and save the previous one while the
+#                        current one is unwarped, with at most DEPTH scans
+#                        waiting between stages (default: 0 = off)
+#  -precision {float32,float64}, --precision {float32,float64}
+#                        precision the unwarp is computed in (default: float32,
+#                        float64 for validation)
+#  -rounding {nearest,truncate}, --rounding {nearest,truncate}
+#                        how unwarped values are converted back to integer
+#                        scans: round to nearest and clip to the type range, or
+#                        truncate towards zero like PLACE 2.6 and earlier
+#                        (default: nearest)
+#  -float, --float       write float32 scans (BRICK_TYPES and BRICK_FLOAT_FACS
+#                        updated) instead of rounding back to the scan data type
+#  -stream, --stream     stream scans from and to disk -t timepoints at a time
+#                        instead of loading them, memory use no longer depends
+#                        on the run length
+#  -resume, --resume     only redo outputs that are missing, stale or corrupt
+#                        according to the PLACE_manifest.json in the save
+#                        directory, instead of skipping every existing output
+#  -follow, --follow     scans are still being acquired: correct new sub-bricks
+#                        as they are appended to each .BRIK (keeping the _pc
+#                        dataset valid all along) until it stops growing for 10
+#                        seconds
 
 # example call:
 #PLACE-2.6.py -d /Users/mein/Desktop/AFNI_Files/LY/111209/EPI_LY_111209_E07+orig.HEAD\
@@ -41,28 +126,16 @@
 import sys
 import os
 import time
-import string
-import copy
 
 import Tkinter as tk
 import tkFileDialog
 
-import subprocess as sp
-import numpy as np
-#custom python module to read in and write out AFNI files
-from afnipyio import AFNIPyIO as afni
-
-from scipy.sparse import *
-from operator import itemgetter
-from contextlib import contextmanager
+#the PLACE correction itself (and the custom python module to read in and write out AFNI files it uses)
+from afnipyio import place
+from afnipyio.place import printandlog, writelog, loglist, version, cache_dirname
 
 import argparse
 
-root = tk.Tk()
-
-#Version so generated logs and scripts are traceable to a specific version of the code (especially important if there are errors)
-version = 'V2.6'
-
 #==================================== CUSTOM USER SETTINGS CHANGE BEFORE YOU USE FOR YOURSELF ========================
 
 defaultdir = '/nfs/data42/seidlitzjm'
@@ -71,235 +144,14 @@ defaultdir = '/nfs/data42/seidlitzjm'
 
 #this will change once you've selected a Dmap or Parscan file
 dmap_parscan_defaultdir = defaultdir
-loglist = []
-
-#Error Handler
-class Error(Exception):
-    def __init__(self, value):
-        self.value = value
-    def __str__(self):
-        return repr(self.value)
-
-#========================= makeunwarpmatrix function translation from matlab code ===============
-#All credit for the logic of the following code goes to GKA and was written July 2006
-#Questions about the overall logic of this function should go to (GKA) geoff.adams@gmail.com
-#Questions about the num.py and sci.py conversion or reports for bugs should go to njmei11@gmail.com
-
-def makeunwarpmatrix(dmap, expan):
-    
-    expan = float(expan)
-
-    #transpose dmap to put phase in columns and read in rows
-    #results in a 3200x64x28 matrix (for 11/02/25 CS scan)
-    #remember!!! axes in python = matlabaxes-1
-    dmap3 = np.transpose(dmap,[1,0,2])
-
-    #print 'Transposed Dmap is: \n' + str(dmap3)
-
-    print 'Dimensions of transposed dmap are: ' + str(dmap3.shape)
-
-    #print dmap3.dtype
-    nslice = np.size(dmap3, axis=2)             #Number of slices
-    nphasevol = np.size(dmap3, axis=0)/expan    #Number of phase points in volume
-    nphasedmap = np.size(dmap3, axis=0)         #Number of phase points in dmap
-    nread = np.size(dmap3, axis=1)              #Number of read points
-
-    print 'nslice is: ' + str(nslice)
-    print 'nphasevol is: ' + str(nphasevol)
-    print 'nphasedmap is: ' + str(nphasedmap)
-    print 'nread is: ' + str(nread)
-
-    crop = np.array([1,1,nread,nphasevol])
-
-    #print str(crop)
-    
-    #------------- Convert from displacement mapping to absolute indexing ---------------------  
-    #Matlab code: phasePoints = repmat([1:nPhaseDmap]', [1,nRead,nSlice]);
-    #Python indexes start at 0 but we will do the "offset" later to preserve parity with matlab code
-    a = np.arange(1,nphasedmap+1)                               # a = [1:nPhaseDmap]
-    #print a
-
-    #tile promotes 'a' to the dimension of the tile argument by prepending new axes as necessary
-    #matlab seems to work in the opposite way...
-    #fix is to append [:,np.newaxis,np.newaxis] to force the matlab tiling method
-    phasepoints = np.tile(a[:,np.newaxis,np.newaxis], [1,nread,nslice])
-
-    #print str('Phasepoints are: ' + str(phasepoints))    
-    print 'Dimension of phasepoints variable is: ' + str(np.shape(phasepoints))
-
-    phaseorigin = np.floor(phasepoints-dmap3, dtype=np.double)
-
-    #print np.max(phaseorigin)
-    #print np.min(phaseorigin)
-    #print str('Phase origins are: ' + str(phaseorigin))
-    #print str(np.size(phaseorigin))
-    print 'Dimensions of phaseorigin variable is: ' + str(np.shape(phaseorigin)) + '\n'
-
-    #-------------------- Correct wrapping errors --------------------------------------
-    #create a boolean index 'outofbound' where phaseorigin values are > nphasedmap
-    outofbound = phaseorigin > nphasedmap
-    #print 'First out of bound' + str(outofbound)
-    phaseorigin[outofbound] = phaseorigin[outofbound] - nphasedmap
-    
-    outofbound = phaseorigin < 1
-    #print 'Second out of bound' + str(outofbound)
-    phaseorigin[outofbound] = phaseorigin[outofbound] + nphasedmap
-
-    #----------------------- Cropping --------------------------------------
-    x1 = crop[0]                        #Read start     x1 evaluates as 1 when crop = [1, 1, 64, 32]
-    x2 = x1 + crop[2]-1                 #Read end       
-    y1 = (crop[1]-1)*expan+1            #Phase start    
-    y2 = (crop[1] + crop[3]-1)*expan    #Phase end
-
-    #phaseOrigin = phaseOrigin(y1:y2,x1:x2,:);
-    #nRead = crop(3);
-    #nPhaseVol = crop(4);
-    #nPhaseDmap = nPhaseVol*expan;
-
-    #cropping phaseorigin to "correct" dimensions. Without user input crop value, it's kind of useless...
-    #slicing in python is "inclusive" i.e. cropping anything below 0 and above 3200 requires [0:3200]
-    phaseorigin = phaseorigin[int(y1-1):int(y2), int(x1-1):int(x2)]
-    nread = crop[2]
-    nphasevol = crop[3]
-    nphasedmap = nphasevol*expan
-
-    phaseorigin = phaseorigin -y1 + 1
-    
-    outofbound = phaseorigin > nphasedmap
-    phaseorigin[outofbound] = nphasedmap
-    
-    outofbound = phaseorigin < 1
-    phaseorigin[outofbound] = 1
-
-    #print np.max(phaseorigin)
-    #print np.min(phaseorigin)
-
-    #--------------------------- Reshaping phaseorigin into a vector to construct warping matrix ---------------
-    #reshape should be in 'Fortran' mode because that's how Matlab does it
-    phaseorigin = np.reshape(phaseorigin, [nphasedmap,-1], order='F')
-
-    #Matlab code: phaseOrigin = phaseOrigin + repmat([0:nRead*nSlice-1]*nPhaseDmap, [nPhaseDmap, 1]);
-
-    b = np.arange(0,nread*nslice)
-    b = b*nphasedmap
-
-    rep = np.tile(b, [nphasedmap, 1])
-
-    phaseorigin = phaseorigin + rep
-
-    #print np.max(phaseorigin)
-    #print np.min(phaseorigin)
-
-    #Matlab: phaseOrigin = ceil(phaseOrigin(:)/expan);
-
-    phaseorigin = np.ceil(phaseorigin.flatten(1)/expan)
-    #Cludgy fix for problem of max(phaseorigin) being 57344 instead of 57343, not sure if this fix is "correct"
-    #update (10/20/11): resulting unwarpmatrix matches output of matlab program (after accounting for 0 vs. 1 index differences)
-    phaseorigin = phaseorigin -1
-
-    #print np.max(phaseorigin)
-    #print np.min(phaseorigin)
-
-    numpoints = nread*nslice*nphasevol
-    #this code in Matlab doesn't do anything....
-    #Matlab: points = range(1,numpoints+1)
-
-    #------------------------------------ Final Step! ---------------------------------------
-    #Matlab sparse takes: S = sparse(i,j,s,m,n)
-    #Generates an m by n sparse matrix such that: S(i(k),j(k)) = s(k)
-    #Matlab matrix type is CSC matrix
-
-    #scipy csc matrix takes: csc_matrix((data, ij), [shape=(M, N)])
-    #a[ij[0,k],ij[1,k]] = data[k]
-    #i would be phaseOrigin variable
-    
-    #Matlab code is: unwarpMatrix = sparse(phaseOrigin, ceil([1:nRead*nSlice*nPhaseDmap]/expan), 1, numPoints, numPoints)/expan;
-    size = nread*nslice*nphasedmap
-
-    #should use this instead because csc_matrix requires largest values in phaseorigin and j to be <= numpoints
-    #essentially j and phaseorigin are indexes and because python starts indexes from 0 we should correct for that
-    #instead of doing something like: ceil([1:nRead*nSlice*nPhaseDmap]/expan) 
-    j = np.floor(np.arange(0,size, dtype=np.double)/expan)
-
-    #Matlab apparently treats '1' as a scalar so I should be tiling 1 to the same size as j and phaseorigin
-    s = np.tile(1,size)
-    
-    unwarpmatrix = csc_matrix((s,(phaseorigin, j)), shape=(int(numpoints),int(numpoints)))/expan
-    return  unwarpmatrix
-
-#========================= Unwarp a volume given an unwarp matrix ======================
-def placeunwarp(vol, unwarpmatrix):
-    #Written by GKA
-    #Extracted from Blockana by dbtm (matlab comment)
-
-    #transpose matrix such that columns 1,2,3 (x, y, z) --> 2,1,3 (y, x, z)
-    vol = np.transpose(vol, [1,0,2])
-
-    origshape = np.array(np.shape(vol))
-
-    #turn volume into linear vector (array)
-    flatvol = vol.flatten(1)
-    #flatvol = vol.flatten(order='F')
-
-    #heart of the correction! Dot product of the unwarpmatrix vector and flatvol vector
-    #sparsematrix.dot() is very difference from np.dot() or np.inner() the first one works, the second two don't
-    dot = unwarpmatrix.dot(flatvol)
-    
-    #reshape back into original volume shape
-    corvol = np.reshape(dot, origshape, order='F')
-
-    #tranpose matrix back to 1,2,3
-    corvol = np.transpose(corvol, [1,0,2])
-
-    return corvol
-
-def printandlog(some_string):
-    global loglist
-
-    some_string = str(some_string)
-    
-    print some_string
-    loglist.append(some_string + '\n')
-
-#code for benchmarking purposes
-@contextmanager  
-def measureTime(title):
-    t1 = time.time()
-    yield
-    t2 = time.time()
-    printandlog('%s: Generating unwarp sparse matrix took %0.2f seconds ' % (title, t2-t1))
-
-#function to write out a logfile
-def writelog(logfilepath, loglist):
-    print '\n' + 'Writing out analysis log!' + '\n'
-    
-    from time import gmtime, strftime
-    time = strftime("%Y-%m-%d %H:%M:%S", gmtime())
-
-    #Opening our file!
-    LOG = open(logfilepath, 'w')
-
-    #Writing the header and time
-    LOG.write('#PLACE correction ' + version + ' by Nicholas Mei\n')
-    LOG.write('#This log was automatically generated on ' + time + ' GMT' + '\n' + '\n')
-
-    #Dump everything collected in the log into our text file!
-    for line in loglist:
-        LOG.write(line)
-
-    #Close our log!
-    LOG.close()
-
-    print 'log file written to' + logfilepath + '\n' + '\n' + 'Finally done with this condition!!' + '\n'
-
-    #empty loglist and reinitialize it for next run
-    del loglist[:]
 
 def main():
 
     #--------------------------- PLACE correction function ----------------------
 
-    def placecor(gui = True, final_dset_list = None, dmap_path = None, parscan_path = None, save_dir = None):
+    def placecor(gui = True, final_dset_list = None, dmap_path = None, parscan_path = None, save_dir = None, tchunk = 32, cache_dir = None, usecache = True, jobs = 1, threads = 1, stream = False, pipeline = 0,
+                 precision = 'float32', rounding = 'nearest', floatout = False, follow = False,
+                 resume = False):
         if gui:
             
             final_dset_list = list(dset_list.get(0, tk.END))
@@ -329,123 +181,17 @@ def main():
             printandlog("Parscan Location: " + parscan_path)
             printandlog("Save Directory: " + save_dir + "\n")
 
-            #===================================== Parscan preparation ========================================
-            #let's parse our Parscan!
-            try:
-                rawparscan = open(parscan_path, 'r')
-            except:
-                raise Error('ParScan file was unable to be opened!')
-
-            rawparscanstring = rawparscan.read()
-            rawparscan.close()
-
-            #separate all values from the raw string by ' ' (space)
-            placepars = rawparscanstring.split()
-            #take first 5 ParScan parameters (xres, yres, zres, reps, expansion)
-            placepars = placepars[:5]
-
-            placepars = [int(i) for i in placepars]
-
-            printandlog('ParScan values of interest are (xres, yres, zres, reps, expansion): ' + str(placepars))
-
-            unwarpnumread = placepars[0]
-            unwarpnumphase = placepars[1]
-            unwarpnumslice = placepars[2]
-            unwarpnumreps = placepars[3]
-            unwarpexpan = placepars[4]
-
-            #===================================== Dmap preparation ===========================================
-            #let's open up our Dmap!  
-            try:
-                binarydmap = open(dmap_path,'r')
-            except:
-                raise Error('Dmap file was unable to be opened!')
-
-            binarydmapstring = binarydmap.read()
-            binarydmap.close()
-
-            #use the numpy fromstring() function to convert the binary file
-            dmap = np.fromstring(binarydmapstring, dtype='int16')
-
-            #loglist.append('Dmap is:' + str(dmap) + '\n')
-            #print 'Dmap is: ' + str(dmap)
+            #===================================== unwarp matrix (built once for all scans) ========================
+            pc = place.corrector(dmap_path, parscan_path, precision = precision, rounding = rounding,
+                                 floatout = floatout, tchunk = tchunk, threads = threads, cache_dir = cache_dir,
+                                 usecache = usecache)
 
-            #size of Dmap should be xres*yres*expan*nslices
-            printandlog('Dimensions of dmap are: ' + str(np.size(dmap)))
-
-            #reshape should be in 'Fortran' read order mode because that's how Matlab does it...
-            dmap = np.reshape(dmap, [unwarpnumread, unwarpnumphase*unwarpexpan, unwarpnumslice], order='F')
-
-            #print 'Reshaped Dmap is: \n' + str(dmap2)
-            printandlog('Dimensions of reshaped dmap are: ' + str(dmap.shape))
-
-            with measureTime('makeunwarpmatrix'):
-
-                unwarpmatrix = makeunwarpmatrix(dmap, unwarpexpan)
-
-            printandlog('\nSample of unwarp sparse matrix: \n \n' + str(unwarpmatrix) + '\n' + '\n')
-
-            #========================================= Reading in data with nibabel and doing actual volume correction =========================
+            #========================================= Reading in data and doing actual volume correction =========================
 
             time1 = time.time()
-            skipped = 0
-
-            #go through all epis in our list
-            for epi in final_dset_list:
-
-                printandlog('\nProcessing scan: ' + str(epi))
-                
-                #load img1 using nibabel
-                img = afni.load(epi)
-                
-                #Warning: data seems to be a pointer to image data so modifying it is not recommended
-                #I.E. only reference and read values from it. Don't operate on it...
-                data = copy.copy(img.brik.volume)
-
-                printandlog('Data matrix shape is: ' + str(np.shape(data)))
-
-                #ensure that the unwarp matrix and data matrix have the same shape otherwise bad stuff will happen...
-                if tuple(np.shape(data)[0:3]) == (unwarpnumread, unwarpnumphase, unwarpnumslice):
-
-                    #initialize our new img matrix (arrays)
-                    tempimg = np.empty(np.shape(data), dtype=img.head.dtype)
-
-                    #go through each timepoint: np.size(data, axis=3) could also be replaced by numtimes
-                    for t in range(np.size(data, axis=3)):
-
-                        tempimg[:,:,:,t] = placeunwarp(data[:,:,:,t], unwarpmatrix)
-
-                    tempimg = tempimg[np.arange(0,unwarpnumread),:,:,:]
-
-                    tempimg = tempimg[:,np.arange(0,unwarpnumphase),:,:]
-
-                    #print(np.shape(tempimg))
-
-                    img.brik.volume = tempimg
-
-                    if epi.endswith('+orig.HEAD'):
-                        correctedname = epi.rstrip('+orig.HEAD') + '_pc+orig.HEAD'
-                    if epi.endswith('+acpc.HEAD'):
-                        correctedname = epi.rstrip('+acpc.HEAD') + '_pc+acpc.HEAD'
-                    if epi.endswith('+tlrc.HEAD'):
-                        correctedname = epi.rstrip('+tlrc.HEAD') + '_pc+tlrc.HEAD'
-
-                    corrected_base = os.path.basename(correctedname)
-
-                    save_path = os.path.join(save_dir, corrected_base)
-
-                    if os.path.exists(save_path):
-                        printandlog("You already have a file of the same name as: " + save_path)
-                        printandlog("PLACE correction was NOT done for: " + epi)
-                        skipped += 1
-                    else:
-                        img.save(save_path)
-                        printandlog('New PLACE corrected file will be saved to: ' + save_path)
-                        printandlog('Alright!! Finished place correcting: ' + str(epi) + '\n')        
-                else:
-                    printandlog("Your scan: " + epi + " Does not match the dimensions of your Parscan parameters!!!")
-                    printandlog("Skipping PLACE correction of: " + epi)
-                    skipped += 1
+            #go through all epis in our list, in worker processes or a pipeline if we were asked to
+            skipped = pc.correctall(final_dset_list, save_dir, jobs = jobs, pipeline = pipeline, stream = stream, follow = follow,
+                                    resume = resume)
 
             time2 = time.time()
 
@@ -461,6 +207,8 @@ def main():
     #check how many arguments are being passed to the PLACE-2.6.py if it is just 1 (the default) start the GUI
     if len(sys.argv) == 1:
 
+        root = tk.Tk()
+
         #function to hide Tkinter console
         def hideTkConsole(root):
             try:
@@ -601,10 +349,24 @@ def main():
     #if the number of arguments passed is != 1 then user entered some arguments
     else:
         parser = argparse.ArgumentParser(description = 'Do PLACE correction')
-        parser.add_argument('-d', '-dset', '--dset', dest = 'dsets', nargs = '+', required = True, help = 'path(s) to .HEAD files (separated by spaces)')
-        parser.add_argument('-p', '-pscan', '--pscan', dest = 'parscan', nargs = 1, required = True, help = 'path to the ParScan file')
-        parser.add_argument('-m', '-dmap', '--dmap', dest = 'dmap', nargs = 1, required = True, help = 'path to the Dmap file')
-        parser.add_argument('-s', '-save', '--save', dest = 'save_path', nargs = '?', help = 'optional save path (default: same as first -dset path)')
+        parser.add_argument('-d', '-dset', '--dset', dest = 'dsets', nargs = '+', help = 'path(s) to .HEAD files (separated by spaces)')
+        parser.add_argument('-submit', '--submit', dest = 'submit_dir', metavar = 'QUEUE_DIR', help = 'instead of correcting the -d scans here, add one job per scan to a queue directory that PLACE workers (python -m afnipyio.place QUEUE_DIR) on any number of hosts work through')
+        parser.add_argument('-w', '-watch', '--watch', dest = 'watch_dir', help = 'instead of -d: watch a directory and correct every scan as soon as it is complete, until interrupted')
+        parser.add_argument('-p', '-pscan', '--pscan', dest = 'parscan', nargs = '+', required = True, help = 'path to the ParScan file (with -watch: one per Dmap)')
+        parser.add_argument('-m', '-dmap', '--dmap', dest = 'dmap', nargs = '+', required = True, help = 'path to the Dmap file (with -watch: several, scans are matched to them by their dimensions)')
+        parser.add_argument('-s', '-save', '--save', dest = 'save_path', nargs = '?', help = 'optional save path (default: same as first -dset path, or the -watch directory)')
+        parser.add_argument('-c', '-cache', '--cache', dest = 'cache_dir', help = 'unwarp matrix cache directory (default: ' + cache_dirname + ' next to the Dmap)')
+        parser.add_argument('-nocache', '--nocache', dest = 'usecache', action = 'store_false', help = 'always rebuild the unwarp matrix, without reading or writing the cache')
+        parser.add_argument('-j', '-jobs', '--jobs', dest = 'jobs', type = int, default = 1, help = 'number of scans corrected in parallel worker processes (default: 1, 0 = one per CPU)')
+        parser.add_argument('-n', '-threads', '--threads', dest = 'threads', type = int, default = 1, help = 'number of threads unwarping slabs of slices of each scan (default: 1, 0 = one per CPU)')
+        parser.add_argument('-t', '-tchunk', '--tchunk', dest = 'tchunk', type = int, default = 32, help = 'number of timepoints unwarped per sparse matrix product (default: 32, 0 = whole run at once)')
+        parser.add_argument('-pipeline', '--pipeline', dest = 'pipeline', type = int, default = 0, metavar = 'DEPTH', help = 'load the next scan and save the previous one while the current one is unwarped, with at most DEPTH scans waiting between stages (default: 0 = off)')
+        parser.add_argument('-precision', '--precision', dest = 'precision', choices = ['float32', 'float64'], default = 'float32', help = 'precision the unwarp is computed in (default: float32, float64 for validation)')
+        parser.add_argument('-rounding', '--rounding', dest = 'rounding', choices = ['nearest', 'truncate'], default = 'nearest', help = 'how unwarped values are converted back to integer scans: round to nearest and clip to the type range, or truncate towards zero like PLACE 2.6 and earlier (default: nearest)')
+        parser.add_argument('-float', '--float', dest = 'floatout', action = 'store_true', help = 'write float32 scans (BRICK_TYPES and BRICK_FLOAT_FACS updated) instead of rounding back to the scan data type')
+        parser.add_argument('-stream', '--stream', dest = 'stream', action = 'store_true', help = 'stream scans from and to disk -t timepoints at a time instead of loading them, memory use no longer depends on the run length')
+        parser.add_argument('-resume', '--resume', dest = 'resume', action = 'store_true', help = 'only redo outputs that are missing, stale or corrupt according to the ' + place.manifest_name + ' in the save directory, instead of skipping every existing output')
+        parser.add_argument('-follow', '--follow', dest = 'follow', action = 'store_true', help = 'scans are still being acquired: correct new sub-bricks as they are appended to each .BRIK (keeping the _pc dataset valid all along) until it stops growing for 10 seconds')
 
         args = parser.parse_args()
 
@@ -618,8 +380,17 @@ def main():
         dmap_good = True
         save_path_good = True
 
+        if bool(args.dsets) == bool(args.watch_dir):
+            parser.error('either -d or -watch is required (but not both)')
+        if args.submit_dir and not args.dsets:
+            parser.error('-submit needs the scans to submit (-d)')
+        if len(args.parscan) != len(args.dmap) or (len(args.dmap) > 1 and not args.watch_dir):
+            parser.error('give one -p ParScan for every -m Dmap (several only with -watch)')
+        if args.pipeline > 0 and (args.stream or args.follow):
+            parser.error('-pipeline overlaps loading and saving whole scans, it can\'t be combined with -stream or -follow')
+
         #Do some rudimentary argument checking to make sure nothing is amiss...
-        for dset_path in args.dsets:
+        for dset_path in args.dsets or []:
             if not os.path.exists(dset_path):
                 print "The dset path you entered: " + str(dset_path) + " does not exist!!"
                 dsets_good = False
@@ -627,24 +398,32 @@ def main():
                 print "The dset path you entered: " + str(dset_path) + " does not end with .HEAD!!"
                 dsets_good = False
 
-        if not os.path.exists(args.parscan[0]):
-            print "The ParScan path you entered: " + str(args.parscan[0]) + " does not exist!!"
-            parscan_good = False
-        if not os.path.basename(args.parscan[0]).startswith("ParScan"):
-            print "The ParScan path you entered: " + str(args.parscan[0]) + " does not appear to point to a ParScan file!!"
-            parscan_good = False
-
-        if not os.path.exists(args.dmap[0]):
-            print "The Dmap path you entered: " + str(args.dmap[0]) + " does not exist!!"
-            dmap_good = False
-        if not os.path.basename(args.dmap[0]).startswith("Dmap"):
-            print "The Dmap path you entered: " + str(args.dmap[0]) + " does not appear to point to a Dmap file!!"
-            dmap_good = False
+        if args.watch_dir and not os.path.isdir(args.watch_dir):
+            print "The watch directory you entered: " + str(args.watch_dir) + " does not exist!!"
+            dsets_good = False
+
+        for parscan_path in args.parscan:
+            if not os.path.exists(parscan_path):
+                print "The ParScan path you entered: " + str(parscan_path) + " does not exist!!"
+                parscan_good = False
+            if not os.path.basename(parscan_path).startswith("ParScan"):
+                print "The ParScan path you entered: " + str(parscan_path) + " does not appear to point to a ParScan file!!"
+                parscan_good = False
+
+        for dmap_path in args.dmap:
+            if not os.path.exists(dmap_path):
+                print "The Dmap path you entered: " + str(dmap_path) + " does not exist!!"
+                dmap_good = False
+            if not os.path.basename(dmap_path).startswith("Dmap"):
+                print "The Dmap path you entered: " + str(dmap_path) + " does not appear to point to a Dmap file!!"
+                dmap_good = False
 
         if args.save_path:
             if not os.path.exists(args.save_path):
                 print "The save path directory you entered: " + str(args.save_path) + " does not exist!!"
                 save_path_good = False
+        elif args.watch_dir:
+            args.save_path = args.watch_dir
         else:
             if os.path.exists(os.path.dirname(args.dsets[0])):
                 print "You did not enter a save directory path, program will default to using: " + str(os.path.dirname(args.dsets[0])) + " as the save path."
@@ -653,8 +432,23 @@ def main():
                 print "Program tried to default to using: " + str(os.path.dirname(args.dsets[0])) + " as the save path but failed!!"
                 save_path_good = False
 
-        if dsets_good and parscan_good and dmap_good and save_path_good:
-            placecor(gui = False, final_dset_list = args.dsets, dmap_path = args.dmap, parscan_path = args.parscan, save_dir = args.save_path)
+        if dsets_good and parscan_good and dmap_good and save_path_good and args.submit_dir:
+            #the -j and -pipeline options are about several scans, there is one per job
+            job_paths = place.submit(args.submit_dir, args.dsets, args.dmap[0], args.parscan[0], args.save_path, split = True,
+                                     precision = args.precision, rounding = args.rounding,
+                                     floatout = args.floatout, tchunk = args.tchunk, threads = args.threads,
+                                     cache_dir = args.cache_dir, usecache = args.usecache, stream = args.stream,
+                                     follow = args.follow, resume = True)
+            print 'Submitted ' + str(len(job_paths)) + ' PLACE jobs to ' + args.submit_dir
+        elif dsets_good and parscan_good and dmap_good and save_path_good and args.watch_dir:
+            #one warm corrector per Dmap/ParScan pair, the watch picks the one matching each scan
+            correctors = [place.corrector(dmap_path, parscan_path, precision = args.precision,
+                                          rounding = args.rounding, floatout = args.floatout, tchunk = args.tchunk,
+                                          threads = args.threads, cache_dir = args.cache_dir, usecache = args.usecache)
+                          for dmap_path, parscan_path in zip(args.dmap, args.parscan)]
+            place.watch(args.watch_dir, correctors, args.save_path, stream = args.stream, follow = args.follow)
+        elif dsets_good and parscan_good and dmap_good and save_path_good:
+            placecor(gui = False, final_dset_list = args.dsets, dmap_path = args.dmap, parscan_path = args.parscan, save_dir = args.save_path, tchunk = args.tchunk, cache_dir = args.cache_dir, usecache = args.usecache, jobs = args.jobs, threads = args.threads, stream = args.stream, pipeline = args.pipeline, precision = args.precision, rounding = args.rounding, floatout = args.floatout, follow = args.follow, resume = args.resume)
 
 if __name__ == "__main__":
     main()
@@ -24,6 +24,13 @@
 # 11/06/12: 1) Added some more self.prime attributes and also alphabetized them
 # 06/04/13: 1) Added a new private method __update_head_names() to the head class. This way if there exist any attribute names that exist in the AFNI header
 #              that my list doesn't cover they will be added on a per need basis.
+# 10/19/26: 1) load() and brik() can be built from an existing head instance and volume array without touching the disk
+#              (i.e. x = load(path, header=some_head, volume=some_array)) so derived representations can be converted back and save()d
+#           2) Added savehead() (the .HEAD writer that save() uses) and a rawhead option to the head class so headers can be
+#              built and written without a .BRIK
+#           3) Added mapbrik() to memory map a .BRIK (in its on-disk byte order) so callers can work through it sub-brick by sub-brick
+#           4) mapbrik() can map a range of sub-bricks (t0 option)
+#           5) Added commonpath() (a path without its .HEAD/.BRIK suffix) so the other afnipyio modules share one definition
 
 # Load AFNI .BRIK and .HEAD information and attributes into variables (.BRIK and .HEAD files must be in same directory for this to work!)
 # usage example: x = load("/My/path/to/afni/head/or/brik/file.BRIK")
@@ -113,11 +120,77 @@ def loadbrik(rawbrik, datatype, byteorder, dimensions, nt):
     volarray = np.reshape(vector, (dimensions[0], dimensions[1], dimensions[2], nt), order = "F")
 
     return volarray
+
+#memory maps a .BRIK as an (x, y, z, t) array in the byte order it has on disk, nothing is read until it is indexed
+#nt defaults to the number of sub-bricks in the header, mode is passed on to np.memmap ('r', 'r+', 'w+')
+#t0 maps sub-bricks t0 ... t0+nt-1 only, so a long run can be worked through without keeping all of it mapped
+def mapbrik(brik_path, dset_head, mode='r', nt=None, t0=0):
+    if dset_head.dtype == "Multiple Types":
+        raise Error("Can't map a .BRIK with multiple BRICK_TYPES")
+
+    if dset_head.byte_order == 'IEEE-LE':
+        datatype = np.dtype(dset_head.dtype).newbyteorder('<')
+    elif dset_head.byte_order == 'IEEE-BE':
+        datatype = np.dtype(dset_head.dtype).newbyteorder('>')
+    else:
+        datatype = np.dtype(dset_head.dtype)
+
+    if nt is None:
+        nt = dset_head.DATASET_RANK[2][1] - t0
+    dimensions = dset_head.DATASET_DIMENSIONS[2]
+    offset = t0*dimensions[0]*dimensions[1]*dimensions[2]*datatype.itemsize
+
+    return np.memmap(brik_path, dtype=datatype, mode=mode, offset=offset,
+                     shape=(dimensions[0], dimensions[1], dimensions[2], nt), order="F")
+
+#strips the .HEAD or .BRIK suffix (if any) from a dataset path
+#unlike the rstrip() that load() uses this never eats into the rest of the name (i.e. "EPI_A+orig.HEAD" -> "EPI_A+orig")
+def commonpath(file_path):
+    if file_path.endswith(".HEAD"):
+        return file_path[:-len(".HEAD")]
+    elif file_path.endswith(".BRIK"):
+        return file_path[:-len(".BRIK")]
+    return file_path
+
+#writes the .HEAD file for a head instance (only UPPERCASE attributes found in dset_head.existing_attributes get saved)
+#save_path should not include the .HEAD extension
+def savehead(dset_head, save_path):
+    f = open(save_path + '.HEAD', 'w')
+
+    for existing_attrib in dset_head.existing_attributes:
+        attrib_val = getattr(dset_head, existing_attrib)
+        val_type = attrib_val[0]
+        val_count = str(attrib_val[1])
+        #write the 'type  = '  line
+        f.write("type  = " + val_type + "\n")
+        #write the 'name  = ' line
+        f.write("name  = " + existing_attrib + "\n")
+        #write the 'count = ' line
+        f.write("count = " + val_count + "\n")
+        #write the actual values for the attribute
+        # if the value type is string, we can just print it
+        if val_type == "string-attribute":
+            f.write(attrib_val[2] + "\n")
+        # otherwise we are going to need to convert the list of ints or floats to a list of space delimited strings
+        else:
+            f.write(' '.join([str(i) for i in attrib_val[2]]) + "\n")
+        #add a newline after each attribute data "block"
+        f.write("\n")         
+    f.close()
         
 # The load class initializes both the head class and brik class.
 class load():
     
-    def __init__(self, file_path=None):
+    def __init__(self, file_path=None, header=None, volume=None):
+        #build an instance out of an existing head instance and volume array (nothing is read from disk)
+        if header is not None:
+            if file_path and (file_path.endswith(".HEAD") or file_path.endswith(".BRIK")):
+                file_path = file_path[:-5]
+            self.path = file_path
+            self.head = header
+            self.brik = brik(str(self.path) + ".BRIK", volume=volume)
+            return
+
         if not file_path:
             root = Tkinter.Tk()
             root.withdraw()
@@ -195,28 +268,7 @@ class load():
             self.head.BYTEORDER_STRING = 'string-attribute', 10, "'" + endianness + "~"
 
         #start writing out the .HEAD file
-        f = open(save_path + '.HEAD', 'w')
-
-        for existing_attrib in self.head.existing_attributes:
-            attrib_val = getattr(self.head, existing_attrib)
-            val_type = attrib_val[0]
-            val_count = str(attrib_val[1])
-            #write the 'type  = '  line
-            f.write("type  = " + val_type + "\n")
-            #write the 'name  = ' line
-            f.write("name  = " + existing_attrib + "\n")
-            #write the 'count = ' line
-            f.write("count = " + val_count + "\n")
-            #write the actual values for the attribute
-            # if the value type is string, we can just print it
-            if val_type == "string-attribute":
-                f.write(attrib_val[2] + "\n")
-            # otherwise we are going to need to convert the list of ints or floats to a list of space delimited strings
-            else:
-                f.write(' '.join([str(i) for i in attrib_val[2]]) + "\n")
-            #add a newline after each attribute data "block"
-            f.write("\n")         
-        f.close()
+        savehead(self.head, save_path)
 
 # Goal of the head class is to be able to get all header attribute information on a per instance basis:
 # i.e. To get the info for spam+orig.HEAD and spam+orig.BRIK one could just call spam = head("/Some/Filepath/spam+orig.HEAD")
@@ -285,7 +337,7 @@ class head:
             return None
                 
     # ===================================== initialize head attributes ========================================
-    def __init__(self, head_path):
+    def __init__(self, head_path, rawhead=None):
         self.path = head_path
 
         #these are the attributes one might typically find in a .HEAD file
@@ -352,14 +404,18 @@ class head:
         #empty list that eventually stores only those attributes that actually exist in the .HEAD file
         self.existing_attributes = []
 
-        if os.path.exists(head_path):
-            try:
-                h = open(head_path, 'r')
-            except:
-                raise Error(".HEAD file could not be opened!!")
+        if rawhead is not None or os.path.exists(head_path):
+            #header lines can also be handed in directly (i.e. when converting from another file format)
+            if rawhead is not None:
+                self.rawhead = list(rawhead)
+            else:
+                try:
+                    h = open(head_path, 'r')
+                except:
+                    raise Error(".HEAD file could not be opened!!")
 
-            self.rawhead = h.readlines()
-            h.close()
+                self.rawhead = h.readlines()
+                h.close()
 
             #if there are any missing attributes then the __update_head_names() method will catch them and add them into prime_attributes list
             self.__update_head_names(self.rawhead)
@@ -451,10 +507,12 @@ class head:
 class brik:
     
     #initialize brik attributes
-    def __init__(self, brik_path):
+    def __init__(self, brik_path, volume=None):
        self.path = brik_path
 
-       if os.path.exists(brik_path):
+       if volume is not None:
+           self.volume = volume
+       elif os.path.exists(brik_path):
            try:
                b = open(brik_path, 'r')
            except:
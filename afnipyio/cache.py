@@ -0,0 +1,150 @@
+#!/usr/bin/env python2.7
+
+# AFNIpyIO dataset cache
+# Opt-in, process-local LRU cache around AFNIPyIO.load()
+# developed and tested on python2.7
+
+# Required modules: numpy, AFNIPyIO
+
+# Pipelines and interactive sessions often call load() on the same reference datasets (masks, templates, base volumes)
+# over and over again, and every call rereads and redecodes the whole .BRIK. The cache class below keeps decoded
+# volumes around up to a configurable byte budget and throws away the least recently used ones when the budget is hit.
+
+# usage example:
+#   from afnipyio import cache
+#   c = cache.cache(max_bytes=2*1024**3)      #2GB budget
+#   mask = c.load("/My/path/to/mask+orig.HEAD")
+#   print c.stats()
+
+# Entries are invalidated whenever the mtime or size of either the .HEAD or the .BRIK changes on disk.
+
+# Every call to cache.load() hands out a *new* instance with its own head (deep copied, so modifying header attributes
+# or calling save() won't touch the cached copy) and its own brik whose volume is a read-only view of the cached array.
+# The view is copy-on-write in the sense that matters: you cannot write into it, but you can always replace it, e.g.
+#   x.brik.volume = x.brik.volume.copy()
+#   x.brik.volume[x.brik.volume < 0] = 0
+# which only affects x. Use c.load(path, copy=True) to get a private writable copy straight away.
+
+import os
+import copy
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from afnipyio import AFNIPyIO as afni
+
+#(mtime, size) stamps of the .HEAD and .BRIK, used to decide if a cached entry is stale
+def filestamp(common_path):
+    stamp = []
+    for ext in (".HEAD", ".BRIK"):
+        try:
+            st = os.stat(common_path + ext)
+        except OSError:
+            raise afni.Error("You've chosen a nonexisting file or a file on a broken path!")
+        stamp.append((st.st_mtime, st.st_size))
+    return tuple(stamp)
+
+class cache:
+
+    def __init__(self, max_bytes=1024**3):
+        self.max_bytes = int(max_bytes)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        #common path --> (stamp, nbytes, load instance) in least to most recently used order
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    #hands out a fresh instance that shares (read only) the cached volume
+    def __checkout(self, cached, copy_volume):
+        dset = copy.copy(cached)
+        dset.head = copy.deepcopy(cached.head)
+        dset.brik = copy.copy(cached.brik)
+
+        if copy_volume:
+            dset.brik.volume = cached.brik.volume.copy()
+        else:
+            dset.brik.volume = cached.brik.volume.view()
+            dset.brik.volume.flags.writeable = False
+        return dset
+
+    def __evict(self, needed):
+        while self.entries and self.current_bytes + needed > self.max_bytes:
+            evicted_path, (stamp, nbytes, dset) = self.entries.popitem(last=False)
+            self.current_bytes -= nbytes
+            self.evictions += 1
+
+    def load(self, file_path, copy=False):
+        path = os.path.abspath(afni.commonpath(file_path))
+        stamp = filestamp(path)
+
+        with self.lock:
+            if path in self.entries:
+                cached_stamp, nbytes, cached = self.entries.pop(path)
+                if cached_stamp == stamp:
+                    #move it to the most recently used end
+                    self.entries[path] = (cached_stamp, nbytes, cached)
+                    self.hits += 1
+                    return self.__checkout(cached, copy)
+
+                #file changed on disk since we cached it
+                self.current_bytes -= nbytes
+                self.invalidations += 1
+            self.misses += 1
+
+        #load outside of the lock so other threads can keep hitting the cache
+        dset = afni.load(path + ".HEAD")
+
+        #files could have been rewritten while we were loading them, in that case don't cache what we got
+        if filestamp(path) != stamp:
+            return dset
+
+        nbytes = dset.brik.volume.nbytes
+        dset.brik.volume.flags.writeable = False
+
+        with self.lock:
+            if path in self.entries:
+                #another thread got here first
+                old_stamp, old_nbytes, old = self.entries.pop(path)
+                self.current_bytes -= old_nbytes
+
+            if nbytes <= self.max_bytes:
+                self.__evict(nbytes)
+                self.entries[path] = (stamp, nbytes, dset)
+                self.current_bytes += nbytes
+
+        return self.__checkout(dset, copy)
+
+    #drop a single dataset (or everything if no path given) from the cache
+    def invalidate(self, file_path=None):
+        with self.lock:
+            if file_path is None:
+                self.entries.clear()
+                self.current_bytes = 0
+            else:
+                path = os.path.abspath(afni.commonpath(file_path))
+                if path in self.entries:
+                    stamp, nbytes, dset = self.entries.pop(path)
+                    self.current_bytes -= nbytes
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': float(self.hits)/lookups if lookups else 0.0,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'entries': len(self.entries),
+                    'current_bytes': self.current_bytes,
+                    'max_bytes': self.max_bytes}
+
+#module level cache for people who just want to swap afni.load(path) for cache.cachedload(path)
+default_cache = cache()
+
+def cachedload(file_path, copy=False):
+    return default_cache.load(file_path, copy=copy)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python2.7
+
+# AFNIpyIO dataset diff
+# Streams .BRIK files in chunks to hash every sub-brick and compare two datasets without loading either of them
+# developed and tested on python2.7
+
+# Required modules: numpy, AFNIPyIO
+
+# Validating pipeline outputs (i.e. PLACE _pc datasets against a reference run) used to mean load()ing both datasets
+# and diffing them in numpy. diffdsets() instead:
+#   1) hashes every sub-brick of both .BRIKs (sha1 of the little-endian values, so byte order doesn't matter), reading
+#      a fixed size chunk at a time. Hashes are cached in a <dataset>.BRIK.sha1 sidecar and reused for as long as the
+#      .BRIK size and mtime don't change
+#   2) compares header attributes (floats with the same tolerance as the data)
+#   3) only for sub-bricks whose hashes differ, streams both sub-bricks through memory maps chunk by chunk and
+#      reports the largest absolute difference and how many values are outside of atol + rtol*|reference|
+# Memory use is set by chunk_bytes, not by the dataset size.
+
+# usage example:
+#   from afnipyio import dsetdiff
+#   report = dsetdiff.diffdsets("/My/run1/EPI_pc+orig.HEAD", "/My/reference/EPI_pc+orig.HEAD", atol=1e-4)
+#   print report['identical']
+#
+# or from the command line:
+#   python -m afnipyio.dsetdiff EPI_pc+orig.HEAD ../reference/EPI_pc+orig.HEAD --atol 1e-4
+# (exit status is 0 if the datasets match, 1 if they don't)
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+
+import numpy as np
+
+from afnipyio import AFNIPyIO as afni
+
+sidecar_ext = '.sha1'
+default_chunk_bytes = 4*1024*1024
+
+#attributes that are expected to differ between otherwise identical datasets
+default_ignore = ['HISTORY_NOTE', 'IDCODE_STRING', 'IDCODE_DATE', 'BYTEORDER_STRING']
+
+#sub-brick by sub-brick flat views of a memory mapped .BRIK
+def subbrickviews(brik_path, dset_head):
+    volume = afni.mapbrik(brik_path, dset_head)
+    return [volume[:, :, :, t].ravel(order="F") for t in range(volume.shape[3])]
+
+#sha1 hex digest of every sub-brick, streamed chunk_bytes at a time
+def hashbrik(brik_path, dset_head, chunk_bytes=default_chunk_bytes):
+    hashes = []
+    for view in subbrickviews(brik_path, dset_head):
+        little = view.dtype.newbyteorder('<')
+        step = max(chunk_bytes // view.dtype.itemsize, 1)
+        sha = hashlib.sha1()
+        for start in range(0, view.size, step):
+            chunk = view[start:start + step]
+            if chunk.dtype != little:
+                chunk = chunk.astype(little)
+            sha.update(np.ascontiguousarray(chunk).data)
+        hashes.append(sha.hexdigest())
+    return hashes
+
+#hashes of every sub-brick of a dataset, from the sidecar if it is still valid, otherwise computed (and cached)
+def hashdset(file_path, chunk_bytes=default_chunk_bytes, use_sidecar=True, dset_head=None):
+    path = afni.commonpath(file_path)
+    brik_path = path + ".BRIK"
+    if dset_head is None:
+        dset_head = afni.head(path + ".HEAD")
+
+    st = os.stat(brik_path)
+    stamp = {'brik_size': st.st_size, 'brik_mtime': st.st_mtime}
+    sidecar_path = brik_path + sidecar_ext
+
+    if use_sidecar and os.path.exists(sidecar_path):
+        try:
+            f = open(sidecar_path, 'r')
+            cached = json.load(f)
+            f.close()
+            if cached['brik_size'] == stamp['brik_size'] and cached['brik_mtime'] == stamp['brik_mtime']:
+                return cached['hashes']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    hashes = hashbrik(brik_path, dset_head, chunk_bytes)
+
+    if use_sidecar:
+        stamp['hashes'] = hashes
+        try:
+            f = open(sidecar_path, 'w')
+            json.dump(stamp, f)
+            f.close()
+        except IOError:
+            #read-only directories are fine, we just don't get to cache
+            pass
+    return hashes
+
+#compares two header attribute tuples, float attributes with tolerance
+def sameattribute(a, b, rtol, atol):
+    if a[0] != b[0] or a[1] != b[1]:
+        return False
+    if a[0] == 'float-attribute':
+        return np.allclose(a[2], b[2], rtol=rtol, atol=atol)
+    return a[2] == b[2]
+
+#streams one pair of sub-bricks and returns (max absolute difference, number of values out of tolerance)
+def comparesubbrick(view_a, view_b, rtol, atol, chunk_bytes=default_chunk_bytes):
+    step = max(chunk_bytes // max(view_a.dtype.itemsize, view_b.dtype.itemsize), 1)
+    maxdiff = 0.0
+    ndiff = 0
+    for start in range(0, view_a.size, step):
+        a = np.asarray(view_a[start:start + step], dtype=np.float64 if view_a.dtype.kind != 'c' else np.complex128)
+        b = np.asarray(view_b[start:start + step], dtype=a.dtype)
+        diff = np.abs(a - b)
+        #NaNs in the same place count as equal, a NaN on just one side is as different as it gets
+        diff[np.isnan(a) & np.isnan(b)] = 0
+        diff[np.isnan(diff)] = np.inf
+        if diff.size:
+            maxdiff = max(maxdiff, float(diff.max()))
+        bad = diff > atol + rtol*np.nan_to_num(np.abs(b))
+        ndiff += int(np.count_nonzero(bad))
+    return maxdiff, ndiff
+
+#compares dataset a against reference dataset b, returns a report dictionary:
+#   identical   - True if headers (minus the ignored attributes) and all sub-bricks match within tolerance
+#   header      - list of (attribute, value in a, value in b) for every attribute that differs (None if missing)
+#   shape       - (shape of a, shape of b)
+#   subbricks   - one dictionary per sub-brick with 'index', 'status' ('identical', 'within tolerance' or 'different'),
+#                 'max_abs_diff' and 'ndiff'
+def diffdsets(path_a, path_b, rtol=0.0, atol=0.0, ignore=default_ignore, chunk_bytes=default_chunk_bytes,
+              use_sidecar=True):
+    path_a = afni.commonpath(path_a)
+    path_b = afni.commonpath(path_b)
+    head_a = afni.head(path_a + ".HEAD")
+    head_b = afni.head(path_b + ".HEAD")
+
+    report = {'a': path_a, 'b': path_b, 'header': [], 'subbricks': []}
+
+    #------------------------ header attributes ------------------------
+    attributes = list(head_a.existing_attributes)
+    attributes += [attrib for attrib in head_b.existing_attributes if attrib not in attributes]
+    for attrib in attributes:
+        if attrib in ignore:
+            continue
+        val_a = getattr(head_a, attrib, None)
+        val_b = getattr(head_b, attrib, None)
+        if val_a is None or val_b is None or not sameattribute(val_a, val_b, rtol, atol):
+            report['header'].append((attrib, val_a, val_b))
+
+    #------------------------ sub-bricks ------------------------
+    shape_a = tuple(head_a.DATASET_DIMENSIONS[2][:3]) + (head_a.DATASET_RANK[2][1],)
+    shape_b = tuple(head_b.DATASET_DIMENSIONS[2][:3]) + (head_b.DATASET_RANK[2][1],)
+    report['shape'] = (shape_a, shape_b)
+
+    if shape_a[:3] != shape_b[:3]:
+        report['identical'] = False
+        return report
+
+    hashes_a = hashdset(path_a, chunk_bytes, use_sidecar, head_a)
+    hashes_b = hashdset(path_b, chunk_bytes, use_sidecar, head_b)
+
+    views_a = views_b = None
+    for t in range(max(shape_a[3], shape_b[3])):
+        entry = {'index': t, 'max_abs_diff': 0.0, 'ndiff': 0}
+        if t >= shape_a[3] or t >= shape_b[3]:
+            entry['status'] = 'different'
+            entry['max_abs_diff'] = None
+            entry['ndiff'] = None
+        elif hashes_a[t] == hashes_b[t] and head_a.dtype == head_b.dtype:
+            entry['status'] = 'identical'
+        else:
+            if views_a is None:
+                views_a = subbrickviews(path_a + ".BRIK", head_a)
+                views_b = subbrickviews(path_b + ".BRIK", head_b)
+            entry['max_abs_diff'], entry['ndiff'] = comparesubbrick(views_a[t], views_b[t], rtol, atol, chunk_bytes)
+            if entry['ndiff'] == 0:
+                entry['status'] = 'within tolerance'
+            else:
+                entry['status'] = 'different'
+        report['subbricks'].append(entry)
+
+    report['identical'] = (not report['header'] and
+                           all(entry['status'] != 'different' for entry in report['subbricks']))
+    return report
+
+def printreport(report):
+    print 'Comparing: ' + report['a']
+    print '  against: ' + report['b']
+
+    if report['header']:
+        print '\nHeader attributes that differ:'
+        for attrib, val_a, val_b in report['header']:
+            print '  ' + attrib + ':'
+            print '    ' + str(val_a[2] if val_a else 'missing')
+            print '    ' + str(val_b[2] if val_b else 'missing')
+
+    shape_a, shape_b = report['shape']
+    if shape_a != shape_b:
+        print '\nDataset shapes differ: ' + str(shape_a) + ' vs ' + str(shape_b)
+
+    different = [entry for entry in report['subbricks'] if entry['status'] != 'identical']
+    if different:
+        print '\nSub-bricks that are not bit identical:'
+        for entry in different:
+            print '  [%d] %s (max abs diff: %s, values out of tolerance: %s)' % (entry['index'], entry['status'],
+                                                                               entry['max_abs_diff'], entry['ndiff'])
+
+    print '\n' + ('Datasets match' if report['identical'] else 'Datasets DIFFER')
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Compare two AFNI datasets sub-brick by sub-brick')
+    parser.add_argument('a', help = 'path to the .HEAD/.BRIK of the dataset to check')
+    parser.add_argument('b', help = 'path to the .HEAD/.BRIK of the reference dataset')
+    parser.add_argument('--rtol', type = float, default = 0.0, help = 'relative tolerance for float values (default: 0)')
+    parser.add_argument('--atol', type = float, default = 0.0, help = 'absolute tolerance for float values (default: 0)')
+    parser.add_argument('--ignore', nargs = '*', default = default_ignore, help = 'header attributes not to compare (default: ' + ' '.join(default_ignore) + ')')
+    parser.add_argument('--chunk-mb', type = float, default = default_chunk_bytes/1024.0**2, help = 'read chunk size in MB (default: 4)')
+    parser.add_argument('--no-sidecar', action = 'store_true', help = 'do not read or write .BRIK' + sidecar_ext + ' hash sidecars')
+
+    args = parser.parse_args()
+
+    report = diffdsets(args.a, args.b, rtol = args.rtol, atol = args.atol, ignore = args.ignore,
+                       chunk_bytes = int(args.chunk_mb*1024**2), use_sidecar = not args.no_sidecar)
+    printreport(report)
+    sys.exit(0 if report['identical'] else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python2.7
+
+# AFNIpyIO masked datasets
+# Mask-compressed in-memory representation of a dataset plus a compact on-disk cache format for it
+# developed and tested on python2.7
+
+# Required modules: numpy, AFNIPyIO
+
+# Most voxels in an EPI grid are outside the brain, but brik.volume (and the .BRIK) always hold the full box.
+# A masked instance only keeps the in-mask voxels:
+#
+#   x.index  - flat (Fortran order, same as the .BRIK) indices of the in-mask voxels
+#   x.data   - (in-mask voxels x time) array, one row per voxel so time series are contiguous. These are the values
+#              as stored in the .BRIK, x.values() applies the BRICK_FLOAT_FACS (if any) and gives float32
+#   x.shape  - (x, y, z, t) shape of the full volume
+#   x.head   - head instance of the source dataset
+#
+# usage example:
+#   from afnipyio import masked
+#   m = masked.masked("/My/path/to/EPI+orig.HEAD", "/My/path/to/mask+orig.HEAD")   #only in-mask data is ever held in memory
+#   gs = m.globalmean()                      #global signal
+#   psc = m.percentchange()                  #percent signal change, still masked
+#   psc.toload().save("/My/path/to/EPI_psc+orig")
+#
+#   m.savecache("/My/path/to/EPI+orig.masked")
+#   m2 = masked.loadmasked("/My/path/to/EPI+orig.masked")   #memory maps just the in-mask data
+#
+# The operations below work on the scaled values, so their results carry no BRICK_FLOAT_FACS. toload() of an
+# unmodified instance keeps the original factors next to the stored (i.e. scaled int16) data.
+#
+# The mask can be a boolean/numeric (x, y, z) array, a load instance or a path to a mask dataset (nonzero voxels of
+# its first sub-brick are in the mask).
+
+# .masked cache file layout:
+#   8 bytes   magic 'AFNIMSK1'
+#   8 bytes   little-endian uint64 length of the pickled info dict (head, shape, dtypes, offsets)
+#   pickled info dict
+#   zero padding up to a 64 byte boundary, then the index array, padding again, then the (voxels x time) data array
+
+import copy
+import struct
+import cPickle as pickle
+
+import numpy as np
+
+from afnipyio import AFNIPyIO as afni
+
+magic = 'AFNIMSK1'
+alignment = 64
+
+#copy of a head without BRICK_FLOAT_FACS, for data that is already in real units
+def unscaledhead(dset_head):
+    dset_head = copy.deepcopy(dset_head)
+    if hasattr(dset_head, 'BRICK_FLOAT_FACS'):
+        delattr(dset_head, 'BRICK_FLOAT_FACS')
+        dset_head.existing_attributes = [attrib for attrib in dset_head.existing_attributes
+                                         if attrib != 'BRICK_FLOAT_FACS']
+    return dset_head
+
+#turn whatever was passed in as a mask into a 3D boolean array
+def makemask(mask):
+    if isinstance(mask, basestring):
+        path = afni.commonpath(mask)
+        mask_head = afni.head(path + ".HEAD")
+        mask = afni.mapbrik(path + ".BRIK", mask_head)[:, :, :, 0]
+    elif hasattr(mask, 'brik'):
+        mask = mask.brik.volume
+        if mask.ndim == 4:
+            mask = mask[:, :, :, 0]
+    return np.asarray(mask) != 0
+
+class masked:
+
+    #dset is a load instance or a path to a .HEAD/.BRIK. When it's a path the .BRIK is memory mapped and read one
+    #sub-brick at a time so the full volume is never held in memory
+    def __init__(self, dset=None, mask=None, index=None, data=None, shape=None, header=None, path=None):
+        #building directly out of the pieces (used by the operations below and by loadmasked())
+        if dset is None:
+            self.index = index
+            self.data = data
+            self.shape = tuple(shape)
+            self.head = header
+            self.path = path
+            return
+
+        mask = makemask(mask)
+
+        if isinstance(dset, basestring):
+            self.path = afni.commonpath(dset)
+            self.head = afni.head(self.path + ".HEAD")
+            volume = afni.mapbrik(self.path + ".BRIK", self.head)
+            datatype = np.dtype(self.head.dtype)
+        else:
+            self.path = dset.path
+            self.head = copy.deepcopy(dset.head)
+            volume = dset.brik.volume
+            datatype = volume.dtype
+
+        self.shape = tuple(volume.shape)
+        if mask.shape != self.shape[:3]:
+            raise afni.Error("Mask dimensions " + str(mask.shape) + " do not match dataset dimensions " + str(self.shape[:3]))
+
+        flatmask = mask.ravel(order="F")
+        if flatmask.size < 2**31:
+            self.index = np.flatnonzero(flatmask).astype(np.int32)
+        else:
+            self.index = np.flatnonzero(flatmask)
+
+        self.data = np.empty((self.index.size, self.shape[3]), dtype=datatype)
+        for t in range(self.shape[3]):
+            #np.take on the raveled sub-brick: one sub-brick worth of memory at most
+            self.data[:, t] = np.take(volume[:, :, :, t].ravel(order="F"), self.index)
+
+    #new masked instance sharing everything but the data with this one (data is in real units, so no scale factors)
+    def __derive(self, data):
+        return masked(index=self.index, data=data, shape=self.shape[:3] + (data.shape[1],),
+                      header=unscaledhead(self.head), path=self.path)
+
+    #per sub-brick BRICK_FLOAT_FACS (0 means unscaled, so 1), None if no sub-brick is scaled
+    def scales(self):
+        facs = getattr(self.head, 'BRICK_FLOAT_FACS', None)
+        if facs is None:
+            return None
+        facs = np.array(facs[2][:self.shape[3]], dtype=np.float32)
+        if not facs.any():
+            return None
+        facs[facs == 0] = 1
+        return facs
+
+    #x.data with the scale factors applied, as float32 (x.data itself if nothing is scaled)
+    def values(self):
+        facs = self.scales()
+        if facs is None:
+            return self.data
+        data = self.data.astype(np.float32)
+        data *= facs
+        return data
+
+    def mask(self):
+        flatmask = np.zeros(self.shape[0]*self.shape[1]*self.shape[2], dtype=bool)
+        flatmask[self.index] = True
+        return flatmask.reshape(self.shape[:3], order="F")
+
+    #row of x.data that holds voxel (i, j, k), or None if the voxel is outside of the mask
+    def row(self, i, j, k):
+        flat = i + self.shape[0]*(j + self.shape[1]*k)
+        pos = np.searchsorted(self.index, flat)
+        if pos < self.index.size and self.index[pos] == flat:
+            return pos
+        return None
+
+    def timeseries(self, i, j, k):
+        pos = self.row(i, j, k)
+        if pos is None:
+            return np.zeros(self.shape[3], dtype=self.data.dtype)
+        return np.asarray(self.data[pos])
+
+    #full (x, y, z) volume of sub-brick t, fill value outside of the mask
+    def subbrick(self, t, fill=0):
+        vol = np.empty(self.shape[0]*self.shape[1]*self.shape[2], dtype=self.data.dtype)
+        vol.fill(fill)
+        vol[self.index] = self.data[:, t]
+        return vol.reshape(self.shape[:3], order="F")
+
+    #-------------------- common operations (results stay masked) --------------------
+
+    #temporal mean/std of every in-mask voxel as a single sub-brick
+    def mean(self):
+        return self.__derive(self.values().mean(axis=1, dtype=np.float64).astype(np.float32)[:, np.newaxis])
+
+    def std(self):
+        return self.__derive(self.values().std(axis=1, dtype=np.float64).astype(np.float32)[:, np.newaxis])
+
+    #mean over all in-mask voxels for every time point (i.e. the global signal)
+    def globalmean(self):
+        gm = self.data.mean(axis=0, dtype=np.float64)
+        facs = self.scales()
+        if facs is not None:
+            gm *= facs
+        return gm
+
+    #remove every voxel's temporal mean
+    def demean(self):
+        data = self.values().astype(np.float32)
+        data -= data.mean(axis=1)[:, np.newaxis]
+        return self.__derive(data)
+
+    #express every voxel's time series as percent change from its temporal mean (zero mean voxels are left at 0)
+    def percentchange(self):
+        data = self.values().astype(np.float32)
+        baseline = data.mean(axis=1)[:, np.newaxis]
+        nonzero = (baseline != 0).ravel()
+        data[nonzero] = 100.0*(data[nonzero]/baseline[nonzero] - 1.0)
+        data[~nonzero] = 0
+        return self.__derive(data)
+
+    #apply any function that maps the (voxels x time) array of values to a new (voxels x something) array
+    def apply(self, func):
+        data = np.asarray(func(self.values()))
+        if data.ndim == 1:
+            data = data[:, np.newaxis]
+        return self.__derive(data)
+
+    #-------------------- conversions --------------------
+
+    #back to a full load instance (with zeros outside of the mask) that can be save()d
+    def toload(self, fill=0):
+        volume = np.empty(self.shape, dtype=self.data.dtype, order="F")
+        for t in range(self.shape[3]):
+            volume[:, :, :, t] = self.subbrick(t, fill)
+
+        header = copy.deepcopy(self.head)
+        header.DATASET_RANK = (header.DATASET_RANK[0], header.DATASET_RANK[1],
+                               [header.DATASET_RANK[2][0], self.shape[3]] + list(header.DATASET_RANK[2][2:]))
+
+        brick_types = {np.dtype('uint8'): 0, np.dtype('int16'): 1, np.dtype('float32'): 3, np.dtype('complex128'): 5}
+        if volume.dtype not in brick_types:
+            raise afni.Error("Can't convert a masked dataset of type " + str(volume.dtype) + " back to AFNI")
+        header.dtype = str(volume.dtype)
+        header.BRICK_TYPES = ('integer-attribute', self.shape[3], [brick_types[volume.dtype]]*self.shape[3])
+
+        #per sub-brick attributes no longer apply if the number of sub-bricks changed (i.e. after mean())
+        if self.shape[3] != self.head.DATASET_RANK[2][1]:
+            for attrib in ('BRICK_FLOAT_FACS', 'BRICK_STATS', 'BRICK_LABS', 'BRICK_KEYWORDS', 'BRICK_STATAUX',
+                           'BRICK_STATSYM', 'TAXIS_NUMS', 'TAXIS_FLOATS', 'TAXIS_OFFSETS'):
+                if hasattr(header, attrib):
+                    delattr(header, attrib)
+            header.existing_attributes = [attrib for attrib in header.existing_attributes if hasattr(header, attrib)]
+
+        return afni.load(self.path, header=header, volume=volume)
+
+    #write the compact .masked cache file
+    def savecache(self, cache_path=None):
+        if not cache_path:
+            cache_path = self.path + ".masked"
+
+        index = np.ascontiguousarray(self.index, dtype=self.index.dtype.newbyteorder('<'))
+        data = np.ascontiguousarray(self.data, dtype=self.data.dtype.newbyteorder('<'))
+
+        info = {'head': self.head, 'shape': self.shape, 'path': self.path,
+                'index_dtype': index.dtype.str, 'data_dtype': data.dtype.str,
+                'nvox': index.size, 'nt': data.shape[1]}
+
+        #offsets depend on the length of the pickle which depends on the offsets, so pickle twice with worst case offsets
+        info['index_offset'] = info['data_offset'] = 2**62
+        blob = pickle.dumps(info, 2)
+        info['index_offset'] = -(-(16 + len(blob)) // alignment)*alignment
+        info['data_offset'] = -(-(info['index_offset'] + index.nbytes) // alignment)*alignment
+        blob = pickle.dumps(info, 2)
+
+        f = open(cache_path, 'wb')
+        f.write(magic)
+        f.write(struct.pack('<Q', len(blob)))
+        f.write(blob)
+        f.write('\0'*(info['index_offset'] - f.tell()))
+        index.tofile(f)
+        f.write('\0'*(info['data_offset'] - f.tell()))
+        data.tofile(f)
+        f.close()
+        return cache_path
+
+#read a .masked cache file. With mmap=True (default) the index and data arrays are memory mapped so only the in-mask
+#voxels you actually touch get read from disk
+def loadmasked(cache_path, mmap=True):
+    f = open(cache_path, 'rb')
+    if f.read(len(magic)) != magic:
+        f.close()
+        raise afni.Error(cache_path + " is not an AFNIpyIO .masked cache file!")
+    bloblen = struct.unpack('<Q', f.read(8))[0]
+    info = pickle.loads(f.read(bloblen))
+
+    index_dtype = np.dtype(info['index_dtype'])
+    data_dtype = np.dtype(info['data_dtype'])
+    if mmap:
+        f.close()
+        index = np.memmap(cache_path, dtype=index_dtype, mode='r', offset=info['index_offset'], shape=(info['nvox'],))
+        data = np.memmap(cache_path, dtype=data_dtype, mode='r', offset=info['data_offset'],
+                         shape=(info['nvox'], info['nt']))
+    else:
+        f.seek(info['index_offset'])
+        index = np.fromfile(f, dtype=index_dtype, count=info['nvox'])
+        f.seek(info['data_offset'])
+        data = np.fromfile(f, dtype=data_dtype, count=info['nvox']*info['nt']).reshape(info['nvox'], info['nt'])
+        f.close()
+
+    return masked(index=index, data=data, shape=info['shape'], header=info['head'], path=info['path'])
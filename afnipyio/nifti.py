@@ -0,0 +1,575 @@
+#!/usr/bin/env python2.7
+
+# AFNIpyIO NIfTI-1
+# Read and write NIfTI-1 (.nii and .nii.gz) files on top of the AFNIPyIO load/head model
+# developed and tested on python2.7
+
+# Required modules: numpy, AFNIPyIO
+
+# Downstream tools need NIfTI, and converting through an external program means rereading the whole .BRIK.
+# NIfTI stores voxels x fastest, then y, z and t, which is exactly the .BRIK layout, so conversion is a straight
+# copy of the data:
+#
+#   afni2nifti("/My/path/EPI+orig.HEAD", "/My/path/EPI.nii.gz")    #the .BRIK is streamed, never fully loaded
+#   nifti2afni("/My/path/EPI.nii", "/My/path/EPI+orig")           #same thing the other way around
+#
+#   x = loadnifti("/My/path/EPI.nii")     #a regular load instance, brik.volume is memory mapped for native .nii files
+#   x.save("/My/path/EPI+orig")           #so everything that works on load instances works on it
+#   savenifti(x, "/My/path/EPI_copy.nii") #written one sub-brick at a time
+#
+# Geometry: AFNI's IJK_TO_DICOM_REAL maps voxel indices to DICOM (RAI) coordinates, NIfTI's sform/qform map them to
+# RAS coordinates, so the two differ by a sign flip of x and y. Both the sform and the qform get written (the qform is
+# the closest rigid rotation + voxel sizes of the same matrix). When reading, the sform is preferred over the qform.
+# If a dataset has no IJK_TO_DICOM_REAL the matrix is put together from ORIENT_SPECIFIC, ORIGIN and DELTA.
+# python -m afnipyio.nifti converts a dataset in every orientation to NIfTI and back and checks the geometry survives.
+
+# NOTE: like load(), brik.volume holds the stored values, scaling factors are not applied. A NIfTI scl_slope becomes
+#       BRICK_FLOAT_FACS and uniform BRICK_FLOAT_FACS become scl_slope. AFNI has no intercept, so a NIfTI file with a
+#       nonzero scl_inter is read as float32 with the slope and intercept applied (and no BRICK_FLOAT_FACS). NIfTI has
+#       a single slope, so a dataset whose BRICK_FLOAT_FACS differ between sub-bricks is written as float32 with the
+#       factors applied.
+
+import os
+import sys
+import gzip
+import shutil
+import struct
+import tempfile
+import itertools
+
+import numpy as np
+
+from afnipyio import AFNIPyIO as afni
+
+header_size = 348
+vox_offset = 352
+copy_chunk_bytes = 4*1024*1024
+
+#field names/struct codes of the 348 byte nifti_1_header, in order
+header_fields = [('sizeof_hdr', 'i'), ('data_type', '10s'), ('db_name', '18s'), ('extents', 'i'),
+                 ('session_error', 'h'), ('regular', 'c'), ('dim_info', 'B'), ('dim', '8h'),
+                 ('intent_p1', 'f'), ('intent_p2', 'f'), ('intent_p3', 'f'), ('intent_code', 'h'),
+                 ('datatype', 'h'), ('bitpix', 'h'), ('slice_start', 'h'), ('pixdim', '8f'),
+                 ('vox_offset', 'f'), ('scl_slope', 'f'), ('scl_inter', 'f'), ('slice_end', 'h'),
+                 ('slice_code', 'B'), ('xyzt_units', 'B'), ('cal_max', 'f'), ('cal_min', 'f'),
+                 ('slice_duration', 'f'), ('toffset', 'f'), ('glmax', 'i'), ('glmin', 'i'),
+                 ('descrip', '80s'), ('aux_file', '24s'), ('qform_code', 'h'), ('sform_code', 'h'),
+                 ('quatern_b', 'f'), ('quatern_c', 'f'), ('quatern_d', 'f'), ('qoffset_x', 'f'),
+                 ('qoffset_y', 'f'), ('qoffset_z', 'f'), ('srow_x', '4f'), ('srow_y', '4f'), ('srow_z', '4f'),
+                 ('intent_name', '16s'), ('magic', '4s')]
+header_format = ''.join(code for name, code in header_fields)
+
+#NIfTI datatype code --> numpy dtype
+nifti_dtypes = {2: 'uint8', 4: 'int16', 8: 'int32', 16: 'float32', 32: 'complex64', 64: 'float64',
+                256: 'int8', 512: 'uint16', 768: 'uint32', 1024: 'int64', 1280: 'uint64', 1792: 'complex128'}
+nifti_codes = dict((np.dtype(dtype), code) for code, dtype in nifti_dtypes.items())
+
+#numpy dtype --> AFNI BRICK_TYPES code (same mapping as AFNIPyIO.head uses when reading)
+afni_codes = {np.dtype('uint8'): 0, np.dtype('int16'): 1, np.dtype('float32'): 3, np.dtype('complex128'): 5}
+
+#AFNI can't store every NIfTI type, these get converted when importing
+afni_conversions = {np.dtype('int8'): 'int16', np.dtype('uint16'): 'float32', np.dtype('int32'): 'float32',
+                    np.dtype('uint32'): 'float32', np.dtype('int64'): 'float32', np.dtype('uint64'): 'float32',
+                    np.dtype('float64'): 'float32', np.dtype('complex64'): 'complex128'}
+
+#SCENE_DATA view code (+orig, +acpc, +tlrc) <--> NIfTI xform codes (scanner, aligned, talairach)
+view_names = ['orig', 'acpc', 'tlrc']
+view_xform_codes = [1, 2, 3]
+
+def niftiprefix(nii_path):
+    for ext in ('.nii.gz', '.nii'):
+        if nii_path.endswith(ext):
+            return nii_path[:-len(ext)]
+    return nii_path
+
+def openfile(path, mode, compresslevel=6):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, compresslevel)
+    return open(path, mode)
+
+#copies nbytes from one file object to another in fixed size chunks
+def copybytes(src, dst, nbytes):
+    while nbytes > 0:
+        chunk = src.read(min(copy_chunk_bytes, nbytes))
+        if not chunk:
+            raise afni.Error("File ended before all of the data could be copied!")
+        dst.write(chunk)
+        nbytes -= len(chunk)
+
+#========================= geometry =========================
+
+#ORIENT_SPECIFIC codes of an axis along DICOM x, y and z, as (positive step, negative step). DICOM x runs from right to
+#left (R2L = 0, L2R = 1), y from anterior to posterior (A2P = 3, P2A = 2) and z from inferior to superior (I2S = 4, S2I = 5)
+orient_codes = [(0, 1), (3, 2), (4, 5)]
+
+#3x4 ijk --> DICOM matrix of an AFNI head instance
+def ijktodicom(dset_head):
+    if hasattr(dset_head, 'IJK_TO_DICOM_REAL'):
+        return np.array(dset_head.IJK_TO_DICOM_REAL[2], dtype=np.float64).reshape(3, 4)
+
+    matrix = np.zeros((3, 4))
+    for axis, code in enumerate(dset_head.ORIENT_SPECIFIC[2]):
+        #RL/LR --> x, PA/AP --> y, IS/SI --> z. The sign of DELTA already says which way the axis runs
+        matrix[code // 2, axis] = dset_head.DELTA[2][axis]
+        matrix[code // 2, 3] = dset_head.ORIGIN[2][axis]
+    return matrix
+
+#closest rotation to a 3x3 matrix with unit columns --> (quatern_b, quatern_c, quatern_d, qfac)
+#follows nifti_mat44_to_quatern() from nifti1_io.c
+def quaternfrommatrix(rotation):
+    u, s, vt = np.linalg.svd(rotation)
+    r = np.dot(u, vt)
+    qfac = 1.0
+    if np.linalg.det(r) < 0:
+        r[:, 2] = -r[:, 2]
+        qfac = -1.0
+
+    a = r[0, 0] + r[1, 1] + r[2, 2] + 1.0
+    if a > 0.5:
+        a = 0.5*np.sqrt(a)
+        b = 0.25*(r[2, 1] - r[1, 2])/a
+        c = 0.25*(r[0, 2] - r[2, 0])/a
+        d = 0.25*(r[1, 0] - r[0, 1])/a
+    else:
+        xd = 1.0 + r[0, 0] - (r[1, 1] + r[2, 2])
+        yd = 1.0 + r[1, 1] - (r[0, 0] + r[2, 2])
+        zd = 1.0 + r[2, 2] - (r[0, 0] + r[1, 1])
+        if xd > 1.0:
+            b = 0.5*np.sqrt(xd)
+            c = 0.25*(r[0, 1] + r[1, 0])/b
+            d = 0.25*(r[0, 2] + r[2, 0])/b
+            a = 0.25*(r[2, 1] - r[1, 2])/b
+        elif yd > 1.0:
+            c = 0.5*np.sqrt(yd)
+            b = 0.25*(r[0, 1] + r[1, 0])/c
+            d = 0.25*(r[1, 2] + r[2, 1])/c
+            a = 0.25*(r[0, 2] - r[2, 0])/c
+        else:
+            d = 0.5*np.sqrt(zd)
+            b = 0.25*(r[0, 2] + r[2, 0])/d
+            c = 0.25*(r[1, 2] + r[2, 1])/d
+            a = 0.25*(r[1, 0] - r[0, 1])/d
+        if a < 0.0:
+            b, c, d = -b, -c, -d
+    return b, c, d, qfac
+
+#3x4 ijk --> RAS matrix out of a parsed NIfTI header (sform if there is one, else qform, else just voxel sizes)
+def niftimatrix(hdr):
+    pixdim = hdr['pixdim']
+    if hdr['sform_code'] > 0:
+        return np.array([hdr['srow_x'], hdr['srow_y'], hdr['srow_z']], dtype=np.float64)
+
+    if hdr['qform_code'] > 0:
+        b, c, d = hdr['quatern_b'], hdr['quatern_c'], hdr['quatern_d']
+        a = np.sqrt(max(0.0, 1.0 - (b*b + c*c + d*d)))
+        rotation = np.array([[a*a + b*b - c*c - d*d, 2*(b*c - a*d), 2*(b*d + a*c)],
+                             [2*(b*c + a*d), a*a + c*c - b*b - d*d, 2*(c*d - a*b)],
+                             [2*(b*d - a*c), 2*(c*d + a*b), a*a + d*d - c*c - b*b]])
+        qfac = -1.0 if pixdim[0] < 0 else 1.0
+        matrix = np.zeros((3, 4))
+        matrix[:, :3] = rotation*np.array([pixdim[1], pixdim[2], qfac*pixdim[3]])
+        matrix[:, 3] = [hdr['qoffset_x'], hdr['qoffset_y'], hdr['qoffset_z']]
+        return matrix
+
+    matrix = np.zeros((3, 4))
+    matrix[0, 0], matrix[1, 1], matrix[2, 2] = [p if p > 0 else 1.0 for p in pixdim[1:4]]
+    return matrix
+
+#========================= scaling =========================
+
+#(scl_slope, scl_inter) of a parsed NIfTI header, (1.0, 0.0) for unscaled data (a scl_slope of 0 or one that
+#isn't finite means no scaling, the intercept is ignored then)
+def niftiscaling(hdr):
+    slope = hdr['scl_slope']
+    inter = hdr['scl_inter']
+    if slope == 0.0 or not np.isfinite(slope):
+        return 1.0, 0.0
+    if not np.isfinite(inter):
+        inter = 0.0
+    return float(slope), float(inter)
+
+#(scl_slope, factors) to write a dataset with. Uniform BRICK_FLOAT_FACS become scl_slope (0.0 when unscaled) and
+#factors is None. Factors that differ between sub-bricks come back as an array (0 --> 1) with a scl_slope of 0.0,
+#they have to be applied to the data, which is then written as float32
+def afniscaling(dset_head, nt):
+    if not hasattr(dset_head, 'BRICK_FLOAT_FACS'):
+        return 0.0, None
+    facs = np.array(dset_head.BRICK_FLOAT_FACS[2][:nt], dtype=np.float64)
+    facs[facs == 0.0] = 1.0
+    if (facs == facs[0]).all():
+        return (float(facs[0]) if facs[0] != 1.0 else 0.0), None
+    return 0.0, facs
+
+#the dtype a dataset with scale factors applied is written/stored as
+def scaleddtype(dtype):
+    if np.dtype(dtype).kind == 'c':
+        return np.dtype('complex128')
+    return np.dtype('float32')
+
+#========================= reading =========================
+
+#parses the 348 byte header of a .nii/.nii.gz file into a dictionary (plus 'endian' and 'dims' entries)
+def readheader(nii_path):
+    f = openfile(nii_path, 'rb')
+    raw = f.read(header_size)
+    f.close()
+    if len(raw) != header_size:
+        raise afni.Error(nii_path + " is too short to be a NIfTI-1 file!")
+
+    for endian in ('<', '>'):
+        if struct.unpack(endian + 'i', raw[:4])[0] == header_size:
+            break
+    else:
+        raise afni.Error(nii_path + " is not a NIfTI-1 file (bad sizeof_hdr)!")
+
+    values = list(struct.unpack(endian + header_format, raw))
+    hdr = {'endian': endian}
+    for name, code in header_fields:
+        count = int(code[:-1]) if code[:-1] and code[-1] != 's' else 1
+        if count > 1:
+            hdr[name] = list(values[:count])
+            del values[:count]
+        else:
+            hdr[name] = values.pop(0)
+
+    if hdr['magic'] not in ('n+1\0', 'ni1\0'):
+        raise afni.Error(nii_path + " is not a NIfTI-1 file (bad magic)!")
+    if hdr['magic'] == 'ni1\0':
+        raise afni.Error(nii_path + " is a two file (.hdr/.img) NIfTI dataset, only single .nii files are supported!")
+    if hdr['datatype'] not in nifti_dtypes:
+        raise afni.Error("Unsupported NIfTI datatype " + str(hdr['datatype']) + " in " + nii_path)
+
+    #anything past the 4th dimension is folded into the sub-brick count
+    ndim = hdr['dim'][0]
+    dims = [max(d, 1) for d in hdr['dim'][1:ndim + 1]] + [1]*(7 - ndim)
+    hdr['dims'] = (dims[0], dims[1], dims[2], int(np.prod(dims[3:])))
+    hdr['dtype'] = np.dtype(nifti_dtypes[hdr['datatype']]).newbyteorder(endian)
+    return hdr
+
+#builds the rawhead lines of an AFNI .HEAD that describes a NIfTI file
+def afnihead(hdr, dtype, byteorder, note=None):
+    nx, ny, nz, nt = hdr['dims']
+
+    #RAS --> DICOM
+    matrix = niftimatrix(hdr)*np.array([[-1.0], [-1.0], [1.0]])
+
+    orient = []
+    origin = []
+    delta = []
+    for axis in range(3):
+        closest = int(np.argmax(np.abs(matrix[:, axis])))
+        step = matrix[closest, axis]
+        orient.append(orient_codes[closest][0 if step > 0 else 1])
+        origin.append(matrix[closest, 3])
+        delta.append(step)
+
+    xform_code = hdr['sform_code'] if hdr['sform_code'] > 0 else hdr['qform_code']
+    view = view_xform_codes.index(xform_code) if xform_code in view_xform_codes else 0
+
+    #an intercept means the data is converted to float32 with the scaling applied (see storeddtype())
+    slope, inter = niftiscaling(hdr)
+    if slope == 1.0 or inter != 0.0:
+        slope = 0.0
+
+    attributes = [('string-attribute', 'TYPESTRING', '3DIM_HEAD_ANAT'),
+                  ('integer-attribute', 'SCENE_DATA', [view, 2 if nt > 1 else 0, 0]),
+                  ('integer-attribute', 'ORIENT_SPECIFIC', orient),
+                  ('float-attribute', 'ORIGIN', origin),
+                  ('float-attribute', 'DELTA', delta),
+                  ('float-attribute', 'IJK_TO_DICOM_REAL', list(matrix.ravel())),
+                  ('integer-attribute', 'DATASET_RANK', [3, nt, 0, 0, 0, 0, 0, 0]),
+                  ('integer-attribute', 'DATASET_DIMENSIONS', [nx, ny, nz, 0, 0]),
+                  ('integer-attribute', 'BRICK_TYPES', [afni_codes[np.dtype(dtype)]]*nt),
+                  ('float-attribute', 'BRICK_FLOAT_FACS', [float(slope)]*nt),
+                  ('string-attribute', 'BYTEORDER_STRING', byteorder)]
+
+    #pixdim[4] is the TR, xyzt_units says whether it's in ms (16) or s (8)
+    if nt > 1 and hdr['pixdim'][4] > 0:
+        units = 77001 if (hdr['xyzt_units'] & 0x38) == 16 else 77002
+        attributes.append(('integer-attribute', 'TAXIS_NUMS', [nt, 0, units]))
+        attributes.append(('float-attribute', 'TAXIS_FLOATS', [0.0, float(hdr['pixdim'][4]), 0.0, 0.0, 0.0]))
+
+    if note:
+        attributes.append(('string-attribute', 'HISTORY_NOTE', note))
+
+    return headlines(attributes)
+
+#(type, name, value) attributes --> rawhead lines
+def headlines(attributes):
+    lines = []
+    for val_type, name, value in attributes:
+        if val_type == 'string-attribute':
+            value = "'" + value + "~"
+            count = len(value) - 1
+            value_str = value
+        else:
+            count = len(value)
+            value_str = ' '.join(str(v) for v in value)
+        lines += ['\n', 'type = ' + val_type + '\n', 'name = ' + name + '\n', 'count = ' + str(count) + '\n',
+                  value_str + '\n']
+    return lines
+
+#the AFNI dtype a NIfTI dtype is stored as
+def afnidtype(dtype):
+    native = np.dtype(dtype).newbyteorder('=')
+    return np.dtype(afni_conversions.get(native, native))
+
+#the AFNI dtype the data of a parsed NIfTI header is stored as. With a nonzero scl_inter that is float32 (complex128
+#for complex data) holding slope*value + intercept, since AFNI can't store an intercept
+def storeddtype(hdr):
+    if niftiscaling(hdr)[1] != 0.0:
+        return scaleddtype(hdr['dtype'])
+    return afnidtype(hdr['dtype'])
+
+#one sub-brick as read from a NIfTI file --> dtype, with slope and intercept applied if storeddtype() asked for that
+def convertsubbrick(subbrick, hdr, dtype):
+    slope, inter = niftiscaling(hdr)
+    if inter != 0.0:
+        return (subbrick*slope + inter).astype(dtype)
+    return subbrick.astype(dtype)
+
+#loads a .nii/.nii.gz into an AFNIPyIO load instance
+#uncompressed native byte order files with an AFNI compatible datatype are memory mapped (read only) when mmap=True,
+#everything else is read one sub-brick at a time into memory
+def loadnifti(nii_path, mmap=True):
+    if not os.path.exists(nii_path):
+        raise afni.Error("You've chosen a nonexisting file or a file on a broken path!")
+
+    hdr = readheader(nii_path)
+    shape = hdr['dims']
+    filedtype = hdr['dtype']
+    dtype = storeddtype(hdr)
+
+    byteorder = 'LSB_FIRST' if sys.byteorder == 'little' else 'MSB_FIRST'
+    path = niftiprefix(nii_path)
+    lines = afnihead(hdr, dtype, byteorder, note='Loaded from ' + os.path.basename(nii_path) + ' by AFNIpyIO')
+    xform_code = hdr['sform_code'] if hdr['sform_code'] > 0 else hdr['qform_code']
+    if xform_code in view_xform_codes:
+        path += '+' + view_names[view_xform_codes.index(xform_code)]
+    else:
+        path += '+orig'
+
+    dset_head = afni.head(path + '.HEAD', rawhead=lines)
+
+    offset = int(hdr['vox_offset'])
+    plaincopy = filedtype == dtype and niftiscaling(hdr)[1] == 0.0
+    if mmap and not nii_path.endswith('.gz') and plaincopy and filedtype.isnative:
+        volume = np.memmap(nii_path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F')
+    else:
+        volume = np.empty(shape, dtype=dtype, order='F')
+        subbrick_bytes = shape[0]*shape[1]*shape[2]*filedtype.itemsize
+        f = openfile(nii_path, 'rb')
+        f.seek(offset)
+        for t in range(shape[3]):
+            raw = f.read(subbrick_bytes)
+            if len(raw) != subbrick_bytes:
+                f.close()
+                raise afni.Error(nii_path + " ended before all of its sub-bricks could be read!")
+            subbrick = convertsubbrick(np.frombuffer(raw, dtype=filedtype), hdr, dtype)
+            volume[:, :, :, t] = subbrick.reshape(shape[:3], order='F')
+        f.close()
+
+    return afni.load(path, header=dset_head, volume=volume)
+
+#========================= writing =========================
+
+#packs a NIfTI header for a dataset with the given AFNI head instance, shape and on-disk dtype
+def packheader(dset_head, shape, dtype):
+    dtype = np.dtype(dtype)
+    native = dtype.newbyteorder('=')
+    if native not in nifti_codes:
+        raise afni.Error("Can't write " + str(native) + " data to NIfTI")
+
+    #DICOM --> RAS
+    matrix = ijktodicom(dset_head)*np.array([[-1.0], [-1.0], [1.0]])
+    voxel_sizes = np.sqrt((matrix[:, :3]**2).sum(axis=0))
+    b, c, d, qfac = quaternfrommatrix(matrix[:, :3]/np.where(voxel_sizes > 0, voxel_sizes, 1.0))
+
+    view = dset_head.SCENE_DATA[2][0] if hasattr(dset_head, 'SCENE_DATA') else 0
+    xform_code = view_xform_codes[view] if 0 <= view < len(view_xform_codes) else 1
+
+    nt = shape[3]
+    dim = [4 if nt > 1 else 3, shape[0], shape[1], shape[2], nt, 1, 1, 1]
+
+    tr = 0.0
+    units = 2 | 8          #mm and seconds
+    if hasattr(dset_head, 'TAXIS_FLOATS') and nt > 1:
+        tr = dset_head.TAXIS_FLOATS[2][1]
+        if hasattr(dset_head, 'TAXIS_NUMS') and dset_head.TAXIS_NUMS[2][2] == 77001:
+            units = 2 | 16  #mm and milliseconds
+
+    #differing factors are applied to the data by the callers (see afniscaling())
+    slope = afniscaling(dset_head, nt)[0]
+
+    hdr = {'sizeof_hdr': header_size, 'data_type': '', 'db_name': '', 'extents': 0, 'session_error': 0,
+           'regular': 'r', 'dim_info': 0, 'dim': dim, 'intent_p1': 0.0, 'intent_p2': 0.0, 'intent_p3': 0.0,
+           'intent_code': 0, 'datatype': nifti_codes[native], 'bitpix': 8*native.itemsize, 'slice_start': 0,
+           'pixdim': [qfac] + list(voxel_sizes) + [tr, 0.0, 0.0, 0.0], 'vox_offset': float(vox_offset),
+           'scl_slope': slope, 'scl_inter': 0.0, 'slice_end': 0, 'slice_code': 0, 'xyzt_units': units,
+           'cal_max': 0.0, 'cal_min': 0.0, 'slice_duration': 0.0, 'toffset': 0.0, 'glmax': 0, 'glmin': 0,
+           'descrip': 'AFNIpyIO', 'aux_file': '', 'qform_code': xform_code, 'sform_code': xform_code,
+           'quatern_b': b, 'quatern_c': c, 'quatern_d': d,
+           'qoffset_x': matrix[0, 3], 'qoffset_y': matrix[1, 3], 'qoffset_z': matrix[2, 3],
+           'srow_x': list(matrix[0]), 'srow_y': list(matrix[1]), 'srow_z': list(matrix[2]),
+           'intent_name': '', 'magic': 'n+1\0'}
+
+    values = []
+    for name, code in header_fields:
+        if isinstance(hdr[name], list):
+            values += hdr[name]
+        else:
+            values.append(hdr[name])
+
+    endian = '>' if dtype.byteorder == '>' or (dtype.byteorder == '=' and sys.byteorder == 'big') else '<'
+    #4 zero bytes after the header say there are no extensions
+    return struct.pack(endian + header_format, *values) + '\0'*(vox_offset - header_size)
+
+#writes a load instance (or, when given a path, an AFNI dataset streamed straight off its .BRIK) to .nii or .nii.gz
+def savenifti(dset, nii_path, compresslevel=6):
+    if isinstance(dset, basestring):
+        return afni2nifti(dset, nii_path, compresslevel)
+
+    volume = dset.brik.volume
+    if volume.ndim == 3:
+        volume = volume[:, :, :, np.newaxis]
+
+    slope, facs = afniscaling(dset.head, volume.shape[3])
+    dtype = volume.dtype if facs is None else scaleddtype(volume.dtype)
+
+    f = openfile(nii_path, 'wb', compresslevel)
+    f.write(packheader(dset.head, volume.shape, dtype))
+    for t in range(volume.shape[3]):
+        #.tostring(order='F') makes a copy of a single sub-brick at most
+        if facs is None:
+            f.write(volume[:, :, :, t].tostring(order='F'))
+        else:
+            f.write((volume[:, :, :, t]*facs[t]).astype(dtype).tostring(order='F'))
+    f.close()
+    return nii_path
+
+#AFNI dataset --> .nii/.nii.gz in a single pass over the .BRIK. The NIfTI header is written in the byte order of the
+#.BRIK so the data itself is copied over byte for byte
+def afni2nifti(file_path, nii_path, compresslevel=6):
+    path = afni.commonpath(file_path)
+    dset_head = afni.head(path + '.HEAD')
+    if dset_head.dtype == "Multiple Types":
+        raise afni.Error("Can't convert a dataset with multiple BRICK_TYPES to NIfTI")
+
+    dims = dset_head.DATASET_DIMENSIONS[2]
+    shape = (dims[0], dims[1], dims[2], dset_head.DATASET_RANK[2][1])
+    if dset_head.byte_order == 'IEEE-BE':
+        dtype = np.dtype(dset_head.dtype).newbyteorder('>')
+    elif dset_head.byte_order == 'IEEE-LE':
+        dtype = np.dtype(dset_head.dtype).newbyteorder('<')
+    else:
+        dtype = np.dtype(dset_head.dtype)
+
+    nbytes = int(np.prod(shape))*dtype.itemsize
+    if os.path.getsize(path + '.BRIK') < nbytes:
+        raise afni.Error(path + ".BRIK is smaller than its header says it should be!")
+
+    #factors that differ between sub-bricks can't be a scl_slope, so those get applied sub-brick by sub-brick
+    if afniscaling(dset_head, shape[3])[1] is not None:
+        return savenifti(afni.load(path, header=dset_head, volume=afni.mapbrik(path + '.BRIK', dset_head)),
+                         nii_path, compresslevel)
+
+    src = open(path + '.BRIK', 'rb')
+    dst = openfile(nii_path, 'wb', compresslevel)
+    dst.write(packheader(dset_head, shape, dtype))
+    copybytes(src, dst, nbytes)
+    dst.close()
+    src.close()
+    return nii_path
+
+#.nii/.nii.gz --> AFNI dataset in a single pass. afni_path may include +orig/+acpc/+tlrc (it's worked out from the
+#NIfTI xform code otherwise)
+def nifti2afni(nii_path, afni_path):
+    hdr = readheader(nii_path)
+    shape = hdr['dims']
+    filedtype = hdr['dtype']
+    dtype = storeddtype(hdr)
+
+    afni_path = afni.commonpath(afni_path)
+    if not (afni_path.endswith('+orig') or afni_path.endswith('+acpc') or afni_path.endswith('+tlrc')):
+        xform_code = hdr['sform_code'] if hdr['sform_code'] > 0 else hdr['qform_code']
+        if xform_code in view_xform_codes:
+            afni_path += '+' + view_names[view_xform_codes.index(xform_code)]
+        else:
+            afni_path += '+orig'
+
+    #when no conversion is needed keep the file's byte order so the data is a plain copy
+    plaincopy = dtype == filedtype.newbyteorder('=') and niftiscaling(hdr)[1] == 0.0
+    if plaincopy:
+        byteorder = 'LSB_FIRST' if hdr['endian'] == '<' else 'MSB_FIRST'
+    else:
+        byteorder = 'LSB_FIRST' if sys.byteorder == 'little' else 'MSB_FIRST'
+
+    lines = afnihead(hdr, dtype, byteorder, note='Converted from ' + os.path.basename(nii_path) + ' by AFNIpyIO')
+
+    src = openfile(nii_path, 'rb')
+    src.seek(int(hdr['vox_offset']))
+    dst = open(afni_path + '.BRIK', 'wb')
+    if plaincopy:
+        copybytes(src, dst, int(np.prod(shape))*filedtype.itemsize)
+    else:
+        subbrick_bytes = shape[0]*shape[1]*shape[2]*filedtype.itemsize
+        for t in range(shape[3]):
+            raw = src.read(subbrick_bytes)
+            if len(raw) != subbrick_bytes:
+                raise afni.Error(nii_path + " ended before all of its sub-bricks could be read!")
+            convertsubbrick(np.frombuffer(raw, dtype=filedtype), hdr, dtype).tofile(dst)
+    dst.close()
+    src.close()
+
+    f = open(afni_path + '.HEAD', 'w')
+    f.writelines(lines)
+    f.close()
+    return afni_path
+
+#========================= checks =========================
+
+#writes a small dataset in every one of the 48 orientations to directory, converts it to NIfTI and back (and loads the
+#NIfTI file) and returns a list of the ones whose ORIENT_SPECIFIC, ORIGIN or DELTA didn't come back the same
+def checkorientations(directory):
+    byteorder = 'LSB_FIRST' if sys.byteorder == 'little' else 'MSB_FIRST'
+    volume = np.arange(2*3*4, dtype=np.int16).reshape((2, 3, 4, 1), order='F')
+    bad = []
+    for axes in itertools.permutations(range(3)):
+        for steps in itertools.product((0, 1), repeat=3):
+            orient = [orient_codes[axis][step] for axis, step in zip(axes, steps)]
+            delta = [(-1.0 if step else 1.0)*size for step, size in zip(steps, (2.0, 2.5, 3.0))]
+            origin = [-10.0, 20.5, 31.0]
+            path = os.path.join(directory, 'orient' + ''.join(str(code) for code in orient) + '+orig')
+            lines = headlines([('string-attribute', 'TYPESTRING', '3DIM_HEAD_ANAT'),
+                               ('integer-attribute', 'SCENE_DATA', [0, 0, 0]),
+                               ('integer-attribute', 'ORIENT_SPECIFIC', orient),
+                               ('float-attribute', 'ORIGIN', origin),
+                               ('float-attribute', 'DELTA', delta),
+                               ('integer-attribute', 'DATASET_RANK', [3, 1, 0, 0, 0, 0, 0, 0]),
+                               ('integer-attribute', 'DATASET_DIMENSIONS', list(volume.shape[:3]) + [0, 0]),
+                               ('integer-attribute', 'BRICK_TYPES', [1]),
+                               ('float-attribute', 'BRICK_FLOAT_FACS', [0.0]),
+                               ('string-attribute', 'BYTEORDER_STRING', byteorder)])
+            afni.load(path, header=afni.head(path + '.HEAD', rawhead=lines), volume=volume).save(path)
+
+            nii_path = afni2nifti(path + '.HEAD', path[:-len('+orig')] + '.nii')
+            back = nifti2afni(nii_path, path[:-len('+orig')] + '_back')
+            for how, dset_head in (('nifti2afni', afni.head(back + '.HEAD')), ('loadnifti', loadnifti(nii_path).head)):
+                if (list(dset_head.ORIENT_SPECIFIC[2]) != orient or not np.allclose(dset_head.ORIGIN[2], origin) or
+                        not np.allclose(dset_head.DELTA[2], delta)):
+                    bad.append((how, orient, list(dset_head.ORIENT_SPECIFIC[2])))
+    return bad
+
+#python -m afnipyio.nifti checks the conversions, exits with 1 if any orientation doesn't survive them
+if __name__ == "__main__":
+    scratch_dir = tempfile.mkdtemp(prefix='nifticheck-')
+    try:
+        bad = checkorientations(scratch_dir)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    for how, orient, got in bad:
+        print how + ': ORIENT_SPECIFIC ' + str(orient) + ' came back as ' + str(got)
+    if bad:
+        print str(len(bad)) + ' orientation(s) DIFFER after the NIfTI round trip'
+        sys.exit(1)
+    print 'Every orientation survives the NIfTI round trip'
@@ -0,0 +1,1794 @@
+#!/usr/bin/env python2.7
+
+# AFNIpyIO PLACE correction
+# The PLACE distortion correction behind PLACE-2.6.py as an importable module, plus a service mode that keeps unwarp
+# matrices warm between jobs
+# developed and tested on python2.7
+
+# Required modules: numpy, scipy, AFNIPyIO
+
+# PLACE-2.6.py is the GUI and command line front end to this module.
+
+# usage example:
+#   from afnipyio import place
+#   pc = place.corrector("/My/place/Dmap", "/My/place/ParScan")   #reads the Dmap/ParScan, builds (or loads) the unwarp matrix
+#   pc.correct("/My/scans/EPI_E07+orig.HEAD", "/My/save/dir")     #saves /My/save/dir/EPI_E07_pc+orig.HEAD/.BRIK
+#   pc.correctall(list_of_heads, "/My/save/dir", jobs=4)
+#   corrected = pc.unwarp(volume)                                  #(x, y, z) or (x, y, z, t) array in, same dtype out
+#   place.writelog("/My/save/dir/PLACE_log.txt", pc.log)
+#
+# Every dataset also gets a JSON Lines record (status, skip/failure reason, per stage timings, bytes read and written, peak
+# memory, voxels per second) in /My/save/dir/PLACE_report.jsonl, see the run report section
+#
+# corrector() takes the same options as PLACE-2.6.py (precision, rounding, floatout, tchunk, threads, cache_dir, usecache),
+# correctall() takes jobs, pipeline, stream, follow and resume.
+#
+# Watch mode corrects scans as soon as they are complete in a directory, see watch(). Scans that are still being
+# acquired can be corrected sub-brick by sub-brick while they grow, see corrector.follow()
+#   place.watch("/My/session/dir", [pc], "/My/save/dir")
+#   pc.follow("/My/session/dir/EPI_E07+orig.HEAD", "/My/save/dir")
+#
+# Service mode keeps worker processes, and the correctors they have built, running between jobs. Jobs are JSON files
+# dropped into a queue directory:
+#   python -m afnipyio.place /My/place_queue                     #or place.serve("/My/place_queue")
+#   place.submit("/My/place_queue", list_of_heads, "/My/place/Dmap", "/My/place/ParScan", "/My/save/dir", jobs=4)
+# Any number of workers, on any number of hosts, can share a queue directory on NFS, best with one job per dataset:
+#   place.submit("/nfs/place_queue", list_of_heads, "/My/place/Dmap", "/My/place/ParScan", "/My/save/dir", split=True)
+# see the service mode section for the job file format and how jobs are claimed and leased
+
+import sys
+import os
+import time
+import copy
+import json
+import uuid
+import shutil
+import socket
+import hashlib
+import resource
+import tempfile
+import argparse
+import threading
+import traceback
+import errno
+import Queue
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+from scipy.sparse import csc_matrix
+
+from afnipyio import AFNIPyIO as afni
+
+#Version so generated logs and scripts are traceable to a specific version of the code (especially important if there are errors)
+version = 'V2.6'
+
+#everything printandlog() is given goes here unless a log list of its own is passed in
+loglist = []
+
+#========================= makeunwarpmatrix function translation from matlab code ===============
+#All credit for the logic of the following code goes to GKA and was written July 2006
+#Questions about the overall logic of this function should go to (GKA) geoff.adams@gmail.com
+#Questions about the num.py and sci.py conversion or reports for bugs should go to njmei11@gmail.com
+
+#makephaseorigin() does all the work of figuring out where every Dmap point comes from, it returns the 0 based
+#(unwarped) voxel index of every Dmap point in (y, x, z) Fortran order and the number of voxels in a volume.
+#makeunwarpmatrix() turns that into the unwarp matrix
+#
+#The Matlab translation built every step as a full size float64 array (tiled phase points, phase origins, wrap masks,
+#tiled column offsets...), several times the size of the final matrix for high expansion Dmaps. The Dmap is int16 so
+#every step is exact integer arithmetic: phase origins are worked out one slice at a time with broadcasting, straight
+#into a single int32 array, with the wrapping and cropping done in place
+def makephaseorigin(dmap, expan):
+
+    expan = int(expan)
+
+    #dmap is (read, phase, slice), the Matlab code transposes it to put phase in columns and read in rows
+    #(3200x64x28 for the 11/02/25 CS scan), here every slice is worked on as a (read, phase) block instead
+    nread = np.size(dmap, axis=0)               #Number of read points
+    nphasedmap = np.size(dmap, axis=1)          #Number of phase points in dmap
+    nslice = np.size(dmap, axis=2)              #Number of slices
+    nphasevol = nphasedmap//expan               #Number of phase points in volume
+
+    numpoints = nread*nslice*nphasevol
+    if numpoints*expan > np.iinfo(np.int32).max:
+        raise afni.Error('Dmap is too large, ' + str(numpoints*expan) + ' points do not fit 32 bit indexes!')
+
+    #phaseorigin[z, x, y] is Dmap point (x, y, z), i.e. the (y, x, z) Fortran order of the Matlab code
+    phaseorigin = np.empty((nslice, nread, nphasedmap), dtype=np.int32)
+
+    #Matlab code: phasePoints = repmat([1:nPhaseDmap]', [1,nRead,nSlice]); phaseOrigin = floor(phasePoints - dMap);
+    #broadcast along read instead of tiled (the Dmap is integer so floor() is a no-op)
+    phasepoints = np.arange(1, nphasedmap+1, dtype=np.int32)
+
+    #Matlab code: phaseOrigin = phaseOrigin + repmat([0:nRead*nSlice-1]*nPhaseDmap, [nPhaseDmap, 1]);
+    #followed by ceil(phaseOrigin(:)/expan) - 1 (0 based). With phase origins in 1 ... nPhaseDmap that is
+    #(origin-1)//expan + (x + z*nRead)*nPhaseVol
+    readoffsets = (np.arange(nread, dtype=np.int32)*nphasevol)[:, np.newaxis]
+
+    for z in range(nslice):
+        origin = phaseorigin[z]
+        np.subtract(phasepoints, dmap[:, :, z], out=origin)
+
+        #-------------------- Correct wrapping errors --------------------------------------
+        origin[origin > nphasedmap] -= nphasedmap
+        origin[origin < 1] += nphasedmap
+
+        #----------------------- Cropping --------------------------------------
+        #crop is [1, 1, nread, nphasevol] (no user input crop), so only the clamp to 1 ... nphasedmap is left
+        np.clip(origin, 1, nphasedmap, out=origin)
+
+        origin -= 1
+        origin //= expan
+        origin += readoffsets
+        origin += z*nread*nphasevol
+
+    return phaseorigin.reshape(-1), int(numpoints)
+
+#Matlab code is: unwarpMatrix = sparse(phaseOrigin, ceil([1:nRead*nSlice*nPhaseDmap]/expan), 1, numPoints, numPoints)/expan;
+#i.e. column j of the matrix (0 based) holds the expan Dmap points j*expan ... (j+1)*expan-1 with a 1 at the row
+#they come from, and Matlab sparse() adds up the ones that land on the same row.
+#
+#Rather than handing scipy row and column arrays (and have csc_matrix convert, sort and add them up) the compressed
+#column arrays are made here: phase origins are sorted within their column in place, and every run of equal rows
+#becomes one entry holding the run length. The matrix is the one csc_matrix((1, (phaseorigin, j))) gives, entry
+#for entry
+def makeunwarpmatrix(dmap, expan):
+
+    phaseorigin, numpoints = makephaseorigin(dmap, expan)
+    expan = int(expan)
+
+    #one row per matrix column
+    rows = phaseorigin.reshape(numpoints, expan)
+    rows.sort(axis=1)
+
+    #first Dmap point of every run of equal rows within a column
+    first = np.ones(rows.shape, dtype=bool)
+    np.not_equal(rows[:, 1:], rows[:, :-1], out=first[:, 1:])
+
+    indptr = np.zeros(numpoints+1, dtype=np.int32)
+    np.cumsum(first.sum(axis=1), out=indptr[1:])
+
+    first = first.reshape(-1)
+    indices = phaseorigin[first]
+    starts = np.flatnonzero(first)
+    del first, rows, phaseorigin
+    counts = np.diff(np.append(starts, numpoints*expan)).astype(np.min_scalar_type(expan))
+    del starts
+
+    unwarpmatrix = csc_matrix((counts, indices, indptr), shape=(numpoints,numpoints))/expan
+    return  unwarpmatrix
+
+#========================= On-disk unwarp matrix cache ======================
+#Building the unwarp matrix is most of PLACE's startup time, and the same Dmap/ParScan pair gets reused for many
+#sessions and reruns. Every matrix PLACE builds is saved as a directory of .npy files in the cache directory
+#(PLACE_cache next to the Dmap by default, see the cache_dir and usecache options of corrector()) named after the sha1 of the cache
+#format, the first five ParScan values and the Dmap bytes. Later runs memory map those arrays instead of
+#rebuilding the matrix. Entries are checked against the ParScan before they are used, one that doesn't fit (i.e.
+#written by a different build of the same cache format) is thrown away and rebuilt.
+
+cache_dirname = 'PLACE_cache'
+
+#cache_format has to go up whenever the arrays a matrix is saved as (or how they are built) change, the PLACE version
+#alone doesn't say that. 2: float64 matrices only, built out of the int32 phase origins of makephaseorigin()
+cache_format = 2
+
+def unwarpcachekey(dmapbytes, placepars):
+    sha = hashlib.sha1()
+    sha.update('format ' + str(cache_format) + '\n' + ' '.join([str(i) for i in placepars]) + '\n')
+    sha.update(dmapbytes)
+    return sha.hexdigest()
+
+#None if a cache entry (its info.json and memory mapped arrays) holds the unwarp matrix for placepars, otherwise why
+#it doesn't
+def checkunwarpcache(info, arrays, placepars):
+    numpoints = placepars[0]*placepars[1]*placepars[2]
+    expan = placepars[4]
+    if info.get('format') != cache_format:
+        return 'cache format ' + str(info.get('format')) + ' instead of ' + str(cache_format)
+    if info['expan'] != expan or info['numpoints'] != numpoints:
+        return 'holds a matrix for ' + str(info['numpoints']) + ' voxels, expansion ' + str(info['expan'])
+
+    #name --> (dtype, length), the lengths of data and indices are checked against indptr below
+    expected = {'data': ('float64', None), 'indices': ('int32', None), 'indptr': ('int32', numpoints + 1)}
+    if sorted(arrays) != sorted(expected):
+        return 'arrays ' + ', '.join(sorted(arrays)) + ' instead of ' + ', '.join(sorted(expected))
+    for name, (dtype, length) in expected.items():
+        if arrays[name].ndim != 1:
+            return name + ' has shape ' + str(arrays[name].shape)
+        if dtype is not None and arrays[name].dtype != np.dtype(dtype):
+            return name + ' is ' + str(arrays[name].dtype) + ' instead of ' + dtype
+        if length is not None and arrays[name].size != length:
+            return name + ' has ' + str(arrays[name].size) + ' entries instead of ' + str(length)
+
+    indptr = arrays['indptr']
+    indices = arrays['indices']
+    if indptr[0] != 0 or indptr[-1] != indices.size or arrays['data'].size != indices.size:
+        return 'indptr, indices and data disagree on the number of entries'
+    steps = np.diff(indptr)
+    if steps.min() < 1 or steps.max() > expan:
+        return 'columns with less than 1 or more than ' + str(expan) + ' entries'
+    if indices.min() < 0 or indices.max() >= numpoints:
+        return 'indices outside of the ' + str(numpoints) + ' voxels'
+    return None
+
+#returns the cached matrix, or None if there isn't one (or it can't be read). An entry that doesn't hold the matrix
+#for placepars is moved out of the way (so the rebuilt one can take its place) and logged
+def loadunwarpcache(cache_dir, key, placepars, log=None):
+    entry_path = os.path.join(cache_dir, key)
+    arrays = None
+    try:
+        f = open(os.path.join(entry_path, 'info.json'), 'r')
+        info = json.load(f)
+        f.close()
+        arrays = dict([(name, np.load(os.path.join(entry_path, name + '.npy'), mmap_mode='r')) for name in info['arrays']])
+        problem = checkunwarpcache(info, arrays, placepars)
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        if not os.path.isdir(entry_path):
+            return None
+        problem = 'unreadable'
+
+    if problem is not None:
+        printandlog('Unwarp matrix cache entry ' + entry_path + ' is not usable (' + problem + '), rebuilding it', log)
+        arrays = None
+        #renamed first so runs sharing the cache never see it half deleted
+        stale_path = os.path.join(cache_dir, '.' + key + '.stale.' + uuid.uuid4().hex)
+        try:
+            os.rename(entry_path, stale_path)
+        except OSError:
+            return None
+        shutil.rmtree(stale_path, ignore_errors=True)
+        return None
+
+    numpoints = info['numpoints']
+    return csc_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=(numpoints, numpoints), copy=False)
+
+#writes the matrix into a temporary directory that is then renamed into place, so runs sharing a cache never see a half
+#written entry. Returns the path of the entry or None if the cache directory isn't writable
+def saveunwarpcache(cache_dir, key, unwarpmatrix, expan):
+    entry_path = os.path.join(cache_dir, key)
+    arrays = {'data': unwarpmatrix.data, 'indices': unwarpmatrix.indices, 'indptr': unwarpmatrix.indptr}
+    info = {'version': version, 'format': cache_format, 'expan': int(expan), 'numpoints': int(unwarpmatrix.shape[0]),
+            'arrays': sorted(arrays)}
+
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = tempfile.mkdtemp(prefix='.' + key + '.', dir=cache_dir)
+        os.chmod(tmp_path, 0o755)
+    except OSError:
+        return None
+
+    try:
+        for name in arrays:
+            np.save(os.path.join(tmp_path, name + '.npy'), arrays[name])
+        f = open(os.path.join(tmp_path, 'info.json'), 'w')
+        json.dump(info, f)
+        f.close()
+        os.rename(tmp_path, entry_path)
+    except (IOError, OSError):
+        #either another run saved the same entry first or we ran out of space
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(entry_path):
+            return None
+    return entry_path
+
+#========================= Unwarp a volume given an unwarp matrix ======================
+def placeunwarp(vol, unwarpmatrix):
+    #Written by GKA
+    #Extracted from Blockana by dbtm (matlab comment)
+
+    #transpose matrix such that columns 1,2,3 (x, y, z) --> 2,1,3 (y, x, z)
+    vol = np.transpose(vol, [1,0,2])
+
+    origshape = np.array(np.shape(vol))
+
+    #turn volume into linear vector (array)
+    flatvol = vol.flatten(1)
+    #flatvol = vol.flatten(order='F')
+
+    #heart of the correction! Dot product of the unwarpmatrix vector and flatvol vector
+    #sparsematrix.dot() is very difference from np.dot() or np.inner() the first one works, the second two don't
+    dot = unwarpmatrix.dot(flatvol)
+    
+    #reshape back into original volume shape
+    corvol = np.reshape(dot, origshape, order='F')
+
+    #tranpose matrix back to 1,2,3
+    corvol = np.transpose(corvol, [1,0,2])
+
+    return corvol
+
+#========================= Unwarp a whole run given an unwarp matrix ======================
+#Same math as placeunwarp(), but instead of one sparse matrix-vector product (plus transposes and flatten copies) per TR
+#the run is laid out once as a (voxels x timepoints) matrix in the (y, x, z) Fortran order the unwarp matrix expects and
+#corrected with a single sparse matrix-matrix product. tchunk timepoints are done per product (0 = the whole run at once)
+#to keep the float temporaries bounded. Results are identical to calling placeunwarp() on every timepoint
+#values are computed in the precision of unwarpmatrix (see corrector(precision=)). For integer outputs rounding = 'nearest' rounds
+#them to the nearest integer and clips them to the range of the output type, 'truncate' leaves it to the cast into
+#out (towards zero, out of range values wrap around) like PLACE always did. scales (one per timepoint) multiply the
+#unwarped values, i.e. the BRICK_FLOAT_FACS of an integer scan that is written out as float. pool is a ThreadPool to
+#run the slabs on (see corrector.threadpool()), without one a pool of threads threads is started for this call only
+def placeunwarpall(data, unwarpmatrix, out=None, tchunk=32, threads=1, slabs=None, rounding='nearest', scales=None,
+                   pool=None):
+    nread, nphase, nslice, ntimes = np.shape(data)
+
+    if out is None:
+        out = np.empty(np.shape(data), dtype=data.dtype)
+
+    if not tchunk or tchunk < 1:
+        tchunk = ntimes
+
+    if slabs is None:
+        if threads > 1:
+            slabs = splitunwarp(unwarpmatrix, nread, nphase, nslice, threads)
+        else:
+            slabs = [(0, nslice, unwarpmatrix)]
+
+    def unwarpslab(task):
+        (z1, z2, block), t1 = task
+        t2 = min(t1 + tchunk, ntimes)
+
+        #voxel index y + nphase*x + nphase*nread*z is a C order (z, x, y) volume, with time as the fastest axis the
+        #sparse product walks both the run and its result contiguously. This is the only copy of the input we make
+        flatrun = np.ascontiguousarray(np.transpose(data[:,:,z1:z2,t1:t2], [2,0,1,3]), dtype=block.dtype)
+        flatrun = flatrun.reshape(-1, t2-t1)
+
+        dot = block.dot(flatrun)
+
+        if scales is not None:
+            dot *= scales[t1:t2].astype(dot.dtype)
+        if rounding == 'nearest' and out.dtype.kind in 'iu':
+            limits = np.iinfo(out.dtype)
+            np.rint(dot, out=dot)
+            np.clip(dot, limits.min, limits.max, out=dot)
+
+        #(z, x, y, t) view back to (x, y, z, t), cast into the output as we go
+        out[:,:,z1:z2,t1:t2] = np.transpose(dot.reshape(z2-z1, nread, nphase, t2-t1), [1,2,0,3])
+
+    tasks = [(slab, t1) for t1 in range(0, ntimes, tchunk) for slab in slabs]
+    if threads > 1 and len(tasks) > 1:
+        #every task reads and writes its own part of data/out, and both the copies and the products release the GIL
+        if pool is not None:
+            pool.map(unwarpslab, tasks, chunksize=1)
+        else:
+            pool = ThreadPool(min(threads, len(tasks)))
+            try:
+                pool.map(unwarpslab, tasks, chunksize=1)
+            finally:
+                pool.terminate()
+                pool.join()
+    else:
+        for task in tasks:
+            unwarpslab(task)
+
+    return out
+
+#The unwarp matrix is block diagonal: phaseorigin is offset by one phase line for every (read, slice) column, so every
+#voxel only gets contributions from its own phase line. Voxels are numbered y + nphase*x + nphase*nread*z, which makes
+#the voxels of slices z1 ... z2-1 one contiguous range, and the diagonal block for that range unwarps those slices on
+#their own. Summation order within a row doesn't change, so unwarping slab by slab is bit identical to the whole
+#matrix. splitunwarp() cuts the matrix into nslabs such (z1, z2, block) slabs and checks that nothing falls outside
+#of the blocks
+def splitunwarp(unwarpmatrix, nread, nphase, nslice, nslabs):
+    slabvoxels = nread*nphase
+    bounds = np.unique(np.linspace(0, nslice, min(nslabs, nslice) + 1).astype(int))
+
+    slabs = []
+    for z1, z2 in zip(bounds[:-1], bounds[1:]):
+        v1, v2 = z1*slabvoxels, z2*slabvoxels
+        rows = unwarpmatrix.indices[unwarpmatrix.indptr[v1]:unwarpmatrix.indptr[v2]]
+        if rows.size and (rows.min() < v1 or rows.max() >= v2):
+            raise afni.Error('Unwarp matrix is not block diagonal, voxels ' + str(v1) + ' to ' + str(v2) + ' depend on voxels outside of them!')
+        block = unwarpmatrix[v1:v2, v1:v2]
+        slabs.append((int(z1), int(z2), block))
+    return slabs
+
+#log is the list the line is collected in, loglist unless a scan is keeping its own log section
+def printandlog(some_string, log = None):
+    global loglist
+
+    if log is None:
+        log = loglist
+
+    some_string = str(some_string)
+    
+    print some_string
+    log.append(some_string + '\n')
+
+#code for benchmarking purposes
+@contextmanager  
+def measureTime(title, log = None):
+    t1 = time.time()
+    yield
+    t2 = time.time()
+    printandlog('%s took %0.2f seconds' % (title, t2-t1), log)
+
+#peak resident memory of this process so far in MB (ru_maxrss is in kB on Linux and in bytes on OS X)
+def peakmemory():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss/1024.0**2
+    return maxrss/1024.0
+
+#the peak is a high water mark, so the growth only shows what the block needed above anything the process used before
+@contextmanager
+def measureMemory(title, log = None):
+    m1 = peakmemory()
+    yield
+    m2 = peakmemory()
+    printandlog('%s: peak memory %0.1f MB (%0.1f MB above the earlier peak)' % (title, m2, m2-m1), log)
+
+#function to write out a logfile
+def writelog(logfilepath, loglist):
+    print '\n' + 'Writing out analysis log!' + '\n'
+    
+    from time import gmtime, strftime
+    time = strftime("%Y-%m-%d %H:%M:%S", gmtime())
+
+    #Opening our file!
+    LOG = open(logfilepath, 'w')
+
+    #Writing the header and time
+    LOG.write('#PLACE correction ' + version + ' by Nicholas Mei\n')
+    LOG.write('#This log was automatically generated on ' + time + ' GMT' + '\n' + '\n')
+
+    #Dump everything collected in the log into our text file!
+    for line in loglist:
+        LOG.write(line)
+
+    #Close our log!
+    LOG.close()
+
+    print 'log file written to' + logfilepath + '\n' + '\n' + 'Finally done with this condition!!' + '\n'
+
+    #empty loglist and reinitialize it for next run
+    del loglist[:]
+
+#header for a float32 version of a scan (-float): every BRICK_TYPES entry becomes float and BRICK_FLOAT_FACS are cleared.
+#Also returns the scale factor of every sub-brick (1 where BRICK_FLOAT_FACS is 0), which has to be applied to the
+#unwarped values since they are no longer scaled on disk
+def floathead(dset_head):
+    ntimes = dset_head.DATASET_RANK[2][1]
+    float_head = copy.deepcopy(dset_head)
+
+    scales = np.ones(ntimes)
+    if hasattr(float_head, 'BRICK_FLOAT_FACS'):
+        facs = np.asarray(float_head.BRICK_FLOAT_FACS[2], dtype=np.float64)
+        scales[facs != 0] = facs[facs != 0]
+        float_head.BRICK_FLOAT_FACS = ('float-attribute', ntimes, [0.0]*ntimes)
+
+    float_head.BRICK_TYPES = ('integer-attribute', ntimes, [3]*ntimes)
+    float_head.dtype = 'float32'
+    return float_head, scales
+
+#copy of a header cut down (or grown) to nt sub-bricks, for a .BRIK that is still being written. DATASET_RANK, TAXIS_NUMS,
+#BRICK_TYPES and BRICK_FLOAT_FACS are resized (new sub-bricks get the values of the last one), the per sub-brick
+#statistics and labels are dropped (AFNI works out the statistics itself). Headers that already are for nt sub-bricks
+#are copied unchanged
+def subbrickhead(dset_head, nt):
+    sub_head = copy.deepcopy(dset_head)
+    if dset_head.DATASET_RANK[2][1] == nt:
+        return sub_head
+
+    rank = sub_head.DATASET_RANK
+    sub_head.DATASET_RANK = (rank[0], rank[1], [rank[2][0], nt] + list(rank[2][2:]))
+    if hasattr(sub_head, 'TAXIS_NUMS'):
+        taxis = sub_head.TAXIS_NUMS
+        sub_head.TAXIS_NUMS = (taxis[0], taxis[1], [nt] + list(taxis[2][1:]))
+
+    for attrib in ('BRICK_TYPES', 'BRICK_FLOAT_FACS'):
+        if hasattr(sub_head, attrib):
+            values = list(getattr(sub_head, attrib)[2][:nt])
+            values += values[-1:]*(nt - len(values))
+            setattr(sub_head, attrib, (getattr(sub_head, attrib)[0], nt, values))
+
+    for attrib in ('BRICK_STATS', 'BRICK_LABS', 'BRICK_KEYWORDS', 'BRICK_STATAUX', 'BRICK_STATSYM'):
+        if hasattr(sub_head, attrib):
+            delattr(sub_head, attrib)
+    sub_head.existing_attributes = [attrib for attrib in sub_head.existing_attributes if hasattr(sub_head, attrib)]
+    return sub_head
+
+#===================================== batch manifest ===========================================
+#correctall() keeps PLACE_manifest.json in the save directory: for every output it corrected the input, the sha1 of the
+#input .HEAD/.BRIK, of the Dmap/ParScan and of the output .HEAD/.BRIK, the settings and the PLACE version. An entry is
+#only added once its output has been completely written, and the manifest is always replaced as a whole (written to
+#a temporary file that is renamed over it, under a lock so several processes can share a save directory), so an entry
+#is the completion marker of its output: after a crash, outputs without one are half written. Rerunning with resume = True (-resume) checks every output against its entry and only
+#redoes the missing, stale or corrupt ones
+manifest_name = 'PLACE_manifest.json'
+
+#sha1 of the .HEAD and then the .BRIK of a dataset, read chunk_bytes at a time
+def dsetsha1(head_path, chunk_bytes = 4*1024*1024):
+    sha = hashlib.sha1()
+    for path in (head_path, head_path[:-len('.HEAD')] + '.BRIK'):
+        f = open(path, 'rb')
+        chunk = f.read(chunk_bytes)
+        while chunk:
+            sha.update(chunk)
+            chunk = f.read(chunk_bytes)
+        f.close()
+    return sha.hexdigest()
+
+def readmanifest(save_dir):
+    try:
+        f = open(os.path.join(save_dir, manifest_name), 'r')
+        manifest = json.load(f)
+        f.close()
+        if 'outputs' in manifest:
+            return manifest
+    except (IOError, ValueError):
+        pass
+    return {'outputs': {}}
+
+def writemanifest(save_dir, manifest):
+    fd, tmp_path = tempfile.mkstemp(prefix = '.' + manifest_name, dir = save_dir)
+    f = os.fdopen(fd, 'w')
+    json.dump(manifest, f, indent = 1, sort_keys = True)
+    f.close()
+    os.rename(tmp_path, os.path.join(save_dir, manifest_name))
+
+#held while the manifest is read, changed and written, so processes on any number of hosts can add to the same one (the
+#lock file is created with O_EXCL, which is atomic on NFS too). The lock file holds its owner, the workerid() and a token
+#of this hold. A lock whose owner died holding it is broken: as soon as its process is gone if it was on this host, after
+#stale seconds (by the clock of the filesystem) if it was on another host or the owner couldn't be read
+@contextmanager
+def manifestlock(save_dir, stale = 30.0):
+    lock_path = os.path.join(save_dir, manifest_name + '.lock')
+    owner = workerid() + ' ' + uuid.uuid4().hex
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            #anything but a lock that is already there (save_dir can't be written to, a full disk) won't go away by
+            #waiting
+            if e.errno != errno.EEXIST:
+                raise
+            seen = readlock(lock_path)
+            if seen is not None and deadlock(save_dir, seen, stale):
+                droplock(lock_path, seen)
+                continue
+            time.sleep(0.05)
+            continue
+        os.write(fd, owner)
+        os.close(fd)
+        break
+    try:
+        yield
+    finally:
+        droplock(lock_path, (owner, None))
+
+#(owner, mtime) of a lock file, None if there is none. The owner is '' for a lock that was just created and not
+#written yet
+def readlock(lock_path):
+    try:
+        f = open(lock_path)
+        owner = f.read()
+        f.close()
+        return owner, os.path.getmtime(lock_path)
+    except (IOError, OSError):
+        return None
+
+#True if the owner of a lock (as readlock() saw it) died holding it
+def deadlock(save_dir, seen, stale):
+    host, _, pid = seen[0].split(' ')[0].rpartition('-')
+    if host == socket.gethostname() and pid.isdigit():
+        try:
+            os.kill(int(pid), 0)
+        except OSError as e:
+            return e.errno == errno.ESRCH
+        return False
+    try:
+        return fstime(save_dir) - seen[1] > stale
+    except OSError:
+        return False
+
+#removes the lock if it is still the one seen (the owner, and the mtime unless that is None). The lock is first renamed
+#to a unique name, so of several processes breaking the same lock only one gets it, and then checked: a lock that
+#changed hands since it was seen is put back
+def droplock(lock_path, seen):
+    moved_path = lock_path + '.' + uuid.uuid4().hex
+    try:
+        os.rename(lock_path, moved_path)
+    except OSError:
+        return
+    moved = readlock(moved_path)
+    if moved is None or (moved[0] == seen[0] and seen[1] in (None, moved[1])):
+        if moved is not None:
+            os.remove(moved_path)
+        return
+    try:
+        os.link(moved_path, lock_path)
+    except OSError:
+        pass
+    os.remove(moved_path)
+
+#adds (or replaces) the entry of one output, keeping whatever other processes added in the meantime
+def addtomanifest(save_dir, name, entry):
+    with manifestlock(save_dir):
+        manifest = readmanifest(save_dir)
+        manifest['outputs'][name] = entry
+        writemanifest(save_dir, manifest)
+
+#===================================== run report ===========================================
+#Next to the free text PLACE_log.txt every run appends machine readable records to PLACE_report.jsonl in the save
+#directory, one JSON object per line, so throughput can be compared across sessions (slow NFS mounts, oversized runs):
+#   dataset - one for every dataset correct(), follow(), correctall() or watch() looked at: status (corrected, skipped
+#             or failed), reason (skipped and failed ones), seconds, bytes_read, bytes_written, voxels and voxels_per_s
+#             (corrected ones), peak_rss_mb of the process that did it and per stage (load, unwarp, save, stream or
+#             follow) seconds and bytes
+#   run     - one per correctall(): datasets, corrected, skipped, seconds, the run options, the corrector settings and
+#             how its unwarp matrix was made (built or from the cache, seconds, peak_rss_mb, mb)
+#Every record also has the time (UTC), the worker (hostname-pid) and the PLACE version. Records are appended as soon as
+#they are known, under the manifest lock so workers on several hosts can share a save directory, and a run that never
+#finishes still leaves the records of the datasets it got through. The report is bookkeeping only: not being able to
+#write it never stops a correction
+report_name = 'PLACE_report.jsonl'
+
+def appendreport(save_dir, kind, entry):
+    if not os.path.isdir(save_dir):
+        return
+    record = OrderedDict([('record', kind), ('time', time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())),
+                          ('worker', workerid()), ('version', version)])
+    record.update(entry)
+    try:
+        with manifestlock(save_dir):
+            f = open(os.path.join(save_dir, report_name), 'a')
+            f.write(json.dumps(record) + '\n')
+            f.close()
+    except (IOError, OSError):
+        pass
+
+#the record of one dataset, stages are added with measureStage() and reportdataset() writes it out
+def datasetreport(epi):
+    return {'dataset': epi, 'started': time.time(), 'stages': OrderedDict()}
+
+#times one stage of a dataset, the dictionary it yields takes the bytes_read/bytes_written of the stage
+@contextmanager
+def measureStage(report, name):
+    stage = OrderedDict()
+    report['stages'][name] = stage
+    t1 = time.time()
+    try:
+        yield stage
+    finally:
+        stage['seconds'] = time.time() - t1
+
+#writes a dataset record that failed (and re-raises the exception) if anything in the block raises
+@contextmanager
+def reportfailure(save_dir, report):
+    try:
+        yield
+    except Exception:
+        failure = sys.exc_info()
+        reportdataset(save_dir, report, 'failed', failurereason(failure))
+        raise failure[0], failure[1], failure[2]
+
+#the exception of a sys.exc_info() as the one line reason of a failed dataset
+def failurereason(failure):
+    return ''.join(traceback.format_exception_only(failure[0], failure[1])).strip()
+
+#size of a .HEAD plus its .BRIK, as much of them as there is
+def dsetbytes(head_path):
+    total = 0
+    for path in (head_path, head_path[:-len('.HEAD')] + '.BRIK'):
+        if os.path.exists(path):
+            total += os.path.getsize(path)
+    return total
+
+#status is corrected, skipped or failed
+def reportdataset(save_dir, report, status, reason = None):
+    seconds = time.time() - report['started']
+    stages = report['stages']
+
+    entry = OrderedDict([('dataset', report['dataset']), ('status', status)])
+    if reason:
+        entry['reason'] = reason
+    if 'output' in report:
+        entry['output'] = report['output']
+    entry['seconds'] = seconds
+    entry['bytes_read'] = sum(stage.get('bytes_read', 0) for stage in stages.values())
+    entry['bytes_written'] = sum(stage.get('bytes_written', 0) for stage in stages.values())
+    if status == 'corrected' and report.get('voxels'):
+        entry['voxels'] = report['voxels']
+        entry['voxels_per_s'] = report['voxels']/seconds if seconds else None
+        for name in ('unwarp', 'stream', 'follow'):
+            if name in stages and stages[name].get('seconds'):
+                stages[name]['voxels_per_s'] = report['voxels']/stages[name]['seconds']
+    entry['peak_rss_mb'] = peakmemory()
+    entry['stages'] = stages
+    appendreport(save_dir, 'dataset', entry)
+
+#===================================== ParScan and Dmap ===========================================
+#first 5 ParScan parameters (xres, yres, zres, reps, expansion)
+def readparscan(parscan_path):
+    try:
+        rawparscan = open(parscan_path, 'r')
+    except IOError:
+        raise afni.Error('ParScan file was unable to be opened!')
+
+    rawparscanstring = rawparscan.read()
+    rawparscan.close()
+
+    #separate all values from the raw string by ' ' (space)
+    placepars = rawparscanstring.split()[:5]
+    return [int(i) for i in placepars]
+
+#raw Dmap bytes (they are part of the unwarp cache key) and the Dmap as a (read, phase*expan, slice) int16 array
+def readdmap(dmap_path, placepars):
+    try:
+        binarydmap = open(dmap_path, 'rb')
+    except IOError:
+        raise afni.Error('Dmap file was unable to be opened!')
+
+    binarydmapstring = binarydmap.read()
+    binarydmap.close()
+
+    #use the numpy fromstring() function to convert the binary file
+    dmap = np.fromstring(binarydmapstring, dtype='int16')
+
+    #reshape should be in 'Fortran' read order mode because that's how Matlab does it...
+    #size of Dmap should be xres*yres*expan*nslices
+    dmap = np.reshape(dmap, [placepars[0], placepars[1]*placepars[4], placepars[2]], order='F')
+    return binarydmapstring, dmap
+
+#where the PLACE corrected version of a scan goes (None if it isn't an +orig, +acpc or +tlrc .HEAD)
+def correctedpath(epi, save_dir):
+    for view in ('+orig', '+acpc', '+tlrc'):
+        if epi.endswith(view + '.HEAD'):
+            correctedname = afni.commonpath(epi)[:-len(view)] + '_pc' + view + '.HEAD'
+            break
+    else:
+        return None
+
+    corrected_base = os.path.basename(correctedname)
+
+    return os.path.join(save_dir, corrected_base)
+
+#where a scan is written before it is renamed to save_path, when it has to be held back until it is known it may be
+#saved (see correctall()): a hidden name next to save_path, unique to the tag of the run
+def stagedpath(save_path, tag):
+    return os.path.join(os.path.dirname(save_path), '.' + tag + '.' + os.path.basename(save_path))
+
+#renames a .HEAD/.BRIK pair, the .BRIK first so the .HEAD at to_path never points at a .BRIK that isn't there yet
+def renamedset(from_path, to_path):
+    for ext in ('.BRIK', '.HEAD'):
+        os.rename(from_path[:-len('.HEAD')] + ext, to_path[:-len('.HEAD')] + ext)
+
+#removes as much of a .HEAD/.BRIK pair as there is
+def removedset(head_path):
+    for ext in ('.HEAD', '.BRIK'):
+        if os.path.exists(head_path[:-len('.HEAD')] + ext):
+            os.remove(head_path[:-len('.HEAD')] + ext)
+
+#loads a scan and works out where its PLACE corrected version goes. Returns (img, save_path), or None if the scan has
+#to be skipped (and then puts why in report['reason'] if it is given a dataset report). With stream = True img is only
+#the head instance of the scan. claimed is a set of the (absolute) output paths earlier scans of the batch are going to
+#be saved to, for when they haven't been written yet (see corrector.__pipeline()). The save_path of a scan that isn't
+#skipped is added to it
+def placeload(epi, placepars, save_dir, stream = False, log = None, report = None, claimed = None):
+
+    unwarpnumread, unwarpnumphase, unwarpnumslice = placepars[:3]
+
+    printandlog('\nProcessing scan: ' + str(epi), log)
+
+    if stream:
+        img = afni.head(epi)
+        datashape = tuple(img.DATASET_DIMENSIONS[2][:3]) + (img.DATASET_RANK[2][1],)
+    else:
+        #load img1 using nibabel
+        img = afni.load(epi)
+        datashape = np.shape(img.brik.volume)
+
+    printandlog('Data matrix shape is: ' + str(datashape), log)
+
+    #ensure that the unwarp matrix and data matrix have the same shape otherwise bad stuff will happen...
+    if tuple(datashape[0:3]) != (unwarpnumread, unwarpnumphase, unwarpnumslice):
+        printandlog("Your scan: " + epi + " Does not match the dimensions of your Parscan parameters!!!", log)
+        printandlog("Skipping PLACE correction of: " + epi, log)
+        if report is not None:
+            report['reason'] = 'dimensions ' + str(tuple(datashape[0:3])) + ' do not match the ParScan'
+        return None
+
+    save_path = correctedpath(epi, save_dir)
+    if save_path is None:
+        printandlog("Your scan: " + epi + " is not an +orig, +acpc or +tlrc .HEAD file!!!", log)
+        printandlog("Skipping PLACE correction of: " + epi, log)
+        if report is not None:
+            report['reason'] = 'not an +orig, +acpc or +tlrc .HEAD'
+        return None
+
+    #an earlier scan with the same output name counts as an existing file, the same as when the scans are done one
+    #after the other
+    if os.path.exists(save_path) or (claimed is not None and os.path.abspath(save_path) in claimed):
+        printandlog("You already have a file of the same name as: " + save_path, log)
+        printandlog("PLACE correction was NOT done for: " + epi, log)
+        if report is not None:
+            report['reason'] = 'output already exists'
+        return None
+
+    if claimed is not None:
+        claimed.add(os.path.abspath(save_path))
+    return img, save_path
+
+def placesaved(epi, save_path, log = None):
+    printandlog('New PLACE corrected file will be saved to: ' + save_path, log)
+    printandlog('Alright!! Finished place correcting: ' + str(epi) + '\n', log)        
+
+#======================== PLACE corrector ========================
+#Everything PLACE needs to correct scans acquired with one Dmap/ParScan pair: the ParScan parameters and the unwarp
+#matrix (built once, or loaded from the on-disk cache), already converted to the unwarp precision and split into slabs
+#for threads. A corrector can be reused for any number of arrays or datasets.
+#
+#   x.placepars    - (xres, yres, zres, reps, expansion) from the ParScan
+#   x.unwarpmatrix - csc_matrix
+#   x.log          - list the log lines end up in (the module loglist unless a list is passed in)
+class corrector:
+
+    def __init__(self, dmap_path, parscan_path, precision='float32', rounding='nearest',
+                 floatout=False, tchunk=32, threads=1, cache_dir=None, usecache=True, log=None):
+        if precision not in ('float32', 'float64'):
+            raise afni.Error('Unwarp precision has to be float32 or float64, not: ' + str(precision))
+        if rounding not in ('nearest', 'truncate'):
+            raise afni.Error('Rounding has to be nearest or truncate, not: ' + str(rounding))
+
+        self.log = loglist if log is None else log
+        self.dmap_path = dmap_path
+        self.parscan_path = parscan_path
+        self.precision = precision
+        self.rounding = rounding
+        self.floatout = floatout
+        self.tchunk = tchunk
+
+        #===================================== Parscan preparation ========================================
+        self.placepars = readparscan(parscan_path)
+        printandlog('ParScan values of interest are (xres, yres, zres, reps, expansion): ' + str(self.placepars), self.log)
+        unwarpnumread, unwarpnumphase, unwarpnumslice, unwarpnumreps, unwarpexpan = self.placepars
+
+        #===================================== Dmap preparation ===========================================
+        binarydmapstring, dmap = readdmap(dmap_path, self.placepars)
+        self.dmapsha1 = hashlib.sha1(json.dumps(self.placepars) + binarydmapstring).hexdigest()
+        printandlog('Dimensions of dmap are: ' + str(np.size(dmap)), self.log)
+        printandlog('Dimensions of reshaped dmap are: ' + str(dmap.shape), self.log)
+
+        #------------------ unwarp matrix, straight from the cache if this Dmap/ParScan was used before ----------
+        #how it was made goes into the run report
+        self.matrixreport = OrderedDict([('source', 'built')])
+        t1 = time.time()
+        unwarpmatrix = None
+        if usecache:
+            if not cache_dir:
+                cache_dir = os.path.join(os.path.dirname(os.path.abspath(dmap_path)), cache_dirname)
+            cachekey = unwarpcachekey(binarydmapstring, self.placepars)
+            unwarpmatrix = loadunwarpcache(cache_dir, cachekey, self.placepars, self.log)
+            if unwarpmatrix is not None:
+                printandlog('Unwarp matrix cache hit: ' + os.path.join(cache_dir, cachekey), self.log)
+                self.matrixreport['source'] = 'cache'
+            else:
+                printandlog('Unwarp matrix cache miss: ' + os.path.join(cache_dir, cachekey), self.log)
+
+        if unwarpmatrix is None:
+            title = 'Building the unwarp sparse matrix'
+            with measureTime(title, self.log), measureMemory(title, self.log):
+
+                unwarpmatrix = makeunwarpmatrix(dmap, unwarpexpan)
+
+            if usecache:
+                if saveunwarpcache(cache_dir, cachekey, unwarpmatrix, unwarpexpan):
+                    printandlog('Unwarp matrix saved to cache', self.log)
+                else:
+                    printandlog('Unable to save the unwarp matrix to cache directory ' + cache_dir, self.log)
+
+        printandlog('\nSample of unwarp sparse matrix: \n \n' + str(unwarpmatrix) + '\n' + '\n', self.log)
+
+        #the cache always holds float64 matrices
+        if precision != 'float64':
+            unwarpmatrix = unwarpmatrix.astype(precision)
+        printandlog('Unwarping in ' + precision + ' precision, ' + ('writing float32 scans' if floatout else
+                    'rounding to the scan data type (' + rounding + ')'), self.log)
+        self.unwarpmatrix = unwarpmatrix
+
+        nbytes = unwarpmatrix.data.nbytes + unwarpmatrix.indices.nbytes + unwarpmatrix.indptr.nbytes
+        self.matrixreport['seconds'] = time.time() - t1
+        self.matrixreport['peak_rss_mb'] = peakmemory()
+        self.matrixreport['mb'] = nbytes/1024.0**2
+
+        #split the matrix into per slab blocks once for all scans
+        self.slabs = None
+        if threads < 1:
+            threads = multiprocessing.cpu_count()
+        self.threads = threads
+        if threads > 1:
+            self.slabs = splitunwarp(unwarpmatrix, unwarpnumread, unwarpnumphase, unwarpnumslice, threads)
+            printandlog('Unwarping ' + str(len(self.slabs)) + ' slabs of slices on ' + str(threads) + ' threads', self.log)
+
+        #(pid, ThreadPool) the slabs run on, started by threadpool() the first time it is needed
+        self.__pool = None
+
+    #-------------------- thread pool --------------------
+
+    #the ThreadPool every placeunwarpall() call of this corrector uses (None without threads). It is started once and
+    #reused for every chunk, sub-brick and scan: starting a pool costs more than unwarping a few sub-bricks. Worker
+    #processes fork with a copy of the corrector but not with its threads, so every process starts a pool of its own
+    def threadpool(self):
+        if self.threads <= 1:
+            return None
+        if self.__pool is None or self.__pool[0] != os.getpid():
+            self.__pool = (os.getpid(), ThreadPool(self.threads))
+        return self.__pool[1]
+
+    #stops the threads of this corrector (a later unwarp starts them again)
+    def close(self):
+        if self.__pool is not None and self.__pool[0] == os.getpid():
+            self.__pool[1].terminate()
+            self.__pool[1].join()
+        self.__pool = None
+
+    #-------------------- arrays --------------------
+
+    #PLACE corrected copy of an (x, y, z) or (x, y, z, t) array, in the array's own data type (float32 with floatout).
+    #scales are optional per sub-brick factors applied to the unwarped values (see floathead())
+    def unwarp(self, volume, scales=None):
+        volume = np.asarray(volume)
+        single = volume.ndim == 3
+        if single:
+            volume = volume[:, :, :, np.newaxis]
+        if volume.ndim != 4 or volume.shape[:3] != tuple(self.placepars[:3]):
+            raise afni.Error('Volume dimensions ' + str(volume.shape) + ' do not match the ParScan parameters ' +
+                             str(tuple(self.placepars[:3])))
+
+        corrected = np.empty(volume.shape, dtype=np.float32 if self.floatout else volume.dtype, order='F')
+        placeunwarpall(volume, self.unwarpmatrix, corrected, self.tchunk, self.threads, self.slabs, self.rounding,
+                       scales, self.threadpool())
+        if single:
+            return corrected[:, :, :, 0]
+        return corrected
+
+    #replaces the volume of a loaded scan with its PLACE corrected version
+    def unwarpscan(self, img):
+        scales = None
+        if self.floatout:
+            img.head, scales = floathead(img.head)
+
+        #Warning: data seems to be a pointer to image data so modifying it is not recommended
+        #I.E. only reference and read values from it. Don't operate on it... (placeunwarpall() only reads it)
+        #the result is in Fortran order so save() can write it out without another copy
+        img.brik.volume = self.unwarp(img.brik.volume, scales)
+
+    #header of the PLACE corrected version of a scan: written in native byte order (same as save()), float32 with
+    #floatout. Also returns the scales the unwarped values need (see floathead()), None unless floatout
+    def correctedhead(self, dset_head):
+        scales = None
+        if self.floatout:
+            corrected_head, scales = floathead(dset_head)
+        else:
+            corrected_head = copy.deepcopy(dset_head)
+        if sys.byteorder == 'little':
+            corrected_head.byte_order = 'IEEE-LE'
+            endianness = 'LSB_FIRST'
+        else:
+            corrected_head.byte_order = 'IEEE-BE'
+            endianness = 'MSB_FIRST'
+        if endianness not in corrected_head.BYTEORDER_STRING[2]:
+            corrected_head.BYTEORDER_STRING = 'string-attribute', 10, "'" + endianness + "~"
+        return corrected_head, scales
+
+    #unwarps sub-bricks t1 to t2 of the input .BRIK into the (already big enough) output .BRIK, tchunk sub-bricks at a
+    #time through memory maps
+    def __unwarpbrik(self, brik_path, dset_head, corrected_brik_path, corrected_head, scales, t1, t2):
+        tchunk = self.tchunk
+        if not tchunk or tchunk < 1:
+            tchunk = t2 - t1
+
+        for c1 in range(t1, t2, tchunk):
+            c2 = min(c1 + tchunk, t2)
+            inchunk = afni.mapbrik(brik_path, dset_head, 'r', nt = c2-c1, t0 = c1)
+            outchunk = afni.mapbrik(corrected_brik_path, corrected_head, 'r+', nt = c2-c1, t0 = c1)
+
+            placeunwarpall(inchunk, self.unwarpmatrix, outchunk, tchunk, self.threads, self.slabs, self.rounding,
+                           None if scales is None else scales[c1:c2], self.threadpool())
+
+            outchunk.flush()
+            del inchunk, outchunk
+
+    #Streaming version of the load(), unwarp, save() sequence. Only tchunk sub-bricks of the input .BRIK and of the
+    #output .BRIK are memory mapped at any time, so memory use is set by tchunk and not by the length of the run. The
+    #output .BRIK is written in native byte order (same as save()) and the .HEAD is written last, once the .BRIK is complete
+    def streamscan(self, epi, dset_head, save_path):
+        ntimes = dset_head.DATASET_RANK[2][1]
+        corrected_head, scales = self.correctedhead(dset_head)
+
+        brik_path = epi[:-len('.HEAD')] + '.BRIK'
+        corrected_path = save_path[:-len('.HEAD')]
+
+        #allocate the whole output .BRIK up front (sparse file), then fill it chunk by chunk
+        volumebytes = np.prod(dset_head.DATASET_DIMENSIONS[2][:3])*np.dtype(corrected_head.dtype).itemsize
+        BRIK = open(corrected_path + '.BRIK', 'wb')
+        BRIK.truncate(int(volumebytes*ntimes))
+        BRIK.close()
+
+        self.__unwarpbrik(brik_path, dset_head, corrected_path + '.BRIK', corrected_head, scales, 0, ntimes)
+
+        afni.savehead(corrected_head, corrected_path)
+
+    #Incremental correction of a scan that is still being acquired. Every poll seconds the sub-bricks completed in the
+    #input .BRIK since the last look (its size over the size of one volume) are unwarped and appended to the _pc .BRIK,
+    #then the _pc .HEAD is replaced (a new one is renamed over it) by one for the sub-bricks done so far. The .BRIK is
+    #always extended before the .HEAD that points into it, so AFNI can display the corrected run at any time while it
+    #grows. The input .HEAD is read again on every look in case the scanner rewrites it. Stops once the input .BRIK has
+    #not grown for idle seconds. Returns 1 if the scan was skipped and 0 if it was corrected. The output has to be
+    #visible while it grows, so it is never staged (see correctall()): with lost it stops with an afni.Error before the
+    #next sub-bricks are written once lost.is_set()
+    def follow(self, epi, save_dir, poll = 0.5, idle = 10.0, log = None, lost = None):
+        if log is None:
+            log = self.log
+
+        report = datasetreport(epi)
+        with reportfailure(save_dir, report):
+            with measureStage(report, 'load') as stage:
+                scan = placeload(epi, self.placepars, save_dir, True, log, report)
+                stage['bytes_read'] = os.path.getsize(epi)
+            if scan is None:
+                reportdataset(save_dir, report, 'skipped', report.get('reason'))
+                return 1
+            dset_head, save_path = scan
+
+            brik_path = epi[:-len('.HEAD')] + '.BRIK'
+            corrected_path = save_path[:-len('.HEAD')]
+            corrected_brik_path = corrected_path + '.BRIK'
+            temp_path = os.path.join(os.path.dirname(corrected_path), '.' + os.path.basename(corrected_path) + '.growing')
+            nvox = np.prod(self.placepars[:3])
+
+            printandlog('Following ' + epi + ' while it grows', log)
+            open(corrected_brik_path, 'wb').close()
+            done = 0
+            grown = time.time()
+            with measureStage(report, 'follow') as stage:
+                while True:
+                    try:
+                        dset_head = afni.head(epi)
+                    except Exception:
+                        #the scanner is rewriting it, the last good one will do
+                        pass
+                    try:
+                        available = os.path.getsize(brik_path) // (nvox*np.dtype(dset_head.dtype).itemsize)
+                    except OSError:
+                        available = 0
+
+                    if available > done:
+                        if lost is not None and lost.is_set():
+                            raise afni.Error('Lost the lease, stopped following ' + epi + ' after ' + str(done) +
+                                             ' sub-bricks')
+                        in_head = subbrickhead(dset_head, available)
+                        corrected_head, scales = self.correctedhead(in_head)
+
+                        BRIK = open(corrected_brik_path, 'r+b')
+                        BRIK.truncate(int(nvox*np.dtype(corrected_head.dtype).itemsize*available))
+                        BRIK.close()
+                        self.__unwarpbrik(brik_path, in_head, corrected_brik_path, corrected_head, scales, done, available)
+
+                        afni.savehead(corrected_head, temp_path)
+                        os.rename(temp_path + '.HEAD', corrected_path + '.HEAD')
+                        printandlog('Corrected sub-bricks ' + str(done) + ' to ' + str(available - 1), log)
+                        done = available
+                        grown = time.time()
+                    elif time.time() - grown > idle:
+                        break
+                    else:
+                        time.sleep(poll)
+                stage['bytes_read'] = int(nvox*np.dtype(dset_head.dtype).itemsize*done)
+
+            if not done:
+                os.remove(corrected_brik_path)
+                printandlog('No complete sub-brick ever showed up in ' + brik_path + ', PLACE correction was NOT done for: ' + epi, log)
+                reportdataset(save_dir, report, 'skipped', 'no complete sub-brick showed up')
+                return 1
+
+            stage['bytes_written'] = dsetbytes(save_path)
+            report['output'] = save_path
+            report['voxels'] = int(nvox*done)
+            placesaved(epi, save_path, log)
+        reportdataset(save_dir, report, 'corrected')
+        return 0
+
+    #-------------------- datasets --------------------
+
+    #loads, unwarps and saves one dataset, returns 1 if the dataset was skipped and 0 if it was corrected
+    #with stream = True the scan is never loaded, see streamscan(). With a tag it is saved to stagedpath(), see
+    #correctall()
+    def correct(self, epi, save_dir, stream = False, log = None, tag = None):
+        if log is None:
+            log = self.log
+
+        report = datasetreport(epi)
+        with reportfailure(save_dir, report):
+            with measureStage(report, 'load') as stage:
+                scan = placeload(epi, self.placepars, save_dir, stream, log, report)
+                stage['bytes_read'] = os.path.getsize(epi) if stream else dsetbytes(epi)
+            if scan is None:
+                reportdataset(save_dir, report, 'skipped', report.get('reason'))
+                return 1
+            img, save_path = scan
+            report['output'] = save_path
+            dset_head = img if stream else img.head
+            report['voxels'] = int(np.prod(self.placepars[:3])*dset_head.DATASET_RANK[2][1])
+            write_path = save_path if tag is None else stagedpath(save_path, tag)
+
+            try:
+                if stream:
+                    with measureStage(report, 'stream') as stage:
+                        self.streamscan(epi, img, write_path)
+                        stage['bytes_read'] = dsetbytes(epi) - os.path.getsize(epi)
+                        stage['bytes_written'] = dsetbytes(write_path)
+                else:
+                    with measureStage(report, 'unwarp'):
+                        self.unwarpscan(img)
+                    with measureStage(report, 'save') as stage:
+                        img.save(write_path)
+                        stage['bytes_written'] = dsetbytes(write_path)
+            except:
+                if tag is not None:
+                    removedset(write_path)
+                raise
+
+            placesaved(epi, save_path, log)
+        reportdataset(save_dir, report, 'corrected')
+        return 0
+
+    #corrects a list of datasets one after the other, in a pipeline (pipeline = queue depth) or in jobs worker
+    #processes (0 = one per CPU). Log lines always end up in input order. With follow = True every dataset is
+    #followed while it grows (see follow()), one after the other. Every corrected dataset is recorded in the
+    #save_dir manifest, with resume = True datasets whose output the manifest verifies are skipped and missing, stale or
+    #corrupt outputs are redone (see the batch manifest section). Returns the number of skipped datasets
+    #
+    #lost is for runs that may only write while they hold something (the lease of a service job, see runqueued()): an
+    #object whose is_set() is True once they don't anymore. Scans are then written under a temporary name (see
+    #stagedpath()) and only renamed into place and added to the manifest, one by one in input order, while lost isn't
+    #set. Once it is the run stops with an afni.Error, and the scans still under their temporary name are removed
+    def correctall(self, dsets, save_dir, jobs = 1, pipeline = 0, stream = False, follow = False, resume = False,
+                   log = None, lost = None):
+        if log is None:
+            log = self.log
+
+        time1 = time.time()
+        ndsets = len(dsets)
+        manifest = readmanifest(save_dir)
+        tag = 'placing-' + uuid.uuid4().hex[:8] if lost is not None and not follow else None
+        #called in input order for every dataset that got corrected
+        def corrected(epi):
+            if lost is not None:
+                save_path = correctedpath(epi, save_dir)
+                if lost.is_set():
+                    raise afni.Error('Lost the lease, ' + save_path + ' and the scans after it were not saved')
+                if tag is not None:
+                    renamedset(stagedpath(save_path, tag), save_path)
+            addtomanifest(save_dir, *self.record(epi, save_dir))
+
+        skipped = 0
+        if resume:
+            #a redo removes the output first, so two inputs with the same output would keep replacing each other's
+            outputs = {}
+            for epi in dsets:
+                save_path = correctedpath(epi, save_dir)
+                if save_path and save_path in outputs:
+                    raise afni.Error('Both ' + outputs[save_path] + ' and ' + epi + ' would be saved to ' + save_path +
+                                     ', nothing was corrected')
+                outputs[save_path] = epi
+            todo = []
+            for epi in dsets:
+                save_path = correctedpath(epi, save_dir)
+                reason = self.stale(manifest, epi, save_path)
+                if reason is None:
+                    printandlog('\nVerified against the manifest, not redoing: ' + save_path, log)
+                    reportdataset(save_dir, datasetreport(epi), 'skipped', 'verified against the manifest')
+                    skipped += 1
+                    continue
+                if save_path and (os.path.exists(save_path) or os.path.exists(save_path[:-len('.HEAD')] + '.BRIK')):
+                    printandlog('\nRedoing ' + save_path + ' (' + reason + ')', log)
+                    removedset(save_path)
+                todo.append(epi)
+            dsets = todo
+
+        if jobs < 1:
+            jobs = multiprocessing.cpu_count()
+        #the pipeline overlaps load() and save() of whole scans: streamed and followed scans are never loaded whole, and
+        #worker processes already overlap them
+        if pipeline > 0 and len(dsets) > 1 and (follow or stream or jobs > 1):
+            printandlog('Not using a pipeline (queue depth: ' + str(pipeline) + ') with ' +
+                        ('follow' if follow else 'stream' if stream else str(jobs) + ' worker processes'), log)
+        try:
+            if follow:
+                for epi in dsets:
+                    if self.follow(epi, save_dir, log = log, lost = lost):
+                        skipped += 1
+                    else:
+                        corrected(epi)
+            elif (jobs == 1 or len(dsets) == 1) and pipeline > 0 and not stream and len(dsets) > 1:
+                printandlog('Loading, unwarping and saving scans in a pipeline (queue depth: ' + str(pipeline) + ')', log)
+                skipped += self.__pipeline(dsets, save_dir, pipeline, log, corrected, tag)
+            elif jobs == 1 or len(dsets) <= 1:
+                for epi in dsets:
+                    if self.correct(epi, save_dir, stream, log, tag):
+                        skipped += 1
+                    else:
+                        corrected(epi)
+            else:
+                jobs = min(jobs, len(dsets))
+                printandlog('Correcting ' + str(len(dsets)) + ' scans with ' + str(jobs) + ' worker processes', log)
+
+                worker.update(corrector = self, save_dir = save_dir, stream = stream, tag = tag)
+                pool = multiprocessing.Pool(jobs)
+                try:
+                    for epi, (dsetlog, dsetskipped) in zip(dsets, pool.imap(placeworker, dsets)):
+                        log.extend(dsetlog)
+                        if dsetskipped:
+                            skipped += 1
+                        else:
+                            corrected(epi)
+                finally:
+                    pool.terminate()
+                    pool.join()
+                    worker.clear()
+        except:
+            #scans written under their temporary name that never made it into place
+            if tag is not None:
+                for epi in dsets:
+                    if correctedpath(epi, save_dir):
+                        removedset(stagedpath(correctedpath(epi, save_dir), tag))
+            raise
+
+        options = OrderedDict([('jobs', jobs), ('pipeline', pipeline), ('stream', stream), ('follow', follow),
+                               ('resume', resume)])
+        appendreport(save_dir, 'run', OrderedDict([
+            ('datasets', ndsets), ('corrected', ndsets - skipped), ('skipped', skipped), ('seconds', time.time() - time1),
+            ('options', options), ('corrector', self.description()), ('unwarpmatrix', self.matrixreport),
+            ('peak_rss_mb', peakmemory())]))
+        return skipped
+
+    #--------------------------- batch manifest ----------------------
+    #what the output of this corrector depends on besides the input: the Dmap/ParScan and the settings that change values
+    #(threads and chunking give identical results)
+    def settings(self):
+        return {'precision': self.precision, 'rounding': self.rounding, 'floatout': self.floatout}
+
+    #everything about this corrector, for the run report
+    def description(self):
+        return OrderedDict([('dmap', os.path.abspath(self.dmap_path)), ('parscan', os.path.abspath(self.parscan_path)),
+                            ('placepars', self.placepars), ('precision', self.precision),
+                            ('rounding', self.rounding), ('floatout', self.floatout), ('tchunk', self.tchunk),
+                            ('threads', self.threads)])
+
+    #manifest (name, entry) for the just corrected output of epi
+    def record(self, epi, save_dir):
+        save_path = correctedpath(epi, save_dir)
+        return os.path.basename(save_path), {
+            'input': os.path.abspath(epi), 'input_sha1': dsetsha1(epi), 'dmap': os.path.abspath(self.dmap_path),
+            'dmap_sha1': self.dmapsha1, 'settings': self.settings(), 'version': version,
+            'output_sha1': dsetsha1(save_path), 'completed': time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())}
+
+    #None if the manifest verifies the output of epi (same input, Dmap/ParScan, settings and PLACE version, and the output
+    #still has the checksum it was written with), otherwise why it has to be redone
+    def stale(self, manifest, epi, save_path):
+        if save_path is None:
+            return 'no output name'
+        if not (os.path.exists(save_path) and os.path.exists(save_path[:-len('.HEAD')] + '.BRIK')):
+            return 'missing'
+        entry = manifest['outputs'].get(os.path.basename(save_path))
+        if entry is None:
+            return 'not in the manifest, may be incomplete'
+        if entry['version'] != version:
+            return 'made by PLACE ' + entry['version']
+        if entry['dmap_sha1'] != self.dmapsha1:
+            return 'made with a different Dmap/ParScan'
+        if entry['settings'] != self.settings():
+            return 'made with different settings'
+        if entry['input_sha1'] != dsetsha1(epi):
+            return 'input changed'
+        if entry['output_sha1'] != dsetsha1(save_path):
+            return 'output corrupt'
+        return None
+
+    #--------------------------- pipelined batch ----------------------
+    #While scan N is unwarped a reader thread is already loading scan N+1 and a writer thread is still saving scan N-1,
+    #so the disk and the CPU are busy at the same time. The stages are connected by queues holding at most depth scans
+    #each. Every scan keeps its own log section, the writer adds them to log in input order and calls corrected(epi) for
+    #every scan it saved. Returns the number of skipped scans
+    #
+    #Scans travel through the queues as (epi, scan, log, report, failure) in input order. A stage that fails on a scan passes the
+    #exception on in place of the scan and stops working on later ones (but keeps draining its queue so nothing blocks),
+    #so just like a plain loop every scan before the failing one still gets saved and the exception is raised at the end
+    def __pipeline(self, dsets, save_dir, depth, log, corrected, tag = None):
+        loaded = Queue.Queue(depth)
+        unwarped = Queue.Queue(depth)
+        stop = threading.Event()
+        failures = []
+        #outputs of the scans already loaded: the reader is ahead of the writer, so a later scan with the same output
+        #name would not find the file yet
+        claimed = set()
+
+        def reader():
+            for epi in dsets:
+                if stop.is_set():
+                    break
+                scanlog = []
+                report = datasetreport(epi)
+                try:
+                    with measureStage(report, 'load') as stage:
+                        scan = placeload(epi, self.placepars, save_dir, log = scanlog, report = report,
+                                         claimed = claimed)
+                        stage['bytes_read'] = dsetbytes(epi)
+                    loaded.put((epi, scan, scanlog, report, None))
+                    del scan
+                except:
+                    loaded.put((epi, None, scanlog, report, sys.exc_info()))
+                    break
+            loaded.put(None)
+
+        def writer():
+            while True:
+                item = unwarped.get()
+                if item is None:
+                    break
+                epi, scan, scanlog, report, failure = item
+                del item
+                if stop.is_set() and not failure:
+                    continue
+                if failure:
+                    failures.append(failure)
+                    stop.set()
+                    reportdataset(save_dir, report, 'failed', failurereason(failure))
+                    continue
+                try:
+                    if scan is not None:
+                        img, save_path = scan
+                        report['output'] = save_path
+                        report['voxels'] = int(np.prod(self.placepars[:3])*img.head.DATASET_RANK[2][1])
+                        write_path = save_path if tag is None else stagedpath(save_path, tag)
+                        with measureStage(report, 'save') as stage:
+                            try:
+                                img.save(write_path)
+                            except:
+                                if tag is not None:
+                                    removedset(write_path)
+                                raise
+                            stage['bytes_written'] = dsetbytes(write_path)
+                        placesaved(epi, save_path, scanlog)
+                    log.extend(scanlog)
+                    if scan is not None:
+                        corrected(epi)
+                        reportdataset(save_dir, report, 'corrected')
+                    else:
+                        reportdataset(save_dir, report, 'skipped', report.get('reason'))
+                except:
+                    failures.append(sys.exc_info())
+                    stop.set()
+                    reportdataset(save_dir, report, 'failed', failurereason(failures[-1]))
+                del scan
+
+        stages = [threading.Thread(target = reader), threading.Thread(target = writer)]
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
+
+        skipped = 0
+        failed = False
+        while True:
+            item = loaded.get()
+            if item is None:
+                break
+            if failed or stop.is_set():
+                continue
+            epi, scan, scanlog, report, failure = item
+            if failure:
+                failed = True
+            elif scan is None:
+                skipped += 1
+            else:
+                try:
+                    with measureStage(report, 'unwarp'):
+                        self.unwarpscan(scan[0])
+                except:
+                    item = (epi, None, scanlog, report, sys.exc_info())
+                    failed = True
+                    stop.set()
+            unwarped.put(item)
+            del item, scan
+        unwarped.put(None)
+
+        for stage in stages:
+            stage.join()
+
+        if failures:
+            raise failures[0][0], failures[0][1], failures[0][2]
+        return skipped
+
+#--------------------------- worker processes ----------------------
+#correctall() fills this in and only then starts the pool, so the forked workers inherit the corrector and its unwarp
+#matrix (copy on write, and it is only ever read) instead of having it pickled over to every one of them
+worker = {}
+
+#runs in a worker: corrects one dataset and hands back its section of the log, the parent puts the sections together in
+#input order
+def placeworker(epi):
+    log = []
+    skipped = worker['corrector'].correct(epi, worker['save_dir'], worker['stream'], log, worker['tag'])
+    return log, skipped
+
+#======================== watch mode ========================
+#watch() corrects scans as they land in a directory (i.e. the session directory at the scanner), so nobody has to start
+#PLACE after every run. The directory is polled every poll seconds (python 2 has no inotify in the standard library and
+#polling also works on network filesystems). A .HEAD/.BRIK pair is corrected once
+#   1) the .HEAD can be read and the .BRIK holds every sub-brick the .HEAD promises, and
+#   2) neither file has changed size or mtime for settle seconds
+#It is corrected with the corrector whose ParScan matches its DATASET_DIMENSIONS, so one watch can serve several
+#Dmap/ParScan pairs. Scans that already have a _pc version in save_dir are left alone, _pc datasets themselves are
+#never picked up. The log of the whole watch is rewritten to save_dir/PLACE_log.txt after every scan, corrected
+#scans are recorded in the save_dir manifest just like correctall() does and every scan gets a dataset record in the
+#run report
+
+#(size, mtime) of the .HEAD and .BRIK if both are there and the .BRIK is as big as the .HEAD says, otherwise None
+def dsetstamp(epi):
+    brik_path = epi[:-len('.HEAD')] + '.BRIK'
+    try:
+        head_stat = os.stat(epi)
+        brik_stat = os.stat(brik_path)
+        dset_head = afni.head(epi)
+        volumebytes = np.prod(dset_head.DATASET_DIMENSIONS[2][:3])*np.dtype(dset_head.dtype).itemsize
+        complete = brik_stat.st_size >= volumebytes*dset_head.DATASET_RANK[2][1]
+    except Exception:
+        #not there yet, or the .HEAD is still being written
+        return None
+    if not complete:
+        return None
+    return (head_stat.st_size, head_stat.st_mtime, brik_stat.st_size, brik_stat.st_mtime)
+
+#watches watch_dir until interrupted (or, with once = True, until there is nothing left to wait for). correctors is a
+#list of corrector instances, at most one per scan dimensions. With follow = True scans are picked up as soon as their
+#.HEAD can be read and followed while they grow (see corrector.follow()) instead of waiting for them to be complete
+def watch(watch_dir, correctors, save_dir = None, poll = 0.5, settle = 1.0, stream = False, follow = False, once = False,
+          log = None):
+    if log is None:
+        log = loglist
+    if not save_dir:
+        save_dir = watch_dir
+
+    bydims = {}
+    for pc in correctors:
+        dims = tuple(pc.placepars[:3])
+        if dims in bydims:
+            raise afni.Error('Two of the Dmap/ParScan pairs have the same dimensions ' + str(dims) + ': ' +
+                             bydims[dims].parscan_path + ' and ' + pc.parscan_path)
+        bydims[dims] = pc
+
+    printandlog('Watching ' + os.path.abspath(watch_dir) + ' for scans of dimensions ' +
+                ', '.join(str(dims) for dims in sorted(bydims)) + ', saving to ' + save_dir, log)
+
+    #epi -> (stamp, time the stamp was first seen)
+    pending = {}
+    done = set()
+    try:
+        while True:
+            for name in sorted(os.listdir(watch_dir)):
+                epi = os.path.join(watch_dir, name)
+                if not name.endswith('.HEAD') or '_pc+' in name or epi in done:
+                    continue
+                save_path = correctedpath(epi, save_dir)
+                if save_path is None or os.path.exists(save_path):
+                    done.add(epi)
+                    continue
+
+                if follow:
+                    try:
+                        afni.head(epi)
+                    except Exception:
+                        continue
+                else:
+                    stamp = dsetstamp(epi)
+                    if stamp is None or epi not in pending or pending[epi][0] != stamp:
+                        pending[epi] = (stamp, time.time())
+                        continue
+                    if time.time() - pending[epi][1] < settle:
+                        continue
+                    complete = pending.pop(epi)[1]
+                done.add(epi)
+
+                dims = tuple(afni.head(epi).DATASET_DIMENSIONS[2][:3])
+                if dims not in bydims:
+                    printandlog('\nNo Dmap/ParScan for scan: ' + epi + ' (dimensions ' + str(dims) + '), skipping it', log)
+                    reportdataset(save_dir, datasetreport(epi), 'skipped', 'no Dmap/ParScan for dimensions ' + str(dims))
+                else:
+                    try:
+                        if follow:
+                            skipped = bydims[dims].follow(epi, save_dir, poll, log = log)
+                        else:
+                            skipped = bydims[dims].correct(epi, save_dir, stream, log)
+                            if not skipped:
+                                printandlog('Corrected %0.2f seconds after the scan was complete' % (time.time() - complete), log)
+                        if not skipped:
+                            addtomanifest(save_dir, *bydims[dims].record(epi, save_dir))
+                    except Exception:
+                        #a bad scan must not stop the watch
+                        printandlog('PLACE correction of ' + epi + ' failed!\n' + traceback.format_exc(), log)
+                writelog(os.path.join(save_dir, 'PLACE_log.txt'), list(log))
+
+            if once and not pending:
+                break
+            time.sleep(poll)
+    except KeyboardInterrupt:
+        pass
+    printandlog('Stopped watching ' + os.path.abspath(watch_dir), log)
+
+#======================== service mode ========================
+#serve() keeps one process running that works through job files in a queue directory. Correctors (and with them the
+#unwarp matrices) are kept warm between jobs, keyed by the Dmap/ParScan paths, their size and mtime and the corrector
+#options, so only the first job for a Dmap pays for building or loading the matrix (and with the default cache_dir every
+#worker after the first one loads it from the cache next to the Dmap).
+#
+#A job is a <name>.json file:
+#   {"dsets": [".../EPI_E07+orig.HEAD", ...], "dmap": ".../Dmap", "parscan": ".../ParScan", "save_dir": "...",
+#    "options": {"jobs": 4, "precision": "float32", ...}}
+#options are any of corrector_options and run_options. Job files are picked up in name order, submit() names them by
+#submission time.
+#
+#The queue needs nothing but the filesystem, so any number of workers on any number of hosts can share one queue
+#directory on NFS without a coordinator:
+#   <name>.json           waiting
+#   <name>.json.running   claimed by a worker by renaming the .json (only one rename can win). The worker adds its name
+#                         and the attempt number to it and touches it every lease/4 seconds while the job runs
+#   <name>.json.done      the job, the worker that ran it, the number of corrected/skipped scans and the log
+#   <name>.json.failed    the job and the error
+#A .running file that hasn't been touched for lease seconds belongs to a worker that died: the next worker to notice
+#renames it back to <name>.json so it is run again, or fails it after attempts tries. Ages are measured in the file
+#server's clock (see fstime()), not in the clocks of the hosts. A worker that finds its lease gone doesn't write a
+#result, so every job gets exactly one, and it doesn't save any more scans either: they are written under a temporary
+#name and only renamed into place while the lease is held (see correctall() and leaselost). submit(..., split = True) makes one job per dataset so a batch is spread over
+#all the workers, these jobs resume by default so the rerun of a dataset whose worker died replaces its partial output
+#(see the batch manifest section) and each writes its own <dataset>_PLACE_log.txt to save_dir instead of PLACE_log.txt
+corrector_options = ['precision', 'rounding', 'floatout', 'tchunk', 'threads', 'cache_dir', 'usecache']
+run_options = ['jobs', 'pipeline', 'stream', 'follow', 'resume']
+
+#name of this worker in job and result files
+def workerid():
+    return socket.gethostname() + '-' + str(os.getpid())
+
+#current time in the clock of the filesystem a directory is on (the mtime of a file created there), which is the clock
+#the mtimes of files on a shared filesystem are in no matter which host touched them
+def fstime(directory):
+    fd, clock_path = tempfile.mkstemp(prefix = '.clock-', dir = directory)
+    os.close(fd)
+    now = os.path.getmtime(clock_path)
+    os.remove(clock_path)
+    return now
+
+def readjson(path):
+    f = open(path, 'r')
+    content = json.load(f)
+    f.close()
+    return content
+
+#writes a job or result file under a name serve() ignores and renames it into place, so nobody ever sees it half written
+def writejson(path, content):
+    fd, tmp_path = tempfile.mkstemp(prefix = '.' + os.path.basename(path), dir = os.path.dirname(path))
+    f = os.fdopen(fd, 'w')
+    json.dump(content, f, indent = 1)
+    f.close()
+    os.rename(tmp_path, path)
+
+#writes a job file for serve() and returns its path. With split = True there is one job per dataset (resuming unless
+#the options say otherwise) and a list of their paths is returned
+def submit(queue_dir, dsets, dmap_path, parscan_path, save_dir, split = False, **options):
+    unknown = [option for option in options if option not in corrector_options + run_options]
+    if unknown:
+        raise afni.Error('Unknown PLACE job options: ' + ', '.join(unknown))
+
+    job = {'dsets': [os.path.abspath(epi) for epi in dsets], 'dmap': os.path.abspath(dmap_path),
+           'parscan': os.path.abspath(parscan_path), 'save_dir': os.path.abspath(save_dir), 'options': options}
+
+    if not os.path.isdir(queue_dir):
+        os.makedirs(queue_dir)
+    name = time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:8]
+
+    if not split:
+        job_path = os.path.join(queue_dir, name + '.json')
+        writejson(job_path, job)
+        return job_path
+
+    job_paths = []
+    options = dict(options)
+    options.setdefault('resume', True)
+    for i, epi in enumerate(job['dsets']):
+        dset_job = dict(job, dsets = [epi], options = options,
+                        log_name = os.path.basename(epi)[:-len('.HEAD')] + '_PLACE_log.txt')
+        job_paths.append(os.path.join(queue_dir, name + '-%05d.json' % i))
+        writejson(job_paths[-1], dset_job)
+    return job_paths
+
+#runs one job with a warm corrector (building one if there is none for this Dmap/ParScan yet), returns the result. lost
+#is passed on to correctall()
+def runjob(job, correctors, keep = 4, lost = None):
+    options = job.get('options', {})
+    unknown = [option for option in options if option not in corrector_options + run_options]
+    if unknown:
+        raise afni.Error('Unknown PLACE job options: ' + ', '.join(unknown))
+    dsets = job['dsets']
+    save_dir = job['save_dir']
+
+    log = []
+    stamps = [(os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)) for path in (job['dmap'], job['parscan'])]
+    key = json.dumps([stamps, sorted((option, options[option]) for option in options if option in corrector_options)])
+    if key in correctors:
+        pc = correctors.pop(key)
+        printandlog('Using the warm corrector for Dmap ' + job['dmap'], log)
+    else:
+        pc = corrector(job['dmap'], job['parscan'], log = log,
+                       **dict((option, options[option]) for option in options if option in corrector_options))
+    correctors[key] = pc
+    while len(correctors) > keep:
+        correctors.popitem(last = False)[1].close()
+
+    printandlog("Dataset list: " + str(dsets) + "\n", log)
+    printandlog("Save Directory: " + save_dir + "\n", log)
+
+    time1 = time.time()
+    skipped = pc.correctall(dsets, save_dir, log = log, lost = lost,
+                            **dict((option, options[option]) for option in options if option in run_options))
+    time2 = time.time()
+
+    printandlog('\nPhew finished converting ' + str(len(dsets)-skipped) + ' scans\n', log)
+    printandlog('Entire conversion took: ' + str((time2-time1)) + ' seconds\n', log)
+
+    result = {'job': job, 'corrected': len(dsets)-skipped, 'skipped': skipped, 'seconds': time2-time1, 'log': list(log)}
+    writelog(os.path.join(save_dir, job.get('log_name', 'PLACE_log.txt')), log)
+    return result
+
+#True as long as the .running file is still the one this worker claimed (its lease hasn't expired and been taken over)
+def ownlease(running_path, me, attempt):
+    try:
+        job = readjson(running_path)
+    except (IOError, OSError, ValueError):
+        return False
+    return job.get('worker') == me and job.get('attempt') == attempt
+
+#runs in a thread next to a job: touches its .running file every interval seconds until stop is set, sets lost (and
+#stops) if the lease was taken away
+def heartbeat(running_path, me, attempt, interval, stop, lost):
+    while not stop.wait(interval):
+        if not ownlease(running_path, me, attempt):
+            lost.set()
+            return
+        try:
+            os.utime(running_path, None)
+        except OSError:
+            lost.set()
+            return
+
+#the lost that runqueued() hands to runjob(): also reads the .running file whenever it is asked, so a worker that stalled
+#past its lease (and its heartbeats with it) finds out before it saves anything
+class leaselost:
+    def __init__(self, running_path, me, attempt, lost):
+        self.running_path = running_path
+        self.me = me
+        self.attempt = attempt
+        self.lost = lost
+
+    def is_set(self):
+        if not self.lost.is_set() and not ownlease(self.running_path, self.me, self.attempt):
+            self.lost.set()
+        return self.lost.is_set()
+
+#claims and runs the waiting job <name>.json, returns False if another worker claimed it first
+def runqueued(queue_dir, name, me, correctors, keep = 4, lease = 60.0, attempts = 3):
+    job_path = os.path.join(queue_dir, name)
+    running_path = job_path + '.running'
+    try:
+        os.rename(job_path, running_path)
+    except OSError:
+        #somebody else got there first
+        return False
+
+    job = None
+    try:
+        job = readjson(running_path)
+        job['worker'] = me
+        job['attempt'] = job.get('attempt', 0) + 1
+        writejson(running_path, job)
+    except Exception:
+        print 'PLACE job ' + job_path + ' could not be read!'
+        writejson(job_path + '.failed', {'job': job, 'worker': me, 'error': traceback.format_exc()})
+        os.remove(running_path)
+        return True
+
+    if job['attempt'] > attempts:
+        print 'Giving up on PLACE job ' + job_path + ' after ' + str(attempts) + ' attempts'
+        writejson(job_path + '.failed', {'job': job, 'worker': me,
+                                         'error': 'Gave up after ' + str(attempts) + ' attempts, the workers running it stopped renewing their lease'})
+        os.remove(running_path)
+        return True
+
+    print '\nRunning PLACE job: ' + job_path + ' (attempt ' + str(job['attempt']) + ')'
+    stop = threading.Event()
+    lost = threading.Event()
+    beat = threading.Thread(target = heartbeat, args = (running_path, me, job['attempt'], lease/4.0, stop, lost))
+    beat.daemon = True
+    beat.start()
+    try:
+        result = runjob(job, correctors, keep, leaselost(running_path, me, job['attempt'], lost))
+        result_path = job_path + '.done'
+    except Exception:
+        print 'PLACE job ' + job_path + ' failed!'
+        traceback.print_exc()
+        result = {'job': job, 'error': traceback.format_exc()}
+        result_path = job_path + '.failed'
+    stop.set()
+    beat.join()
+
+    if lost.is_set() or not ownlease(running_path, me, job['attempt']):
+        print 'Lost the lease on PLACE job ' + job_path + ', leaving it to whoever has it now'
+        return True
+    result['worker'] = me
+    writejson(result_path, result)
+    os.remove(running_path)
+    return True
+
+#works through the queue directory until interrupted (or, with once = True, until no job is waiting or running). keep
+#is the number of correctors kept warm, least recently used ones are dropped first. lease and attempts are explained
+#above, lease has to be the same for all workers sharing a queue
+def serve(queue_dir, poll = 1.0, keep = 4, once = False, lease = 60.0, attempts = 3):
+    if not os.path.isdir(queue_dir):
+        os.makedirs(queue_dir)
+    correctors = OrderedDict()
+    me = workerid()
+
+    print 'PLACE ' + version + ' worker ' + me + ' working through ' + os.path.abspath(queue_dir)
+    try:
+        while True:
+            names = sorted(name for name in os.listdir(queue_dir) if not name.startswith('.'))
+            waiting = [name for name in names if name.endswith('.json')]
+            running = [name for name in names if name.endswith('.json.running')]
+
+            #requeue the jobs of dead workers
+            if running:
+                now = fstime(queue_dir)
+                for name in running:
+                    running_path = os.path.join(queue_dir, name)
+                    try:
+                        if now - os.path.getmtime(running_path) > lease:
+                            os.rename(running_path, running_path[:-len('.running')])
+                            print 'Lease on PLACE job ' + running_path + ' expired, it goes back into the queue'
+                            waiting.append(name[:-len('.running')])
+                    except OSError:
+                        #finished or requeued by somebody else in the meantime
+                        pass
+
+            ran = False
+            for name in sorted(waiting):
+                if runqueued(queue_dir, name, me, correctors, keep, lease, attempts):
+                    ran = True
+                    break
+
+            if not ran:
+                if once and not waiting and not running:
+                    break
+                time.sleep(poll)
+    except KeyboardInterrupt:
+        pass
+    print 'PLACE worker ' + me + ' stopped'
+
+def main():
+    parser = argparse.ArgumentParser(description = 'PLACE correction worker: runs the PLACE jobs in a queue directory (which any number of workers on any number of hosts can share), keeping unwarp matrices in memory between jobs')
+    parser.add_argument('queue_dir', help = 'directory to take <name>.json job files from')
+    parser.add_argument('--poll', type = float, default = 1.0, help = 'seconds between looks at an empty queue (default: 1)')
+    parser.add_argument('--keep', type = int, default = 4, help = 'number of Dmap/ParScan unwarp matrices kept in memory (default: 4)')
+    parser.add_argument('--once', action = 'store_true', help = 'stop once no job is waiting or running instead of waiting for more jobs')
+    parser.add_argument('--lease', type = float, default = 60.0, help = 'seconds after which the job of a worker that stopped renewing its lease is run again (default: 60, same for all workers)')
+    parser.add_argument('--attempts', type = int, default = 3, help = 'number of times a job is tried before it is failed (default: 3)')
+
+    args = parser.parse_args()
+
+    serve(args.queue_dir, poll = args.poll, keep = args.keep, once = args.once, lease = args.lease,
+          attempts = args.attempts)
+
+if __name__ == "__main__":
+    main()
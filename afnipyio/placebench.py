@@ -0,0 +1,476 @@
+#!/usr/bin/env python2.7
+
+# AFNIpyIO PLACE benchmark
+# Times the PLACE unwarp on synthetic scans and checks every execution mode against a frozen copy of the original
+# PLACE algorithm
+# developed and tested on python2.7
+
+# Required modules: numpy, scipy, AFNIPyIO
+
+# afnipyio.place can do the same correction in many ways (float32 or float64, threads, streaming, pipelines, worker
+# processes) and none of them is allowed to change what PLACE computes. benchmark():
+#   1) writes a synthetic Dmap, ParScan and a few EPI runs for every geometry into a scratch directory (a smooth
+#      distortion of a few voxels that wraps around in phase, int16 scans)
+#   2) times unwarp matrix construction and checks makeunwarpmatrix() against refmakeunwarpmatrix()
+#   3) times per volume unwarping for every precision/threads setting and checks it against refplaceunwarp()
+#   4) times whole datasets through corrector.correctall() in every mode and checks the _pc datasets against datasets
+#      corrected with the reference code (with dsetdiff)
+# float64 precision with truncate rounding has to be bit identical to the reference. Other settings have to be within
+# their tolerance: 1 for integer scans rounded to nearest, float32 round off for float scans.
+
+# usage example:
+#   from afnipyio import placebench
+#   rows = placebench.benchmark("/scratch/placebench", placebench.quick_geometries)
+#   print placebench.failures(rows)
+#
+# or from the command line (or make bench):
+#   python -m afnipyio.placebench --json bench.json
+#   python -m afnipyio.placebench --quick --compare bench.json     (timings relative to an earlier run)
+# (exit status is 0 if every mode matches the reference, 1 if any doesn't)
+
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import scipy
+from scipy.sparse import csc_matrix
+
+from afnipyio import AFNIPyIO as afni
+from afnipyio import dsetdiff
+from afnipyio import place
+
+#read, phase and slice points, Dmap expansion (phase points per voxel), timepoints per run and number of runs
+default_geometries = OrderedDict([
+    ('standard',  {'nread': 64, 'nphase': 64, 'nslice': 28, 'expan': 4,   'ntimes': 40, 'nruns': 3}),
+    ('highexpan', {'nread': 64, 'nphase': 32, 'nslice': 28, 'expan': 100, 'ntimes': 40, 'nruns': 3}),
+    ('hires',     {'nread': 96, 'nphase': 96, 'nslice': 40, 'expan': 8,   'ntimes': 20, 'nruns': 3}),
+])
+
+quick_geometries = OrderedDict([
+    ('quick',       {'nread': 32, 'nphase': 24, 'nslice': 6, 'expan': 4,  'ntimes': 8, 'nruns': 2}),
+    ('quickexpan',  {'nread': 16, 'nphase': 8,  'nslice': 4, 'expan': 25, 'ntimes': 6, 'nruns': 2}),
+])
+
+#(precision, rounding) settings every mode is run with, the first one has to match the reference bit for bit
+precisions = [('float64', 'truncate'), ('float32', 'nearest')]
+
+#per volume settings: (label, corrector options)
+volume_modes = [
+    ('sparse',            {}),
+    ('sparse threads',    {'threads': 2}),
+    ('sparse tchunk=1',   {'tchunk': 1}),
+    ('sparse float',      {'floatout': True}),
+]
+
+#whole dataset settings: (label, corrector options, correctall() options)
+dataset_modes = [
+    ('serial',            {}, {}),
+    ('stream',            {}, {'stream': True}),
+    ('pipeline',          {}, {'pipeline': 2}),
+    ('jobs',              {}, {'jobs': 2}),
+    ('threads',           {'threads': 2}, {}),
+    ('threads stream',    {'threads': 2, 'tchunk': 8}, {'stream': True}),
+]
+
+#======================== frozen reference implementation ========================
+#refmakeunwarpmatrix() and refplaceunwarp() are the makeunwarpmatrix() and placeunwarp() of PLACE 2.6 as they were
+#translated from GKA's Matlab code (minus the prints), and the oracle every faster version is checked against. Do NOT
+#optimize or otherwise change them: if PLACE's output is meant to change, that is a new reference and a new release
+def refmakeunwarpmatrix(dmap, expan):
+    expan = float(expan)
+
+    dmap3 = np.transpose(dmap,[1,0,2])
+
+    nslice = np.size(dmap3, axis=2)
+    nphasevol = np.size(dmap3, axis=0)/expan
+    nphasedmap = np.size(dmap3, axis=0)
+    nread = np.size(dmap3, axis=1)
+
+    crop = np.array([1,1,nread,nphasevol])
+
+    a = np.arange(1,nphasedmap+1)
+    phasepoints = np.tile(a[:,np.newaxis,np.newaxis], [1,nread,nslice])
+    phaseorigin = np.floor(phasepoints-dmap3, dtype=np.double)
+
+    outofbound = phaseorigin > nphasedmap
+    phaseorigin[outofbound] = phaseorigin[outofbound] - nphasedmap
+    outofbound = phaseorigin < 1
+    phaseorigin[outofbound] = phaseorigin[outofbound] + nphasedmap
+
+    x1 = crop[0]
+    x2 = x1 + crop[2]-1
+    y1 = (crop[1]-1)*expan+1
+    y2 = (crop[1] + crop[3]-1)*expan
+
+    phaseorigin = phaseorigin[int(y1-1):int(y2), int(x1-1):int(x2)]
+    nread = crop[2]
+    nphasevol = crop[3]
+    nphasedmap = nphasevol*expan
+
+    phaseorigin = phaseorigin -y1 + 1
+
+    outofbound = phaseorigin > nphasedmap
+    phaseorigin[outofbound] = nphasedmap
+    outofbound = phaseorigin < 1
+    phaseorigin[outofbound] = 1
+
+    phaseorigin = np.reshape(phaseorigin, [int(nphasedmap),-1], order='F')
+    b = np.arange(0,nread*nslice)
+    b = b*nphasedmap
+    rep = np.tile(b, [int(nphasedmap), 1])
+    phaseorigin = phaseorigin + rep
+
+    phaseorigin = np.ceil(phaseorigin.flatten(1)/expan)
+    phaseorigin = phaseorigin -1
+
+    numpoints = int(nread*nslice*nphasevol)
+
+    size = np.size(phaseorigin)
+    j = np.floor(np.arange(0,size, dtype=np.double)/expan)
+    s = np.tile(1,size)
+
+    return csc_matrix((s,(phaseorigin, j)), shape=(numpoints,numpoints))/expan
+
+def refplaceunwarp(vol, unwarpmatrix):
+    vol = np.transpose(vol, [1,0,2])
+    origshape = np.array(np.shape(vol))
+    flatvol = vol.flatten(1)
+    dot = unwarpmatrix.dot(flatvol)
+    corvol = np.reshape(dot, origshape, order='F')
+    corvol = np.transpose(corvol, [1,0,2])
+    return corvol
+
+#a whole run corrected the way PLACE 2.6 did it: one refplaceunwarp() per timepoint, cast into the scan data type.
+#With dtype = None the float64 values are returned as they are
+def refcorrect(data, unwarpmatrix, dtype=None):
+    corrected = np.empty(np.shape(data), dtype=data.dtype if dtype is None else dtype)
+    for t in range(np.size(data, axis=3)):
+        corrected[:,:,:,t] = refplaceunwarp(data[:,:,:,t], unwarpmatrix)
+    return corrected
+
+#======================== synthetic scans ========================
+#a smooth distortion like a real B0 field map: up to shift voxels (shift*expan Dmap points) of displacement along phase
+#that varies slowly with read and slice, so some of it wraps around the ends of the phase axis
+def synthdmap(nread, nphase, nslice, expan, shift=3.0, seed=0):
+    rng = np.random.RandomState(seed)
+    nphasedmap = nphase*expan
+    x = np.arange(nread)[:, np.newaxis, np.newaxis]/float(nread)
+    y = np.arange(nphasedmap)[np.newaxis, :, np.newaxis]/float(nphasedmap)
+    z = np.arange(nslice)[np.newaxis, np.newaxis, :]/float(max(nslice - 1, 1))
+
+    field = np.sin(2*np.pi*(y + 0.3*x))*(0.5 + 0.5*z) + 0.5*np.cos(2*np.pi*(2*x + z))
+    field = field*shift*expan + rng.uniform(-0.25, 0.25, field.shape)*expan
+    return np.asfortranarray(np.round(field).astype(np.int16))
+
+#an int16 run: an ellipsoid of signal with a little noise every timepoint, on a low background
+def synthepi(nread, nphase, nslice, ntimes, seed=0):
+    rng = np.random.RandomState(seed)
+    x = np.linspace(-1, 1, nread)[:, np.newaxis, np.newaxis]
+    y = np.linspace(-1, 1, nphase)[np.newaxis, :, np.newaxis]
+    z = np.linspace(-1, 1, nslice)[np.newaxis, np.newaxis, :]
+    brain = ((x/0.8)**2 + (y/0.9)**2 + (z/1.1)**2) < 1
+    base = np.where(brain, 1000 + 300*y, 20)
+
+    data = np.empty((nread, nphase, nslice, ntimes), dtype=np.int16, order='F')
+    for t in range(ntimes):
+        data[:, :, :, t] = np.clip(base + rng.normal(0, 15, base.shape), 0, None)
+    return data
+
+def writeparscan(parscan_path, nread, nphase, nslice, nreps, expan):
+    f = open(parscan_path, 'w')
+    f.write('%d %d %d %d %d\n' % (nread, nphase, nslice, nreps, expan))
+    f.close()
+
+#minimal +orig .HEAD/.BRIK pair for an int16 run, save_path without the .HEAD extension
+def writeepi(save_path, data):
+    nread, nphase, nslice, ntimes = data.shape
+    byteorder = 'LSB_FIRST' if sys.byteorder == 'little' else 'MSB_FIRST'
+    attributes = [
+        ('string-attribute',  'TYPESTRING',         "'3DIM_HEAD_ANAT~"),
+        ('integer-attribute', 'SCENE_DATA',         [0, 2, 0]),
+        ('integer-attribute', 'ORIENT_SPECIFIC',    [0, 3, 4]),
+        ('float-attribute',   'ORIGIN',             [-94.5, -94.5, -40.0]),
+        ('float-attribute',   'DELTA',              [3.0, 3.0, 3.5]),
+        ('integer-attribute', 'DATASET_RANK',       [3, ntimes, 0, 0, 0, 0, 0, 0]),
+        ('integer-attribute', 'DATASET_DIMENSIONS', [nread, nphase, nslice, 0, 0]),
+        ('integer-attribute', 'BRICK_TYPES',        [1]*ntimes),
+        ('float-attribute',   'BRICK_FLOAT_FACS',   [0.0]*ntimes),
+        ('string-attribute',  'BYTEORDER_STRING',   "'" + byteorder + "~"),
+        ('integer-attribute', 'TAXIS_NUMS',         [ntimes, 0, 77002]),
+        ('float-attribute',   'TAXIS_FLOATS',       [0.0, 2.0, 0.0, 0.0, 0.0]),
+        ('string-attribute',  'HISTORY_NOTE',       "'synthetic PLACE benchmark scan~"),
+    ]
+    f = open(save_path + '.HEAD', 'w')
+    for val_type, name, value in attributes:
+        f.write('type  = ' + val_type + '\n')
+        f.write('name  = ' + name + '\n')
+        if val_type == 'string-attribute':
+            f.write('count = ' + str(len(value) - 1) + '\n' + value + '\n\n')
+        else:
+            f.write('count = ' + str(len(value)) + '\n' + ' '.join(str(i) for i in value) + '\n\n')
+    f.close()
+    data.ravel(order='F').tofile(save_path + '.BRIK')
+
+#writes the Dmap, ParScan and runs of one geometry into directory, returns (dmap_path, parscan_path, list of .HEADs)
+def makesynthetic(directory, geometry, seed=0):
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    g = geometry
+    dmap_path = os.path.join(directory, 'Dmap')
+    parscan_path = os.path.join(directory, 'ParScan')
+
+    synthdmap(g['nread'], g['nphase'], g['nslice'], g['expan'], seed=seed).ravel(order='F').tofile(dmap_path)
+    writeparscan(parscan_path, g['nread'], g['nphase'], g['nslice'], g['ntimes'], g['expan'])
+
+    dsets = []
+    for run in range(g['nruns']):
+        save_path = os.path.join(directory, 'run%02d+orig' % (run + 1))
+        writeepi(save_path, synthepi(g['nread'], g['nphase'], g['nslice'], g['ntimes'], seed=seed + run + 1))
+        dsets.append(save_path + '.HEAD')
+    return dmap_path, parscan_path, dsets
+
+#======================== benchmark ========================
+#PLACE prints every step, which buries the results
+@contextmanager
+def quiet():
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+#best wall time of repeat calls, and the result of the last one
+def timed(function, repeat=1):
+    best = None
+    for i in range(repeat):
+        t1 = time.time()
+        result = function()
+        t2 = time.time()
+        if best is None or t2 - t1 < best:
+            best = t2 - t1
+    return best, result
+
+#tolerance a setting is held to against the float64 reference
+def tolerance(precision, rounding, floatout=False):
+    if floatout:
+        return 1e-5 if precision == 'float32' else 1e-6
+    if precision == 'float64' and rounding == 'truncate':
+        return 0
+    return 1
+
+#'identical', 'within tolerance' or 'different', and the largest absolute difference. rtol for float scans is relative
+#to the largest reference value
+def compare(result, reference, tol, floatout=False):
+    result = np.asarray(result, dtype=np.float64)
+    reference = np.asarray(reference, dtype=np.float64)
+    if result.shape != reference.shape:
+        return 'different', None
+    if np.array_equal(result, reference):
+        return 'identical', 0.0
+    maxdiff = float(np.max(np.abs(result - reference)))
+    if floatout:
+        tol = tol*max(float(np.max(np.abs(reference))), 1.0)
+    return ('within tolerance' if maxdiff <= tol else 'different'), maxdiff
+
+def row(geometry, stage, mode, seconds, units=None, unit=None, status=None, maxdiff=None):
+    entry = OrderedDict([('geometry', geometry), ('stage', stage), ('mode', mode), ('seconds', seconds)])
+    if units is not None and seconds:
+        entry['rate'] = units/seconds
+        entry['unit'] = unit
+    if status is not None:
+        entry['status'] = status
+        entry['max_abs_diff'] = maxdiff
+    return entry
+
+#unwarp matrix construction: the reference against makeunwarpmatrix() (which has to give the same matrix entry for entry)
+def benchconstruction(name, dmap, expan, repeat):
+    rows = []
+    seconds, refmatrix = timed(lambda: refmakeunwarpmatrix(dmap, expan), repeat)
+    rows.append(row(name, 'construction', 'reference', seconds, refmatrix.shape[0], 'voxels/s'))
+
+    seconds, unwarpmatrix = timed(lambda: place.makeunwarpmatrix(dmap, expan), repeat)
+    same = (np.array_equal(unwarpmatrix.indptr, refmatrix.indptr) and
+            np.array_equal(unwarpmatrix.indices, refmatrix.indices) and
+            np.array_equal(unwarpmatrix.data, refmatrix.data))
+    rows.append(row(name, 'construction', 'makeunwarpmatrix', seconds, refmatrix.shape[0], 'voxels/s',
+                    'identical' if same else 'different'))
+    return rows, refmatrix
+
+#per volume unwarping of one run: refplaceunwarp() one timepoint at a time against corrector.unwarp() for every setting
+def benchvolumes(name, dmap_path, parscan_path, data, refmatrix, repeat):
+    rows = []
+    ntimes = data.shape[3]
+
+    seconds, reference = timed(lambda: refcorrect(data, refmatrix, np.float64), repeat)
+    rows.append(row(name, 'volume', 'reference', seconds/ntimes, 1, 'volumes/s'))
+
+    for label, options in volume_modes:
+        floatout = options.get('floatout', False)
+        for precision, rounding in precisions:
+            if floatout and rounding == 'truncate':
+                rounding = 'nearest'
+            with quiet():
+                cor = place.corrector(dmap_path, parscan_path, precision=precision, rounding=rounding,
+                                      usecache=False, log=[], **options)
+            seconds, corrected = timed(lambda: cor.unwarp(data), repeat)
+
+            if floatout:
+                expected = reference
+            elif rounding == 'truncate':
+                expected = reference.astype(data.dtype)
+            else:
+                limits = np.iinfo(data.dtype)
+                expected = np.clip(np.rint(reference), limits.min, limits.max)
+            status, maxdiff = compare(corrected, expected, tolerance(precision, rounding, floatout), floatout)
+            rows.append(row(name, 'volume', label + ' ' + precision + ' ' + rounding, seconds/ntimes, 1, 'volumes/s',
+                            status, maxdiff))
+    return rows
+
+#whole datasets through correctall() in every mode, checked against _pc datasets corrected with the reference code
+def benchdatasets(name, directory, dmap_path, parscan_path, dsets, refmatrix):
+    rows = []
+    refdir = os.path.join(directory, 'reference')
+    os.makedirs(refdir)
+    nbytes = 0
+    for epi in dsets:
+        with quiet():
+            img = afni.load(epi)
+            img.brik.volume = refcorrect(img.brik.volume, refmatrix)
+            img.save(place.correctedpath(epi, refdir)[:-len('.HEAD')])
+        nbytes += 2*img.brik.volume.nbytes
+
+    for label, options, runoptions in dataset_modes:
+        for precision, rounding in precisions:
+            with quiet():
+                cor = place.corrector(dmap_path, parscan_path, precision=precision, rounding=rounding,
+                                      usecache=False, log=[], **options)
+            save_dir = tempfile.mkdtemp(prefix='out_', dir=directory)
+            with quiet():
+                seconds, skipped = timed(lambda: cor.correctall(dsets, save_dir, **runoptions))
+
+            status, maxdiff = 'identical', 0.0
+            if skipped:
+                status, maxdiff = 'different', None
+            for epi in dsets:
+                report = dsetdiff.diffdsets(place.correctedpath(epi, save_dir), place.correctedpath(epi, refdir),
+                                            atol=tolerance(precision, rounding), use_sidecar=False)
+                diffs = [entry['max_abs_diff'] for entry in report['subbricks']]
+                if not report['identical'] or None in diffs:
+                    status, maxdiff = 'different', None
+                    break
+                if max(diffs) > 0:
+                    status = 'within tolerance'
+                    maxdiff = max(maxdiff, max(diffs))
+            rows.append(row(name, 'dataset', label + ' ' + precision + ' ' + rounding, seconds/len(dsets),
+                            nbytes/1024.0**2, 'MB/s', status, maxdiff))
+            shutil.rmtree(save_dir)
+    return rows
+
+#runs everything for every geometry in scratch_dir (a temporary directory that is removed afterwards if None) and
+#returns a list of result rows: geometry, stage, mode, seconds (per call, volume or dataset), rate/unit and for the
+#checked modes status ('identical', 'within tolerance' or 'different') and max_abs_diff
+def benchmark(scratch_dir=None, geometries=default_geometries, repeat=3, datasets=True):
+    cleanup = scratch_dir is None
+    if cleanup:
+        scratch_dir = tempfile.mkdtemp(prefix='placebench_')
+
+    rows = []
+    try:
+        for name, geometry in geometries.items():
+            directory = os.path.join(scratch_dir, name)
+            if os.path.exists(directory):
+                shutil.rmtree(directory)
+            dmap_path, parscan_path, dsets = makesynthetic(directory, geometry)
+            placepars = place.readparscan(parscan_path)
+            dmap = place.readdmap(dmap_path, placepars)[1]
+
+            with quiet():
+                construction, refmatrix = benchconstruction(name, dmap, geometry['expan'], repeat)
+            rows += construction
+
+            data = synthepi(geometry['nread'], geometry['nphase'], geometry['nslice'], geometry['ntimes'], seed=1)
+            rows += benchvolumes(name, dmap_path, parscan_path, data, refmatrix, repeat)
+
+            if datasets:
+                rows += benchdatasets(name, directory, dmap_path, parscan_path, dsets, refmatrix)
+
+            for entry in rows:
+                if entry['geometry'] == name:
+                    printrow(entry)
+    finally:
+        if cleanup:
+            shutil.rmtree(scratch_dir)
+    return rows
+
+#rows whose mode doesn't match the reference
+def failures(rows):
+    return [entry for entry in rows if entry.get('status') == 'different']
+
+def printrow(entry, baseline=None):
+    line = '%-11s %-13s %-36s %10.2f ms' % (entry['geometry'], entry['stage'], entry['mode'], 1000*entry['seconds'])
+    if 'rate' in entry:
+        line += ' %12.1f %-9s' % (entry['rate'], entry['unit'])
+    else:
+        line += ' ' * 23
+    if baseline is not None:
+        key = (entry['geometry'], entry['stage'], entry['mode'])
+        if key in baseline and entry['seconds']:
+            line += ' %6.2fx' % (baseline[key]/entry['seconds'])
+        else:
+            line += ' ' * 8
+    if 'status' in entry:
+        line += ' ' + entry['status']
+        if entry['max_abs_diff']:
+            line += ' (max abs diff: %g)' % entry['max_abs_diff']
+    print line
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the PLACE unwarp on synthetic scans and check every execution mode against the reference implementation')
+    parser.add_argument('--quick', action = 'store_true', help = 'small geometries only, for a quick correctness check')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'timings are the best of this many runs (default: 3)')
+    parser.add_argument('--no-datasets', action = 'store_true', help = 'skip the whole dataset (correctall()) modes')
+    parser.add_argument('--scratch', default = None, help = 'directory for the synthetic scans (default: a temporary directory that is removed afterwards)')
+    parser.add_argument('--json', default = None, help = 'write the results to this file')
+    parser.add_argument('--compare', default = None, help = 'results file of an earlier run, timings are shown as speedups over it')
+
+    args = parser.parse_args()
+
+    rows = benchmark(args.scratch, quick_geometries if args.quick else default_geometries, args.repeat,
+                     not args.no_datasets)
+
+    if args.compare:
+        f = open(args.compare, 'r')
+        earlier = json.load(f)
+        f.close()
+        baseline = dict(((entry['geometry'], entry['stage'], entry['mode']), entry['seconds'])
+                        for entry in earlier['results'])
+        print '\nSpeedup over ' + args.compare + ':'
+        for entry in rows:
+            printrow(entry, baseline)
+
+    if args.json:
+        f = open(args.json, 'w')
+        json.dump({'place_version': place.version, 'numpy': np.__version__, 'scipy': scipy.__version__,
+                   'cpus': multiprocessing.cpu_count(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'results': rows}, f, indent=1)
+        f.close()
+
+    bad = failures(rows)
+    if bad:
+        print '\n' + str(len(bad)) + ' mode(s) DIFFER from the reference implementation'
+    else:
+        print '\nEvery mode matches the reference implementation'
+    sys.exit(1 if bad else 0)
+
+if __name__ == "__main__":
+    main()
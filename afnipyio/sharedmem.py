@@ -0,0 +1,223 @@
+#!/usr/bin/env python2.7
+
+# AFNIpyIO shared memory datasets
+# Put one copy of a dataset's volume in POSIX shared memory (/dev/shm) and let any number of worker processes attach
+# zero-copy numpy views of it.
+# developed and tested on python2.7
+
+# Required modules: numpy, AFNIPyIO
+
+# When an analysis is fanned out over a multiprocessing pool every worker usually calls load() on the same dataset,
+# so a 16 worker job holds 16 copies of the volume in RAM. With this module the parent publishes the dataset once:
+#
+#   from afnipyio import sharedmem
+#   srv = sharedmem.server("/My/path/to/EPI+orig.HEAD")
+#
+#   def work(name):
+#       x = sharedmem.attach(name)          #x.head and x.brik.volume look just like a load() instance
+#       result = x.brik.volume[:, :, 10, :].mean()
+#       x.close()
+#       return result
+#
+#   pool.map(work, [srv.name]*100)
+#   srv.close()
+#
+# A published dataset lives in three files in /dev/shm (or the temp dir if /dev/shm doesn't exist):
+#   <name>.vol  - the volume, native byte order, Fortran order (same layout as the .BRIK)
+#   <name>.head - the pickled head instance plus shape/dtype information
+#   <name>.ref  - reference count, updated under an fcntl lock
+# The server holds one reference and every attach() adds one. server.close() removes the files no matter how many
+# references are left, so workers that raise, exit or are terminated without calling close() can't keep a dataset in
+# RAM after it: the ones still attached keep working on their mappings (the memory is freed when the last one is
+# gone), later attach() calls fail.
+
+# NOTE: attached volumes are read-only memmaps. Copy the parts you want to modify.
+
+import os
+import uuid
+import fcntl
+import atexit
+import cPickle as pickle
+
+import numpy as np
+
+from afnipyio import AFNIPyIO as afni
+
+if os.path.isdir('/dev/shm'):
+    shm_dir = '/dev/shm'
+else:
+    import tempfile
+    shm_dir = tempfile.gettempdir()
+
+def shmpath(name, ext):
+    return os.path.join(shm_dir, name + ext)
+
+#add delta to the reference count of a published dataset and return the new count
+#when the count drops to zero the shared memory files are removed
+def changeref(name, delta):
+    ref_path = shmpath(name, '.ref')
+    try:
+        fd = os.open(ref_path, os.O_RDWR)
+    except OSError:
+        raise afni.Error("Shared dataset " + name + " no longer exists!")
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        raw = os.read(fd, 32).strip()
+        #a zero count means somebody already cleaned up while we were waiting for the lock
+        count = int(raw) if raw else 0
+        if count <= 0:
+            raise afni.Error("Shared dataset " + name + " no longer exists!")
+        count += delta
+        if count <= 0:
+            for ext in ('.vol', '.head', '.ref'):
+                try:
+                    os.unlink(shmpath(name, ext))
+                except OSError:
+                    pass
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, str(max(count, 0)))
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+    return count
+
+#removes the files of a published dataset whatever its reference count. The count is set to zero under the lock, so
+#an attach() or close() waiting for it finds the dataset gone
+def unpublish(name):
+    try:
+        fd = os.open(shmpath(name, '.ref'), os.O_RDWR)
+    except OSError:
+        return
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        for ext in ('.vol', '.head', '.ref'):
+            try:
+                os.unlink(shmpath(name, ext))
+            except OSError:
+                pass
+        os.ftruncate(fd, 0)
+        os.write(fd, '0')
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+#container for the brik side of an attached dataset (mirrors AFNIPyIO.brik)
+class sharedbrik:
+    def __init__(self, path, volume):
+        self.path = path
+        self.volume = volume
+
+# Publishes a dataset (either a path to a .HEAD/.BRIK or an already loaded AFNIPyIO.load instance) in shared memory
+class server:
+
+    def __init__(self, dset):
+        self.name = 'afnipyio-%d-%s' % (os.getpid(), uuid.uuid4().hex[:12])
+        self.closed = False
+        self.pid = os.getpid()
+
+        if isinstance(dset, basestring):
+            path = afni.commonpath(dset)
+            dset_head = afni.head(path + ".HEAD")
+            brik_path = path + ".BRIK"
+            volume = None
+        else:
+            path = dset.path
+            dset_head = dset.head
+            brik_path = dset.brik.path
+            volume = dset.brik.volume
+
+        if volume is not None:
+            shape = volume.shape
+            dtype = volume.dtype
+        else:
+            dims = dset_head.DATASET_DIMENSIONS[2]
+            shape = (dims[0], dims[1], dims[2], dset_head.DATASET_RANK[2][1])
+            dtype = np.dtype(dset_head.dtype)
+
+        #reference count file goes first so a crash half way through can still be cleaned up with changeref()
+        ref = open(shmpath(self.name, '.ref'), 'w')
+        ref.write('1')
+        ref.close()
+
+        try:
+            shared = np.memmap(shmpath(self.name, '.vol'), dtype=dtype, mode='w+', shape=shape, order='F')
+            if volume is not None:
+                shared[...] = volume
+            else:
+                #stream the .BRIK straight into shared memory one sub-brick at a time instead of load()ing it first,
+                #which would briefly hold two copies
+                ondisk = afni.mapbrik(brik_path, dset_head)
+                for t in range(shape[3]):
+                    shared[:, :, :, t] = ondisk[:, :, :, t]
+                del ondisk
+            shared.flush()
+            del shared
+
+            info = {'path': path, 'brik_path': brik_path, 'head': dset_head,
+                    'shape': shape, 'dtype': np.dtype(dtype).str}
+            h = open(shmpath(self.name, '.head'), 'wb')
+            pickle.dump(info, h, 2)
+            h.close()
+        except:
+            unpublish(self.name)
+            raise
+
+        atexit.register(self.__cleanup)
+
+    #forked children inherit our atexit handlers, only the publishing process should drop the server reference
+    def __cleanup(self):
+        if os.getpid() == self.pid:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            unpublish(self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# An attached shared dataset. Has the same path/head/brik.volume layout as an AFNIPyIO.load instance
+class attach:
+
+    def __init__(self, name):
+        changeref(name, +1)
+        self.name = name
+        self.closed = False
+
+        try:
+            h = open(shmpath(name, '.head'), 'rb')
+            info = pickle.load(h)
+            h.close()
+
+            self.path = info['path']
+            self.head = info['head']
+            volume = np.memmap(shmpath(name, '.vol'), dtype=np.dtype(info['dtype']), mode='r',
+                               shape=info['shape'], order='F')
+            self.brik = sharedbrik(info['brik_path'], volume)
+        except:
+            changeref(name, -1)
+            raise
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            #drop our mapping before giving up the reference
+            del self.brik.volume
+            try:
+                changeref(self.name, -1)
+            except afni.Error:
+                #the server closed first and already removed it
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()